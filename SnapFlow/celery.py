@@ -11,6 +11,11 @@ app = Celery('SnapFlow')
 app.config_from_object('django.conf:settings', namespace='CELERY')
 app.autodiscover_tasks(['users', 'events', 'photos', 'notifications', 'highlights', 'privacy'])
 
+# Connects the worker_process_init receiver that loads and warms up the face
+# models in every worker process; task modules only import it lazily. Its
+# module top needs numpy and celery only, so the web process stays light.
+import photos.ml  # noqa: E402,F401
+
 @app.task(bind=True)
 def debug_task(self):
     print(f'Request: {self.request!r}')
@@ -33,4 +38,8 @@ app.conf.beat_schedule = {
         'task': 'notifications.tasks.send_weekly_digest',
         'schedule': crontab(day_of_week=0, hour=10, minute=0),  # Run at 10:00 AM on Sundays
     },
+    'recover-stale-highlight-runs': {
+        'task': 'highlights.tasks.recover_stale_highlight_runs',
+        'schedule': crontab(minute='*/10'),  # Every 10 minutes
+    },
 }
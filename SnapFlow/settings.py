@@ -201,6 +201,102 @@ CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = 'UTC'  # Set to your project's timezone
 
+# Shared cache: coalesced job markers, per-event locks and counters must be
+# visible to every web and worker process
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.getenv('CACHE_REDIS_URL', 'redis://127.0.0.1:6379/1'),
+    },
+    # Database-backed alternative for the job scheduler (run `manage.py createcachetable`)
+    'jobs_db': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'event_job_cache',
+    },
+}
+
+# Per-event maintenance jobs (duplicate rebuilds, best shots): requests for the
+# same job and event within the window run once; runs on an event never overlap
+EVENT_JOB_CACHE = os.getenv('EVENT_JOB_CACHE', 'default')  # or 'jobs_db'
+EVENT_JOB_WINDOW = 30  # seconds
+EVENT_JOB_LOCK_TIMEOUT = 30 * 60  # seconds
+
+# Per-event highlights summary read by HighlightsMiddleware; dropped when
+# best shots or duplicate groups change, the timeout only bounds rare races
+HIGHLIGHTS_SUMMARY_CACHE = 'default'
+HIGHLIGHTS_SUMMARY_TIMEOUT = 60 * 60  # seconds
+
+# Per-event map of hidden and blurred photo ids read by galleries; dropped
+# when a privacy request of the event completes or is deleted
+PRIVACY_MAP_CACHE = 'default'
+PRIVACY_MAP_TIMEOUT = 60 * 60  # seconds
+
+# Whole-event highlight runs analyze HIGHLIGHT_CHUNK_SIZE photos per task; best
+# shots and duplicate groups are rebuilt once, after the last chunk
+HIGHLIGHT_CHUNK_SIZE = 50
+# A run without progress for this long is recovered: a stalled analysis is
+# finalized with the chunks that finished, a stalled finalization fails
+HIGHLIGHT_RUN_TIMEOUT = 60 * 60  # seconds
+
+# Photos with an EXIF capture time are only compared for duplicates with the
+# same camera's photos taken within DUPLICATE_TIME_WINDOW seconds; frames at
+# most BURST_MAX_GAP seconds apart form a burst
+DUPLICATE_TIME_WINDOW = 10  # seconds
+BURST_MAX_GAP = 2  # seconds
+
+# Blur requests are processed PRIVACY_BLUR_CHUNK_SIZE photos per task, the
+# chunks in parallel; the request completes after the last chunk
+PRIVACY_BLUR_CHUNK_SIZE = 25
+
+# Blurred and resized versions of privacy-masked photos are rendered when
+# first viewed and cached on disk per (photo, mask version, size)
+PRIVACY_DERIVATIVE_DIR = BASE_DIR / 'privacy_cache'
+PRIVACY_DERIVATIVE_SIZES = {'thumb': 400, 'medium': 800, 'full': None}  # longest edge in pixels
+PRIVACY_DERIVATIVE_CACHE = 'default'  # render slots and counters, shared by every web process
+PRIVACY_DERIVATIVE_MAX_RENDERS = 4  # concurrent renders across all processes
+PRIVACY_DERIVATIVE_SLOT_TIMEOUT = 60  # seconds before the slot of a crashed render is freed
+PRIVACY_DERIVATIVE_RENDER_WAIT = 10  # seconds before answering 503
+PRIVACY_DERIVATIVE_CACHE_MAX_BYTES = 512 * 2 ** 20  # least recently served files evicted beyond this
+PRIVACY_DERIVATIVE_EVICT_EVERY = 50  # renders between two eviction scans
+PRIVACY_DERIVATIVE_QUALITY = 85
+
+# Photo processing pipeline
+# 'fused': decode each upload once and run quality, face and tag analysis in one task
+# 'chord': fan out one Celery task per analysis stage (each stage decodes the image again)
+PHOTO_PROCESSING_MODE = os.getenv('PHOTO_PROCESSING_MODE', 'fused')
+
+# Analysis proxies: bounded-size JPEG per photo read by every analyzer
+ANALYSIS_PROXY_MAX_SIZE = 1600  # longest edge in pixels
+ANALYSIS_PROXY_QUALITY = 90
+
+# Face models, loaded and warmed up once per Celery worker process
+FACE_DETECTOR_BACKEND = 'retinaface'
+FACE_EMBEDDING_MODELS = ['Facenet', 'VGG-Face', 'ArcFace']
+FACE_MODEL_WARMUP = True
+
+# Embedding models run cheapest first; a face is settled by a stage when its
+# best user beats the runner-up by the margin (confidence points), and only
+# ambiguous faces go on to the next model. None never settles early.
+FACE_MODEL_CASCADE = [
+    ('Facenet', 10),
+    ('ArcFace', 8),
+    ('VGG-Face', None),
+]
+
+# Bulk uploads are processed PHOTO_BATCH_SIZE photos per task, and the
+# embedding models run over FACE_EMBEDDING_BATCH_SIZE face crops per forward pass
+PHOTO_BATCH_SIZE = 16
+FACE_EMBEDDING_BATCH_SIZE = 32
+
+# Avatar face embeddings: decoded vectors kept in each worker's in-process LRU
+FACE_EMBEDDING_CACHE_SIZE = 20000  # number of (user, model) vectors
+
+# Approximate face search (IVF index per event and model) for very large events
+FACE_ANN_MIN_USERS = 5000  # events with fewer users use exact search
+FACE_ANN_PROBES = 8  # index lists searched per face; higher is slower but more accurate
+FACE_ANN_LOCK_TIMEOUT = 5 * 60  # seconds an index writer may hold the per-event lock
+FACE_ANN_LOCK_WAIT = 60  # seconds a writer waits for it before giving up
+
 # Configure logging for Celery tasks
 LOGGING = {
     # Add the existing LOGGING config if you have it
@@ -0,0 +1,28 @@
+"""
+Settings for running the test suite.
+
+Select them with DJANGO_SETTINGS_MODULE=SnapFlow.test_settings (or
+--settings), whatever runs the tests. Migrations are generated locally and
+not committed, so the test database is created straight from the models.
+"""
+from .settings import *  # noqa: F401,F403
+
+
+class DisableMigrations:
+    def __contains__(self, item):
+        return True
+
+    def __getitem__(self, item):
+        return None
+
+
+MIGRATION_MODULES = DisableMigrations()
+
+
+# Per-process cache instead of Redis, for the job markers, locks, counters
+# and cached summaries the code under test reads and writes
+CACHES = {
+    **CACHES,  # noqa: F405
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+}
+EVENT_JOB_CACHE = 'default'
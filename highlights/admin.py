@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import BestShot, DuplicateGroup, DuplicatePhoto
+from .models import BestShot, DuplicateGroup, DuplicatePhoto, HighlightProcessingStatus, PhotoHighlight
 
 class BestShotAdmin(admin.ModelAdmin):
     list_display = ('event', 'category', 'score', 'created_at')
@@ -7,6 +7,16 @@ class BestShotAdmin(admin.ModelAdmin):
     search_fields = ('event__title',)
     raw_id_fields = ('event', 'photo')
 
+class PhotoHighlightAdmin(admin.ModelAdmin):
+    list_display = ('photo', 'event', 'quality_score', 'analyzed_at')
+    list_filter = ('event',)
+    raw_id_fields = ('event', 'photo')
+
+class HighlightProcessingStatusAdmin(admin.ModelAdmin):
+    list_display = ('event', 'status', 'processed_photos', 'total_photos', 'completed_chunks', 'total_chunks', 'started_at', 'finished_at')
+    list_filter = ('status',)
+    raw_id_fields = ('event',)
+
 class DuplicatePhotoInline(admin.TabularInline):
     model = DuplicatePhoto
     extra = 0
@@ -23,4 +33,6 @@ class DuplicateGroupAdmin(admin.ModelAdmin):
     photo_count.short_description = 'Number of Photos'
 
 admin.site.register(BestShot, BestShotAdmin)
-admin.site.register(DuplicateGroup, DuplicateGroupAdmin)
\ No newline at end of file
+admin.site.register(DuplicateGroup, DuplicateGroupAdmin)
+admin.site.register(PhotoHighlight, PhotoHighlightAdmin)
+admin.site.register(HighlightProcessingStatus, HighlightProcessingStatusAdmin)
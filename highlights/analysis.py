@@ -1,11 +1,45 @@
 # highlights/analysis.py
-def analyze_photo_advanced(photo):
+import logging
+import random
+
+import numpy as np # type: ignore
+
+logger = logging.getLogger(__name__)
+
+
+def analyze_photo_advanced(photo, features=None):
     """Advanced analysis of photo quality with detection of shot types and problems."""
-    import cv2
-    import numpy as np
-    from PIL import Image, ImageStat
-    import json
+    if features is None:
+        # Measured by the ingest pipeline; only photos ingested before the
+        # feature store (or by an older analyzer version) are measured here
+        from photos.features import get_photo_features
+        try:
+            features = get_photo_features(photo)
+        except Exception as e:
+            logger.error(f"Error loading features of photo {photo.id}: {str(e)}")
+            features = None
+
+    return score_photo(photo, features)
+
+
+def face_tile_sharpness(features, box, scale):
+    """Sharpness of a face box estimated from the tile sharpness map (mean of the tiles it covers)."""
+    tiles = features['tile_sharpness']
+    grid_rows, grid_cols = tiles.shape
+    x, y, w, h = (value / scale for value in box)
+    col_start = min(int(x / features['width'] * grid_cols), grid_cols - 1)
+    row_start = min(int(y / features['height'] * grid_rows), grid_rows - 1)
+    col_end = max(col_start + 1, min(int(np.ceil((x + w) / features['width'] * grid_cols)), grid_cols))
+    row_end = max(row_start + 1, min(int(np.ceil((y + h) / features['height'] * grid_rows)), grid_rows))
+    return float(tiles[row_start:row_end, col_start:col_end].mean())
 
+
+def score_photo(photo, features):
+    """
+    Score a photo from its stored features, detected faces and scene tags.
+
+    Does no image I/O, so whole events can be re-scored from the database.
+    """
     results = {
         'quality_score': 0,
         'shot_type': None,
@@ -23,19 +57,18 @@ def analyze_photo_advanced(photo):
         'categories': []
     }
     
+    if features is None:
+        return results
+
     try:
-        # Open the image
-        img = Image.open(photo.image.path)
-        
-        # Get image dimensions and basic stats
-        width, height = img.size
-        aspect_ratio = width / height
-        img_gray = img.convert('L')
-        stat = ImageStat.Stat(img_gray)
+        # Image dimensions (of the original), measured on the analysis proxy
+        width = photo.image_width or features['width']
+        height = photo.image_height or features['height']
+        proxy_factor = features['width'] / width  # maps original pixels to proxy pixels
         
         # Basic quality metrics
-        brightness = stat.mean[0]
-        contrast = stat.stddev[0]
+        brightness = features['brightness']
+        contrast = features['contrast']
         
         # Normalized scores (0-100)
         brightness_score = (1 - abs((brightness - 128) / 128)) * 100
@@ -45,13 +78,8 @@ def analyze_photo_advanced(photo):
         resolution = width * height
         resolution_score = min((resolution / (3000 * 2000)) * 100, 100)
         
-        # Check for faces using existing detected_faces data
-        faces = []
-        if photo.detected_faces:
-            try:
-                faces = json.loads(photo.detected_faces)
-            except:
-                faces = []
+        # Check for faces using existing detected_faces data (a JSONField, already decoded)
+        faces = photo.detected_faces if isinstance(photo.detected_faces, list) else []
         
         face_count = len(faces)
         has_faces = face_count > 0
@@ -79,17 +107,15 @@ def analyze_photo_advanced(photo):
         
         # Calculate composition score (rule of thirds, etc.)
         # This would be more complex in a real implementation
-        composition_score = 70 + (np.random.rand() * 30)  # Placeholder
+        # Placeholder, seeded by the photo so that re-scoring is reproducible
+        composition_score = 70 + (random.Random(photo.id).random() * 30)
         
         # Lighting score
-        lighting_uniformity = 100 - min(((stat.stddev[0] / stat.mean[0]) * 100), 100)
+        lighting_uniformity = 100 - min(((contrast / brightness) * 100) if brightness else 100, 100)
         lighting_score = (brightness_score * 0.6) + (lighting_uniformity * 0.4)
         
         # IMPROVED: Blur detection using combination of Laplacian variance and face-aware analysis
-        # Convert PIL image to OpenCV format for blur detection
-        img_np = np.array(img_gray)
-        laplacian = cv2.Laplacian(img_np, cv2.CV_64F)
-        laplacian_var = laplacian.var()
+        laplacian_var = features['sharpness']
         
         # Higher variance = less blur, normalize to 0-100
         raw_blur_score = min((laplacian_var / 500) * 100, 100)
@@ -111,26 +137,17 @@ def analyze_photo_advanced(photo):
                 blur_score = min(raw_blur_score * 1.2, 100)
                 
             # Check if faces are present and analyze face regions for blur
-            if faces and isinstance(faces, list) and len(faces) > 0:
-                face_sharpness_scores = []
-                for face in faces:
-                    if isinstance(face, dict) and 'x' in face and 'y' in face and 'width' in face and 'height' in face:
-                        # Extract face region and compute its Laplacian variance
-                        face_x, face_y = int(face['x']), int(face['y'])
-                        face_w, face_h = int(face['width']), int(face['height'])
-                        
-                        # Ensure coordinates are within image bounds
-                        face_x = max(0, face_x)
-                        face_y = max(0, face_y)
-                        face_w = min(width - face_x, face_w)
-                        face_h = min(height - face_y, face_h)
-                        
-                        if face_w > 0 and face_h > 0:
-                            face_region = img_np[face_y:face_y+face_h, face_x:face_x+face_w]
-                            if face_region.size > 0:
-                                face_laplacian = cv2.Laplacian(face_region, cv2.CV_64F)
-                                face_var = face_laplacian.var()
-                                face_sharpness_scores.append(face_var)
+            if faces:
+                from photos.features import face_boxes_of
+                face_boxes = face_boxes_of(faces)
+                if face_boxes == features['face_boxes']:
+                    # Laplacian variance of each face, measured at ingest
+                    face_sharpness_scores = [value for value in features['face_sharpness'] if value is not None]
+                else:
+                    # Faces changed since the features were measured: estimate from the tile map
+                    face_sharpness_scores = [
+                        face_tile_sharpness(features, box, 1 / proxy_factor) for box in face_boxes
+                    ]
                 
                 # If we have face sharpness scores, prioritize them over whole image
                 if face_sharpness_scores:
@@ -158,8 +175,8 @@ def analyze_photo_advanced(photo):
         
         # IMPROVED: Exposure detection
         # Calculate exposure score based on histogram distribution
-        histogram = np.array(img_gray.histogram())
-        total_pixels = np.sum(histogram)
+        histogram = features['histogram']
+        total_pixels = np.sum(histogram) or 1
         
         # Check for underexposure (too many dark pixels)
         dark_ratio = np.sum(histogram[:50]) / total_pixels
@@ -169,23 +186,18 @@ def analyze_photo_advanced(photo):
         
         # More precise exposure score calculation
         mid_range_ratio = np.sum(histogram[50:200]) / total_pixels
-        exposure_score = mid_range_ratio * 100  # Higher ratio in middle range = better exposure
+        exposure_score = float(mid_range_ratio * 100)  # Higher ratio in middle range = better exposure
         
         # Determine exposure issues with more accurate thresholds
         is_underexposed = dark_ratio > 0.5 or brightness < 60
         is_overexposed = bright_ratio > 0.5 or brightness > 200
         
         # Check for good action shots
-        is_action = False
-        if hasattr(photo, 'scene_tags') and photo.scene_tags:
-            try:
-                tags = json.loads(photo.scene_tags)
-                action_keywords = ['sport', 'action', 'running', 'jumping', 'dancing']
-                if any(kw in str(tags).lower() for kw in action_keywords):
-                    is_action = True
-                    results['categories'].append('ACTION')
-            except:
-                pass
+        if photo.scene_tags:
+            # scene_tags is a JSONField, already decoded
+            action_keywords = ['sport', 'action', 'running', 'jumping', 'dancing']
+            if any(kw in str(photo.scene_tags).lower() for kw in action_keywords):
+                results['categories'].append('ACTION')
         
         # IMPROVED: Detect accidental shots with more accurate criteria
         technical_issues = 0
@@ -305,6 +317,6 @@ def analyze_photo_advanced(photo):
         results['is_accidental'] = is_accidental
             
     except Exception as e:
-        print(f"Error in advanced analysis: {str(e)}")
+        logger.warning(f"Error in advanced analysis of photo {photo.id}: {str(e)}", exc_info=True)
         
     return results
\ No newline at end of file
@@ -0,0 +1,135 @@
+# highlights/bursts.py
+"""
+Capture-time windows: bursts and duplicate candidates.
+
+Photos that carry an EXIF capture time (see photos/exif.py) are grouped
+per camera: its body serial when the camera records one, otherwise the
+photographer who uploaded it. Duplicate detection only compares photos
+of the same camera taken at most DUPLICATE_TIME_WINDOW seconds apart,
+instead of every pair of the event. A burst is a run of frames of one
+camera with no more than BURST_MAX_GAP seconds between consecutive
+frames; its best frame is the one with the highest quality score.
+"""
+from datetime import timedelta
+
+import numpy as np # type: ignore
+from django.conf import settings
+
+from photos.models import EventPhoto
+
+DEFAULT_DUPLICATE_WINDOW = 10  # seconds
+DEFAULT_BURST_GAP = 2  # seconds
+
+
+def get_duplicate_window():
+    return getattr(settings, 'DUPLICATE_TIME_WINDOW', DEFAULT_DUPLICATE_WINDOW)
+
+
+def get_burst_gap():
+    return getattr(settings, 'BURST_MAX_GAP', DEFAULT_BURST_GAP)
+
+
+def camera_key(camera_serial, uploaded_by_id):
+    return f"serial:{camera_serial}" if camera_serial else f"uploader:{uploaded_by_id}"
+
+
+def same_camera_filter(photo, prefix=''):
+    """Filter kwargs selecting the photos taken by the camera of `photo`."""
+    if photo.camera_serial:
+        return {f'{prefix}camera_serial': photo.camera_serial}
+    return {f'{prefix}camera_serial': '', f'{prefix}uploaded_by_id': photo.uploaded_by_id}
+
+
+def capture_window(photo, seconds=None):
+    """(start, end) of the duplicate window around the capture time of a photo."""
+    window = timedelta(seconds=get_duplicate_window() if seconds is None else seconds)
+    return photo.taken_at - window, photo.taken_at + window
+
+
+def window_pairs(cameras, times, window):
+    """
+    (i, j) index arrays of every pair of photos by the same camera taken at most `window` seconds apart.
+
+    Each camera's photos are sorted by time and every photo is paired with
+    the ones that follow it inside the window, so the cost grows with the
+    number of pairs found, not with the square of the number of photos.
+    """
+    times = np.asarray(times, dtype=np.float64)
+    order = sorted(range(len(times)), key=lambda index: (cameras[index], times[index]))
+    rows, cols = [], []
+
+    start = 0
+    while start < len(order):
+        end = start
+        while end < len(order) and cameras[order[end]] == cameras[order[start]]:
+            end += 1
+        indices = np.array(order[start:end], dtype=np.int64)
+        camera_times = times[indices]
+        stops = np.searchsorted(camera_times, camera_times + window, side='right')
+        for position, stop in enumerate(stops.tolist()):
+            if stop > position + 1:
+                rows.append(np.full(stop - position - 1, indices[position], dtype=np.int64))
+                cols.append(indices[position + 1:stop])
+        start = end
+
+    if not rows:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    return np.concatenate(rows), np.concatenate(cols)
+
+
+def split_bursts(frames, gap):
+    """
+    Bursts of (camera, time, frame number, photo id, quality score) frames, as lists of frames.
+
+    Frames are ordered by camera, time and frame number; a new burst
+    starts at each change of camera or gap longer than `gap` seconds.
+    Single frames are not bursts.
+    """
+    bursts = []
+    current = []
+    for frame in sorted(frames, key=lambda frame: frame[:3]):
+        if current and (frame[0] != current[-1][0] or frame[1] - current[-1][1] > gap):
+            if len(current) > 1:
+                bursts.append(current)
+            current = []
+        current.append(frame)
+    if len(current) > 1:
+        bursts.append(current)
+    return bursts
+
+
+def best_frame(burst):
+    """The frame with the highest quality score, the earliest one on ties or unscored frames."""
+    return max(burst, key=lambda frame: (frame[4] if frame[4] is not None else -1, -frame[1]))
+
+
+def event_bursts(event_id, gap=None):
+    """
+    Bursts of an event, in capture order, from one query over the capture metadata.
+
+    Each burst is a dict with the photo ids of its frames, the id of its
+    best frame, its camera and its first and last capture times.
+    """
+    gap = get_burst_gap() if gap is None else gap
+    rows = EventPhoto.objects.filter(event_id=event_id, taken_at__isnull=False).order_by().values_list(
+        'id', 'camera_serial', 'uploaded_by_id', 'taken_at', 'capture_sequence', 'quality_score'
+    )
+
+    frames = [
+        # The frame number orders frames stamped with the same second
+        (camera_key(serial, uploader), taken_at.timestamp(), sequence or 0, photo_id, quality)
+        for photo_id, serial, uploader, taken_at, sequence, quality in rows
+    ]
+
+    bursts = [
+        {
+            'photo_ids': [frame[3] for frame in burst],
+            'best_photo_id': best_frame(burst)[3],
+            'camera': burst[0][0],
+            'started_at': burst[0][1],
+            'ended_at': burst[-1][1],
+        }
+        for burst in split_bursts(frames, gap)
+    ]
+    bursts.sort(key=lambda burst: burst['started_at'])
+    return bursts
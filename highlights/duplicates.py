@@ -0,0 +1,410 @@
+# highlights/duplicates.py
+"""
+Near-duplicate detection from persisted photo signatures.
+
+Each photo gets a PhotoSignature (bit-packed 16x16 average hash, RGB
+histogram, resolution) once, when it is ingested. A new photo is then
+inserted into the existing duplicate groups of its event by comparing its
+signature with the stored ones, without opening any other image.
+Rebuilding all groups of an event is a separate, explicit operation.
+
+Photos with an EXIF capture time are only compared with photos of the
+same camera taken within DUPLICATE_TIME_WINDOW seconds (see bursts.py);
+photos without one are compared with the other photos without one.
+"""
+import logging
+
+import numpy as np # type: ignore
+from PIL import Image
+
+from events.models import Event
+from photos.models import EventPhoto
+from photos.proxies import open_analysis_proxy
+from photos.transactions import run_in_transaction
+from .bursts import camera_key, capture_window, get_duplicate_window, same_camera_filter, window_pairs
+from .hamming import (
+    get_event_hash_index, hamming_distances, invalidate_event_hash_index, pack_hashes, pairs_within_radius,
+    popcount64,
+)
+from .models import DuplicateGroup, DuplicatePhoto, PhotoSignature
+from .summary import invalidate_highlights_summary
+
+logger = logging.getLogger(__name__)
+
+HASH_SIZE = 16  # 16x16 average hash -> 256 bits
+HASH_BITS = HASH_SIZE * HASH_SIZE
+HISTOGRAM_SIZE = 64  # histogram of a 64x64 thumbnail
+
+# Photos must meet BOTH thresholds to be considered duplicates
+PHASH_THRESHOLD = 0.92
+COLOR_THRESHOLD = 0.88
+
+# Largest Hamming distance that still meets PHASH_THRESHOLD
+PHASH_RADIUS = int((1 - PHASH_THRESHOLD) * HASH_BITS)
+
+# Weights of the combined similarity stored on DuplicatePhoto
+PHASH_WEIGHT = 0.6
+COLOR_WEIGHT = 0.4
+
+# Candidate pairs whose histograms are intersected per block during a rebuild
+HISTOGRAM_BLOCK_SIZE = 4096
+
+
+def compute_signature(img):
+    """(packed hash bytes, normalized float32 histogram) of a PIL image."""
+    # 1. Average hash (sensitive to structure)
+    img_small = img.resize((HASH_SIZE, HASH_SIZE), Image.Resampling.LANCZOS).convert('L')
+    pixels = np.array(img_small).flatten()
+    phash = np.packbits(pixels > np.mean(pixels))
+
+    # 2. Color histogram (sensitive to color distribution), summing to 1 over all channels
+    img_rgb = img.resize((HISTOGRAM_SIZE, HISTOGRAM_SIZE), Image.Resampling.LANCZOS).convert('RGB')
+    histogram = np.array(img_rgb.histogram(), dtype=np.float32)
+    histogram /= histogram.sum()
+
+    return phash.tobytes(), histogram.tobytes()
+
+
+def get_photo_signature(photo, force=False):
+    """Stored signature of a photo, computed from its analysis proxy if missing."""
+    if not force:
+        signature = PhotoSignature.objects.filter(photo=photo).first()
+        if signature is not None:
+            return signature
+
+    img = open_analysis_proxy(photo)
+    phash, color_hist = compute_signature(img)
+    resolution = (photo.image_width or img.size[0]) * (photo.image_height or img.size[1])
+
+    signature, created = PhotoSignature.objects.update_or_create(
+        photo=photo,
+        defaults={
+            'event_id': photo.event_id,
+            'phash': phash,
+            'color_hist': color_hist,
+            'resolution': resolution,
+        }
+    )
+    if not created:
+        # The cached index only picks up new rows
+        invalidate_event_hash_index(photo.event_id)
+    return signature
+
+
+def ensure_event_signatures(event_id):
+    """Compute the signatures missing for photos of an event; returns how many were added."""
+    missing = EventPhoto.objects.filter(event_id=event_id, signature__isnull=True)
+    added = 0
+    for photo in missing:
+        try:
+            get_photo_signature(photo, force=True)
+            added += 1
+        except Exception as e:
+            logger.error(f"Error computing signature of photo {photo.id}: {str(e)}")
+    return added
+
+
+def unpack_histograms(histograms):
+    return np.frombuffer(b''.join(bytes(h) for h in histograms), dtype=np.float32).reshape(len(histograms), -1)
+
+
+def color_similarity(histogram, histograms):
+    """Histogram intersection between one histogram and each row of a matrix."""
+    return np.minimum(histograms, histogram).sum(axis=1)
+
+
+def combined_similarity(phash_sim, color_sim):
+    return phash_sim * PHASH_WEIGHT + color_sim * COLOR_WEIGHT
+
+
+def match_histograms(signature, candidate_sims, hist_rows):
+    """{photo id: combined similarity} of the (photo id, histogram) rows that meet the color threshold."""
+    if not hist_rows:
+        return {}
+    color_sims = color_similarity(
+        np.frombuffer(bytes(signature.color_hist), dtype=np.float32),
+        unpack_histograms([hist for _, hist in hist_rows]),
+    )
+    return {
+        photo_id: float(combined_similarity(candidate_sims[photo_id], color_sim))
+        for (photo_id, _), color_sim in zip(hist_rows, color_sims)
+        if color_sim >= COLOR_THRESHOLD
+    }
+
+
+def find_similar_in_window(signature, photo):
+    """Duplicates of a photo with a capture time, among the same camera's photos around it."""
+    rows = list(
+        PhotoSignature.objects.filter(
+            event_id=signature.event_id,
+            photo__taken_at__range=capture_window(photo),
+            **same_camera_filter(photo, prefix='photo__'),
+        ).exclude(photo_id=photo.id).values_list('photo_id', 'phash', 'color_hist')
+    )
+    if not rows:
+        return {}
+
+    distances = hamming_distances(pack_hashes([signature.phash])[0], pack_hashes(row[1] for row in rows))
+    candidate_sims = {}
+    hist_rows = []
+    for (photo_id, _, hist), distance in zip(rows, distances.tolist()):
+        if distance <= PHASH_RADIUS:
+            candidate_sims[photo_id] = 1.0 - distance / HASH_BITS
+            hist_rows.append((photo_id, hist))
+    return match_histograms(signature, candidate_sims, hist_rows)
+
+
+def find_similar_photos(signature, photo=None):
+    """{photo id: combined similarity} of the photos of the event that duplicate this one."""
+    if photo is not None and photo.taken_at is not None:
+        return find_similar_in_window(signature, photo)
+
+    # Only photos within the hash radius come back from the index
+    photo_ids, distances = get_event_hash_index(signature.event_id).search(
+        pack_hashes([signature.phash])[0], PHASH_RADIUS
+    )
+    candidate_sims = {
+        photo_id: 1.0 - distance / HASH_BITS
+        for photo_id, distance in zip(photo_ids.tolist(), distances.tolist())
+        if photo_id != signature.photo_id
+    }
+    if not candidate_sims:
+        return {}
+
+    # Histograms are only loaded for the photos whose hash is close enough;
+    # photos with a capture time are matched within their own window instead
+    hist_rows = list(
+        PhotoSignature.objects.filter(
+            photo_id__in=candidate_sims, photo__taken_at__isnull=True
+        ).values_list('photo_id', 'color_hist')
+    )
+    return match_histograms(signature, candidate_sims, hist_rows)
+
+
+def add_photo_to_duplicate_groups(photo):
+    """
+    Insert one photo into the duplicate groups of its event.
+
+    The photo joins the group whose primary photo it duplicates best; if
+    it matches no primary, it starts a new group with the ungrouped photos
+    it duplicates. Returns the group, or None.
+    """
+    signature = get_photo_signature(photo)
+    # Retried on lock errors: on SQLite, where select_for_update does nothing,
+    # the insert that lost the race then re-reads the groups the other one wrote
+    return run_in_transaction(_insert_into_duplicate_groups, photo, signature)
+
+
+def _insert_into_duplicate_groups(photo, signature):
+    # Serialize inserts per event so concurrent uploads do not build overlapping groups
+    Event.objects.select_for_update().filter(id=photo.event_id).first()
+
+    if DuplicatePhoto.objects.filter(photo=photo).exists():
+        return None
+
+    similar = find_similar_photos(signature, photo)
+    if not similar:
+        return None
+
+    memberships = DuplicatePhoto.objects.filter(
+        photo_id__in=similar, group__event_id=photo.event_id
+    ).values_list('photo_id', 'group_id', 'is_primary')
+
+    grouped = set()
+    primaries = {}
+    for photo_id, group_id, is_primary in memberships:
+        grouped.add(photo_id)
+        if is_primary:
+            primaries[group_id] = similar[photo_id]
+
+    if primaries:
+        group_id = max(primaries, key=primaries.get)
+        DuplicatePhoto.objects.create(
+            group_id=group_id, photo=photo, is_primary=False, similarity_score=primaries[group_id]
+        )
+        return DuplicateGroup.objects.get(id=group_id)
+
+    ungrouped = {photo_id: sim for photo_id, sim in similar.items() if photo_id not in grouped}
+    if not ungrouped:
+        return None
+
+    group = DuplicateGroup.objects.create(event_id=photo.event_id, similarity_threshold=PHASH_THRESHOLD)
+    DuplicatePhoto.objects.bulk_create(
+        [DuplicatePhoto(group=group, photo=photo, is_primary=True, similarity_score=1.0)]
+        + [
+            DuplicatePhoto(group=group, photo_id=photo_id, is_primary=False, similarity_score=sim)
+            for photo_id, sim in ungrouped.items()
+        ]
+    )
+    return group
+
+
+class UnionFind:
+    """Disjoint sets over 0..n-1 with path halving and union by size."""
+
+    def __init__(self, size):
+        self.parent = list(range(size))
+        self.size = [1] * size
+
+    def find(self, item):
+        parent = self.parent
+        while parent[item] != item:
+            parent[item] = parent[parent[item]]
+            item = parent[item]
+        return item
+
+    def union(self, a, b):
+        a, b = self.find(a), self.find(b)
+        if a == b:
+            return
+        if self.size[a] < self.size[b]:
+            a, b = b, a
+        self.parent[b] = a
+        self.size[a] += self.size[b]
+
+    def groups(self):
+        """Sets with more than one member, as lists of items."""
+        members = {}
+        for item in range(len(self.parent)):
+            members.setdefault(self.find(item), []).append(item)
+        return [items for items in members.values() if len(items) > 1]
+
+
+def close_hash_pairs(words, cameras=None, times=None):
+    """
+    (i, j) index arrays of the candidate pairs within the hash radius.
+
+    Without capture times every pair is a candidate. Otherwise photos with
+    a time (not NaN) are only paired within their camera's time window, and
+    photos without one are paired with each other.
+    """
+    if times is None:
+        rows, cols, _ = pairs_within_radius(words, PHASH_RADIUS)
+        return rows, cols
+
+    timed = np.flatnonzero(~np.isnan(times))
+    untimed = np.flatnonzero(np.isnan(times))
+
+    rows, cols = window_pairs([cameras[index] for index in timed], times[timed], get_duplicate_window())
+    rows, cols = timed[rows], timed[cols]
+    close = np.zeros(len(rows), dtype=bool)
+    for start in range(0, len(rows), HISTOGRAM_BLOCK_SIZE):
+        block = slice(start, start + HISTOGRAM_BLOCK_SIZE)
+        distances = popcount64(words[rows[block]] ^ words[cols[block]]).sum(axis=1)
+        close[block] = distances <= PHASH_RADIUS
+    rows, cols = rows[close], cols[close]
+
+    if len(untimed) > 1:
+        untimed_rows, untimed_cols, _ = pairs_within_radius(words[untimed], PHASH_RADIUS)
+        rows = np.concatenate([rows, untimed[untimed_rows]])
+        cols = np.concatenate([cols, untimed[untimed_cols]])
+    return rows, cols
+
+
+def duplicate_pairs(words, histograms, cameras=None, times=None):
+    """(i, j) index arrays of every candidate pair of signatures that meets both thresholds."""
+    rows, cols = close_hash_pairs(words, cameras, times)
+
+    # Intersect histograms only for the pairs close in hash space, in bounded blocks
+    keep = np.zeros(len(rows), dtype=bool)
+    for start in range(0, len(rows), HISTOGRAM_BLOCK_SIZE):
+        block = slice(start, start + HISTOGRAM_BLOCK_SIZE)
+        intersections = np.minimum(histograms[rows[block]], histograms[cols[block]]).sum(axis=1)
+        keep[block] = intersections >= COLOR_THRESHOLD
+    return rows[keep], cols[keep]
+
+
+def cluster_signatures(words, histograms, ranks, cameras=None, times=None):
+    """
+    Duplicate groups over packed hashes and histograms of one event.
+
+    Candidate pairs are limited by camera and capture time when given (see
+    close_hash_pairs). Photos that duplicate each other are joined with union-find, so groups
+    are the connected components of the duplicate graph. The photo with
+    the highest rank (quality, then resolution) is the primary. Returns
+    lists of (index, similarity to primary), primary first.
+    """
+    rows, cols = duplicate_pairs(words, histograms, cameras, times)
+    sets = UnionFind(len(words))
+    for i, j in zip(rows.tolist(), cols.tolist()):
+        sets.union(i, j)
+
+    groups = []
+    for members in sets.groups():
+        members.sort(key=lambda index: ranks[index], reverse=True)
+        primary, others = members[0], np.array(members[1:])
+        phash_sims = 1.0 - hamming_distances(words[primary], words[others]) / HASH_BITS
+        color_sims = color_similarity(histograms[primary], histograms[others])
+        similarities = combined_similarity(phash_sims, color_sims)
+        groups.append([(primary, 1.0)] + list(zip(others.tolist(), similarities.tolist())))
+    return groups
+
+
+def rebuild_duplicate_groups(event_id):
+    """
+    Recompute every duplicate group of an event from the stored signatures.
+
+    All signatures are loaded into a hash and a histogram matrix and the
+    candidate pairs compared (see cluster_signatures); the groups are
+    then written in one transaction. Returns the number of groups.
+    """
+    ensure_event_signatures(event_id)
+
+    rows = list(
+        PhotoSignature.objects.filter(event_id=event_id)
+        .order_by('photo_id')
+        .values_list(
+            'photo_id', 'phash', 'color_hist', 'resolution', 'photo__quality_score',
+            'photo__taken_at', 'photo__camera_serial', 'photo__uploaded_by_id',
+        )
+    )
+
+    groups = []
+    if len(rows) > 1:
+        photo_ids = [row[0] for row in rows]
+        words = pack_hashes(row[1] for row in rows)
+        histograms = unpack_histograms([row[2] for row in rows])
+        ranks = [(row[4] or 0, row[3]) for row in rows]
+        times = np.array([row[5].timestamp() if row[5] else np.nan for row in rows], dtype=np.float64)
+        cameras = [camera_key(row[6], row[7]) for row in rows]
+        groups = [
+            [(photo_ids[index], similarity) for index, similarity in members]
+            for members in cluster_signatures(words, histograms, ranks, cameras, times)
+        ]
+
+    run_in_transaction(replace_duplicate_groups, event_id, groups)
+    logger.info(f"Rebuilt {len(groups)} duplicate groups for event {event_id} from {len(rows)} signatures")
+    return len(groups)
+
+
+def replace_duplicate_groups(event_id, groups):
+    """Replace every duplicate group of an event with lists of (photo id, similarity), primary first."""
+    # Incremental inserts into this event wait until the new groups are written
+    Event.objects.select_for_update().filter(id=event_id).first()
+    DuplicateGroup.objects.filter(event_id=event_id).delete()
+    created = DuplicateGroup.objects.bulk_create([
+        DuplicateGroup(event_id=event_id, similarity_threshold=PHASH_THRESHOLD) for _ in groups
+    ])
+    DuplicatePhoto.objects.bulk_create([
+        DuplicatePhoto(group=group, photo_id=photo_id, is_primary=(i == 0), similarity_score=similarity)
+        for group, members in zip(created, groups)
+        for i, (photo_id, similarity) in enumerate(members)
+    ], batch_size=1000)
+    # bulk_create sends no signals
+    invalidate_highlights_summary(event_id)
+
+
+def prune_duplicate_groups(event_id):
+    """Drop groups left with a single photo and re-elect missing primaries after deletions."""
+    run_in_transaction(_prune_duplicate_groups, event_id)
+
+
+def _prune_duplicate_groups(event_id):
+    Event.objects.select_for_update().filter(id=event_id).first()
+    for group in DuplicateGroup.objects.filter(event_id=event_id).prefetch_related('photos'):
+        members = list(group.photos.all())
+        if len(members) < 2:
+            group.delete()
+        elif not any(member.is_primary for member in members):
+            primary = max(members, key=lambda member: member.similarity_score)
+            DuplicatePhoto.objects.filter(id=primary.id).update(is_primary=True)
@@ -0,0 +1,202 @@
+# highlights/hamming.py
+"""
+Hamming-space index over the 256-bit photo hashes of an event.
+
+Hashes are packed into four uint64 words. Lookups use multi-index hashing:
+the hash is split into 16 substrings of 16 bits, each with its own sorted
+table. By the pigeonhole principle, any hash within distance r of the
+query matches it on at least one substring within r // 16 bits, so only
+the rows found by probing those few substring values are compared in
+full. This keeps near-duplicate lookup sub-linear for events with tens of
+thousands of photos.
+"""
+import itertools
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy as np # type: ignore
+
+from .models import PhotoSignature
+
+logger = logging.getLogger(__name__)
+
+HASH_BITS = 256
+WORDS = HASH_BITS // 64
+CHUNKS = 16
+CHUNK_BITS = HASH_BITS // CHUNKS
+
+# SWAR popcount constants
+_M1 = np.uint64(0x5555555555555555)
+_M2 = np.uint64(0x3333333333333333)
+_M4 = np.uint64(0x0F0F0F0F0F0F0F0F)
+_H01 = np.uint64(0x0101010101010101)
+
+# Events whose index each worker process keeps in memory
+MAX_CACHED_EVENTS = 64
+
+# Rows per side of the tiles all-pairs distances are computed in
+PAIR_TILE_SIZE = 1024
+
+
+def pack_hashes(hashes):
+    """(n, 4) uint64 words from packed hash bytes (32 bytes each)."""
+    return np.frombuffer(b''.join(bytes(h) for h in hashes), dtype=np.uint64).reshape(-1, WORDS)
+
+
+def popcount64(x):
+    """Set bits of every element of a uint64 array (the array is modified in place)."""
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(x)
+    # Bit-sliced count, a few vectorized integer ops instead of a table lookup per byte
+    x -= (x >> np.uint64(1)) & _M1
+    x[...] = (x & _M2) + ((x >> np.uint64(2)) & _M2)
+    x += x >> np.uint64(4)
+    x &= _M4
+    x *= _H01
+    x >>= np.uint64(56)
+    return x
+
+
+def hamming_distances(query, words):
+    """Hamming distance between one packed hash and each row of a (n, 4) matrix."""
+    return popcount64(words ^ query).sum(axis=1, dtype=np.int32)
+
+
+def pairs_within_radius(words, radius, tile_size=PAIR_TILE_SIZE):
+    """
+    All pairs (i < j) of packed hashes within `radius` bits, as (i, j, distance) arrays.
+
+    Distances are computed in tile_size x tile_size tiles of the upper
+    triangle, one 64-bit word at a time, so peak memory stays around
+    a few uint64 temporaries per tile cell (tens of MB) whatever the
+    number of hashes.
+    """
+    words = np.ascontiguousarray(words, dtype=np.uint64)
+    count = len(words)
+    found_i, found_j, found_distances = [], [], []
+
+    for row_start in range(0, count, tile_size):
+        rows = words[row_start:row_start + tile_size]
+        for col_start in range(row_start, count, tile_size):
+            cols = words[col_start:col_start + tile_size]
+
+            distances = np.zeros((len(rows), len(cols)), dtype=np.uint16)
+            for word in range(WORDS):
+                distances += popcount64(np.bitwise_xor.outer(rows[:, word], cols[:, word])).astype(np.uint16)
+
+            within = distances <= radius
+            if row_start == col_start:
+                # Upper triangle only: each pair once, no self pairs
+                within &= np.triu(np.ones_like(within), k=1)
+            i, j = np.nonzero(within)
+            found_i.append(i + row_start)
+            found_j.append(j + col_start)
+            found_distances.append(distances[i, j])
+
+    if not found_i:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, np.zeros(0, dtype=np.uint16)
+    return np.concatenate(found_i), np.concatenate(found_j), np.concatenate(found_distances)
+
+
+def _chunk_values(words):
+    """(n, 16) uint16 substrings of packed hashes."""
+    return np.ascontiguousarray(words).view(np.uint16).reshape(len(words), CHUNKS)
+
+
+def _flip_masks(bits):
+    """Every 16-bit mask with at most `bits` bits set."""
+    masks = [0]
+    for count in range(1, bits + 1):
+        for positions in itertools.combinations(range(CHUNK_BITS), count):
+            masks.append(sum(1 << position for position in positions))
+    return np.array(masks, dtype=np.uint16)
+
+
+class MultiIndexHashIndex:
+    """Hashes of one event with a sorted table per 16-bit substring."""
+
+    def __init__(self):
+        self.last_signature_id = 0
+        self._set_rows(np.zeros(0, dtype=np.int64), np.zeros((0, WORDS), dtype=np.uint64))
+
+    def __len__(self):
+        return len(self._tables[0])
+
+    def _set_rows(self, ids, words):
+        chunks = _chunk_values(words)
+        orders = np.ascontiguousarray(np.argsort(chunks, axis=0, kind='stable').T)
+        values = np.ascontiguousarray(np.take_along_axis(chunks, orders.T, axis=0).T)
+        # Replaced as a whole so that concurrent searches see a consistent index
+        self._tables = (ids, words, orders, values)
+
+    def add(self, ids, words, last_signature_id=None):
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(ids):
+            current_ids, current_words = self._tables[:2]
+            self._set_rows(np.concatenate([current_ids, ids]), np.vstack([current_words, words]))
+        if last_signature_id is not None:
+            self.last_signature_id = max(self.last_signature_id, last_signature_id)
+
+    def search(self, query, radius):
+        """(ids, distances) of the hashes within `radius` bits of a packed query."""
+        ids, words, orders, values = self._tables
+        if not len(ids):
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int32)
+
+        query = np.asarray(query, dtype=np.uint64).reshape(1, WORDS)
+        masks = _flip_masks(radius // CHUNKS)
+
+        rows = []
+        for chunk, value in enumerate(_chunk_values(query)[0]):
+            keys = np.unique(value ^ masks)
+            starts = np.searchsorted(values[chunk], keys, side='left')
+            ends = np.searchsorted(values[chunk], keys, side='right')
+            rows.extend(orders[chunk][start:end] for start, end in zip(starts, ends) if end > start)
+
+        if not rows:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int32)
+
+        candidates = np.unique(np.concatenate(rows))
+        distances = hamming_distances(query, words[candidates])
+        within = distances <= radius
+        return ids[candidates[within]], distances[within]
+
+
+_indexes = OrderedDict()
+_lock = threading.Lock()
+
+
+def get_event_hash_index(event_id):
+    """In-process index of an event, topped up with the signatures stored since it was last used."""
+    with _lock:
+        index = _indexes.pop(event_id, None)
+        if index is None:
+            index = MultiIndexHashIndex()
+        _indexes[event_id] = index
+        while len(_indexes) > MAX_CACHED_EVENTS:
+            _indexes.popitem(last=False)
+
+    rows = list(
+        PhotoSignature.objects.filter(event_id=event_id, id__gt=index.last_signature_id)
+        .order_by('id')
+        .values_list('id', 'photo_id', 'phash')
+    )
+    if rows:
+        with _lock:
+            # Another thread may have added the same rows in the meantime
+            rows = [row for row in rows if row[0] > index.last_signature_id]
+            if rows:
+                index.add(
+                    [photo_id for _, photo_id, _ in rows],
+                    pack_hashes(phash for _, _, phash in rows),
+                    last_signature_id=rows[-1][0],
+                )
+    return index
+
+
+def invalidate_event_hash_index(event_id):
+    """Forget the index of an event, e.g. after signatures were recomputed."""
+    with _lock:
+        _indexes.pop(event_id, None)
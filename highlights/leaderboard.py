@@ -0,0 +1,297 @@
+# highlights/leaderboard.py
+"""
+Best shots as a top-K leaderboard per (event, category).
+
+Analysis turns each photo into one score per category it qualifies for
+(PhotoHighlight). Those scores are collected in a Leaderboard and written
+in bulk when it is flushed: the merge locks the event row, reads the
+current entries of the event in one query and writes only the difference,
+so concurrent workers never exceed a category's limit. When a best shot
+scores lower than before, its categories are refilled from the stored
+scores of the event, so the next-best photo is promoted. Single photos
+analyzed on upload are only stored, as pending rows, and merged through the
+coalescing scheduler, so a burst of uploads is merged once per window.
+Flushes and merges are retried on lock errors instead of being dropped.
+`rerank_event_best_shots` recomputes every category of an event from one
+query over its analyzed photos.
+"""
+import heapq
+import logging
+from collections import defaultdict
+
+from django.db import transaction
+from django.utils import timezone
+
+from events.models import Event
+from photos.models import EventPhoto
+from photos.transactions import run_in_transaction
+from .models import BestShot, PhotoHighlight
+from .scheduling import schedule_event_job
+from .summary import invalidate_highlights_summary
+
+logger = logging.getLogger(__name__)
+
+# Good categories: higher score = better photo
+GOOD_CATEGORIES = {
+    'OVERALL': {'limit': 10, 'min_score': 75},
+    'PORTRAIT': {'limit': 5, 'min_score': 75},
+    'GROUP': {'limit': 5, 'min_score': 75},
+    'ACTION': {'limit': 5, 'min_score': 75},
+    'COMPOSITION': {'limit': 5, 'min_score': 80},
+    'LIGHTING': {'limit': 5, 'min_score': 80},
+}
+
+# Problem categories: the score is inverted, so higher = worse = shown first
+PROBLEM_CATEGORIES = {
+    'BLURRY': {
+        'limit': 10,
+        'portrait_threshold': 30,  # More permissive for portraits
+        'group_threshold': 35,     # Slightly more permissive for groups
+        'standard_threshold': 40   # Standard threshold for other shots
+    },
+    'UNDEREXPOSED': {'limit': 10},
+    'OVEREXPOSED': {'limit': 10},
+    'ACCIDENTAL': {'limit': 10},
+}
+
+CATEGORY_LIMITS = {
+    category: options['limit']
+    for category, options in {**GOOD_CATEGORIES, **PROBLEM_CATEGORIES}.items()
+}
+
+
+def category_scores(results):
+    """{category: score} for every best-shot category an analyzed photo qualifies for."""
+    scores = {}
+    no_problems = (
+        results['blur_score'] >= 50
+        and not results['is_underexposed']
+        and not results['is_overexposed']
+        and not results['is_accidental']
+    )
+
+    # Only add to OVERALL if it's actually a good photo (not blurry/exposure issues)
+    if results['quality_score'] > GOOD_CATEGORIES['OVERALL']['min_score'] and no_problems:
+        scores['OVERALL'] = results['quality_score']
+
+    for category in results['categories']:
+        if category not in GOOD_CATEGORIES:
+            continue
+        if category == 'COMPOSITION':
+            category_score = results['composition_score']
+        elif category == 'LIGHTING':
+            category_score = results['lighting_score']
+        else:
+            category_score = results['quality_score']
+
+        if (category_score > GOOD_CATEGORIES[category]['min_score']
+                and results['blur_score'] >= 50 and not results['is_accidental']):
+            scores[category] = category_score
+
+    # BLURRY photos - use different thresholds based on shot type
+    blurry = PROBLEM_CATEGORIES['BLURRY']
+    if results['shot_type'] == 'PORTRAIT':
+        blur_threshold = blurry['portrait_threshold']
+    elif results['shot_type'] == 'GROUP':
+        blur_threshold = blurry['group_threshold']
+    else:
+        blur_threshold = blurry['standard_threshold']
+
+    if results['blur_score'] < blur_threshold:
+        scores['BLURRY'] = 100 - results['blur_score']
+    if results['is_underexposed']:
+        scores['UNDEREXPOSED'] = 100 - results['exposure_score']
+    if results['is_overexposed']:
+        scores['OVEREXPOSED'] = 100 - results['exposure_score']
+    if results['is_accidental']:
+        scores['ACCIDENTAL'] = 100 - results['quality_score']
+
+    # Plain floats, as the scores are stored in a JSONField
+    return {category: float(score) for category, score in scores.items()}
+
+
+def top_k(boards):
+    """{(category, photo id): score} of the best entries of each category board."""
+    winners = {}
+    for category, board in boards.items():
+        limit = CATEGORY_LIMITS.get(category)
+        if not limit:
+            continue
+        for photo_id, score in heapq.nlargest(limit, board.items(), key=lambda item: item[1]):
+            winners[(category, photo_id)] = score
+    return winners
+
+
+class Leaderboard:
+    """
+    Scores of analyzed photos, buffered per event until flushed to the database in bulk.
+
+    With defer_merge the flush only stores the scores and schedules a
+    coalesced merge_best_shots job for each event.
+    """
+
+    def __init__(self, defer_merge=False):
+        self.defer_merge = defer_merge
+        self._photos = defaultdict(dict)
+
+    def __len__(self):
+        return sum(len(photos) for photos in self._photos.values())
+
+    def offer(self, event_id, photo_id, quality_score, scores):
+        """Record the quality and full set of category scores of a photo (categories it left are dropped)."""
+        self._photos[event_id][photo_id] = (quality_score, dict(scores))
+
+    def flush(self):
+        """Store the buffered analyses and merge them into BestShot, a few queries per event."""
+        for event_id, photos in self._photos.items():
+            run_in_transaction(flush_event_highlights, event_id, photos, merge=not self.defer_merge)
+        # Kept until every event is stored, so a failed flush can be retried
+        self._photos.clear()
+
+
+def flush_event_highlights(event_id, photos, merge=True):
+    """Store {photo id: (quality score, category scores)} of an event and merge or schedule the merge."""
+    if not merge:
+        store_photo_highlights(event_id, photos, merged=False)
+        transaction.on_commit(lambda: schedule_event_job('merge_best_shots', event_id), robust=True)
+        return
+
+    # Writers of the same event merge one after another, so no limit is exceeded
+    Event.objects.select_for_update().filter(id=event_id).first()
+    store_photo_highlights(event_id, photos)
+    _merge_best_shots(event_id, {photo_id: scores for photo_id, (_, scores) in photos.items()})
+
+
+def store_photo_highlights(event_id, photos, merged=True):
+    """Write {photo id: (quality score, category scores)} to the photos and their PhotoHighlight rows."""
+    # bulk_update does not send post_save, which would re-run ingestion
+    EventPhoto.objects.bulk_update(
+        [EventPhoto(id=photo_id, quality_score=quality_score, highlights=True)
+         for photo_id, (quality_score, _) in photos.items()],
+        ['quality_score', 'highlights'],
+    )
+    PhotoHighlight.objects.bulk_create(
+        [PhotoHighlight(photo_id=photo_id, event_id=event_id, quality_score=quality_score,
+                        category_scores=scores, merged=merged)
+         for photo_id, (quality_score, scores) in photos.items()],
+        update_conflicts=True,
+        unique_fields=['photo'],
+        update_fields=['quality_score', 'category_scores', 'merged', 'analyzed_at'],
+    )
+
+
+def merge_best_shots(event_id, photo_scores):
+    """Merge {photo id: {category: score}} into the best shots of an event."""
+    run_in_transaction(_locked_merge_best_shots, event_id, photo_scores)
+
+
+def _locked_merge_best_shots(event_id, photo_scores):
+    Event.objects.select_for_update().filter(id=event_id).first()
+    _merge_best_shots(event_id, photo_scores)
+
+
+def merge_pending_best_shots(event_id):
+    """Merge the photos stored since the last merge into the best shots of an event; returns how many."""
+    return run_in_transaction(_merge_pending_best_shots, event_id)
+
+
+def _merge_pending_best_shots(event_id):
+    Event.objects.select_for_update().filter(id=event_id).first()
+    pending = dict(
+        PhotoHighlight.objects.select_for_update().filter(event_id=event_id, merged=False).values_list(
+            'photo_id', 'category_scores'
+        )
+    )
+    if pending:
+        _merge_best_shots(event_id, pending)
+        # By id: photos stored after the read stay pending for the next merge
+        PhotoHighlight.objects.filter(photo_id__in=pending).update(merged=True)
+    return len(pending)
+
+
+def _merge_best_shots(event_id, photo_scores):
+    """Merge step of merge_best_shots; the caller holds the event lock."""
+    existing = {}
+    boards = defaultdict(dict)
+    for shot_id, category, photo_id, score in BestShot.objects.filter(event_id=event_id).values_list(
+        'id', 'category', 'photo_id', 'score'
+    ):
+        existing[(category, photo_id)] = (shot_id, score)
+        # Offered photos replace their previous entries
+        if photo_id not in photo_scores:
+            boards[category][photo_id] = score
+
+    for photo_id, scores in photo_scores.items():
+        for category, score in scores.items():
+            boards[category][photo_id] = score
+
+    # A best shot that scores lower or left its category may have to make
+    # room for a runner-up, which is only known from PhotoHighlight
+    dropped = {
+        category for (category, photo_id), (_, score) in existing.items()
+        if photo_id in photo_scores and photo_scores[photo_id].get(category, float('-inf')) < score
+    }
+    if dropped:
+        for photo_id, scores in PhotoHighlight.objects.filter(event_id=event_id).values_list(
+            'photo_id', 'category_scores'
+        ):
+            for category in dropped.intersection(scores or ()):
+                boards[category].setdefault(photo_id, scores[category])
+
+    _write_difference(event_id, existing, top_k(boards))
+
+
+def _write_difference(event_id, existing, winners):
+    """Delete, create and update BestShot rows so the event holds exactly `winners`."""
+    stale = [shot_id for key, (shot_id, _) in existing.items() if key not in winners]
+    if stale:
+        BestShot.objects.filter(id__in=stale).delete()
+
+    new = [
+        BestShot(event_id=event_id, photo_id=photo_id, category=category, score=score)
+        for (category, photo_id), score in winners.items()
+        if (category, photo_id) not in existing
+    ]
+    if new:
+        BestShot.objects.bulk_create(new)
+
+    now = timezone.now()
+    changed = [
+        BestShot(id=existing[key][0], score=score, updated_at=now)
+        for key, score in winners.items()
+        if key in existing and existing[key][1] != score
+    ]
+    if changed:
+        BestShot.objects.bulk_update(changed, ['score', 'updated_at'])
+
+    if new or changed:
+        # bulk_create and bulk_update send no signals
+        invalidate_highlights_summary(event_id)
+
+
+def rerank_event_best_shots(event_id):
+    """Recompute every best-shot category of an event from its analyzed photos."""
+    rows = EventPhoto.objects.filter(event_id=event_id, highlights=True).values_list(
+        'id', 'quality_score', 'highlight__category_scores'
+    )
+
+    boards = defaultdict(dict)
+    for photo_id, quality_score, scores in rows:
+        if scores is None:
+            # Analyzed before category scores were stored: rank by quality only
+            scores = {'OVERALL': quality_score} if quality_score is not None else {}
+        for category, score in scores.items():
+            boards[category][photo_id] = score
+    winners = top_k(boards)
+
+    with transaction.atomic():
+        Event.objects.select_for_update().filter(id=event_id).first()
+        existing = {
+            (category, photo_id): (shot_id, score)
+            for shot_id, category, photo_id, score in BestShot.objects.filter(event_id=event_id).values_list(
+                'id', 'category', 'photo_id', 'score'
+            )
+        }
+        _write_difference(event_id, existing, winners)
+
+    return len(winners)
@@ -0,0 +1,81 @@
+import time
+
+import numpy as np # type: ignore
+from django.core.management.base import BaseCommand
+
+from highlights.duplicates import HASH_BITS, PHASH_RADIUS, PHASH_THRESHOLD
+from highlights.hamming import MultiIndexHashIndex, pack_hashes
+
+
+def legacy_lookup(query_bits, stored_bits):
+    """Pairwise loop find_duplicate_photos used before the index, kept as reference."""
+    matches = []
+    for photo_id, bits in stored_bits.items():
+        similarity = 1.0 - np.sum(query_bits != bits) / len(query_bits)
+        if similarity >= PHASH_THRESHOLD:
+            matches.append(photo_id)
+    return matches
+
+
+class Command(BaseCommand):
+    help = 'Benchmark near-duplicate hash lookup: multi-index hashing against the pairwise loop'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--photos', type=int, nargs='+', default=[1000, 5000, 20000],
+                            help='Photos already in the event')
+        parser.add_argument('--queries', type=int, default=50, help='New photos looked up per size')
+        parser.add_argument('--burst-size', type=int, default=5, help='Near-identical shots per scene')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def make_hashes(self, rng, count, burst_size):
+        """Scenes of random hashes, each shot a few times with some bits flipped."""
+        scenes = rng.integers(0, 2, (count // burst_size + 1, HASH_BITS), dtype=np.uint8)
+        bits = np.repeat(scenes, burst_size, axis=0)[:count]
+        flips = rng.random(bits.shape) < rng.uniform(0, 0.06, (count, 1))
+        return bits ^ flips.astype(np.uint8)
+
+    def handle(self, *args, **options):
+        rng = np.random.default_rng(options['seed'])
+        self.stdout.write(f"radius {PHASH_RADIUS} bits, {options['queries']} lookups per size")
+        self.stdout.write(
+            f"{'photos':>7} {'build ms':>9} {'loop ms':>9} {'index ms':>9} {'speedup':>8} "
+            f"{'candidates':>11} {'agree':>6}"
+        )
+
+        for photo_count in options['photos']:
+            stored = self.make_hashes(rng, photo_count, options['burst_size'])
+            # New shots of scenes already in the event
+            queries = stored[rng.choice(photo_count, options['queries'])]
+            queries = queries ^ (rng.random(queries.shape) < 0.03).astype(np.uint8)
+            ids = np.arange(1, photo_count + 1)
+
+            start = time.perf_counter()
+            index = MultiIndexHashIndex()
+            index.add(ids, pack_hashes(np.packbits(row).tobytes() for row in stored))
+            build_ms = (time.perf_counter() - start) * 1000
+
+            # Python int arrays, as the legacy task kept them
+            stored_bits = {photo_id: row.astype(int) for photo_id, row in zip(ids.tolist(), stored)}
+
+            loop_seconds = index_seconds = 0.0
+            agree = 0
+            found = 0
+            for query in queries:
+                start = time.perf_counter()
+                expected = legacy_lookup(query.astype(int), stored_bits)
+                loop_seconds += time.perf_counter() - start
+
+                packed = pack_hashes([np.packbits(query).tobytes()])[0]
+                start = time.perf_counter()
+                result, _ = index.search(packed, PHASH_RADIUS)
+                index_seconds += time.perf_counter() - start
+
+                found += len(result)
+                agree += sorted(result.tolist()) == sorted(expected)
+
+            queries_count = len(queries)
+            self.stdout.write(
+                f"{photo_count:>7} {build_ms:>9.1f} {loop_seconds / queries_count * 1000:>9.2f} "
+                f"{index_seconds / queries_count * 1000:>9.3f} {loop_seconds / index_seconds:>7.0f}x "
+                f"{found / queries_count:>11.1f} {agree / queries_count:>6.0%}"
+            )
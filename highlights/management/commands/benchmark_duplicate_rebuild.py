@@ -0,0 +1,69 @@
+import time
+import tracemalloc
+
+import numpy as np # type: ignore
+from django.core.management.base import BaseCommand
+
+from highlights.duplicates import cluster_signatures
+from highlights.hamming import HASH_BITS, pack_hashes
+
+HISTOGRAM_BINS = 768
+
+
+class Command(BaseCommand):
+    help = 'Measure time and peak memory of the duplicate clustering used by full rebuilds'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--photos', type=int, nargs='+', default=[1000, 5000, 10000])
+        parser.add_argument('--burst-size', type=int, default=5, help='Near-identical shots per scene')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument(
+            '--cameras', type=int, default=0,
+            help='Give the shots capture times from this many cameras and compare only within time windows',
+        )
+
+    def make_signatures(self, rng, count, burst_size):
+        """Synthetic bursts: scenes shot a few times with small hash and colour changes."""
+        scene_count = count // burst_size + 1
+        scene_bits = rng.integers(0, 2, (scene_count, HASH_BITS), dtype=np.uint8)
+        scene_hists = rng.dirichlet(np.full(HISTOGRAM_BINS, 0.5), scene_count).astype(np.float32)
+
+        scene_of = np.repeat(np.arange(scene_count), burst_size)[:count]
+        bits = scene_bits[scene_of] ^ (rng.random((count, HASH_BITS)) < 0.03).astype(np.uint8)
+        histograms = scene_hists[scene_of] * rng.uniform(0.95, 1.05, (count, HISTOGRAM_BINS)).astype(np.float32)
+        histograms /= histograms.sum(axis=1, keepdims=True)
+
+        words = pack_hashes(np.packbits(row).tobytes() for row in bits)
+        return words, histograms, scene_of
+
+    def make_capture_times(self, rng, scene_of, cameras):
+        """Each scene shot by one camera, a scene every few seconds per camera, frames 0.3s apart."""
+        camera_of_scene = rng.integers(0, cameras, scene_of.max() + 1)
+        frame = np.arange(len(scene_of)) - np.searchsorted(scene_of, scene_of)
+        times = scene_of * 30.0 / cameras + frame * 0.3
+        return [f"camera:{camera_of_scene[scene]}" for scene in scene_of], times
+
+    def handle(self, *args, **options):
+        rng = np.random.default_rng(options['seed'])
+        self.stdout.write(f"{'photos':>7} {'seconds':>8} {'peak MB':>8} {'groups':>7} {'pure':>6}")
+
+        for photo_count in options['photos']:
+            words, histograms, scene_of = self.make_signatures(rng, photo_count, options['burst_size'])
+            ranks = rng.random(photo_count).tolist()
+            cameras, times = None, None
+            if options['cameras']:
+                cameras, times = self.make_capture_times(rng, scene_of, options['cameras'])
+
+            tracemalloc.start()
+            start = time.perf_counter()
+            groups = cluster_signatures(words, histograms, ranks, cameras, times)
+            elapsed = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            # Groups that only contain shots of a single scene
+            pure = sum(1 for members in groups if len({scene_of[index] for index, _ in members}) == 1)
+            self.stdout.write(
+                f"{photo_count:>7} {elapsed:>8.2f} {peak / 2 ** 20:>8.1f} {len(groups):>7} "
+                f"{pure / max(len(groups), 1):>6.0%}"
+            )
@@ -0,0 +1,39 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from photos.models import EventPhoto
+from highlights.tasks import rescore_event_highlights
+
+
+class Command(BaseCommand):
+    help = 'Re-score highlights from stored photo features (no image is read), e.g. after changing a threshold'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--event', type=int, help='Re-score only this event')
+        parser.add_argument(
+            '--measure-missing', action='store_true',
+            help='Measure photos without current features from their analysis proxy instead of skipping them',
+        )
+
+    def handle(self, *args, **options):
+        if options['event']:
+            event_ids = [options['event']]
+        else:
+            event_ids = list(EventPhoto.objects.values_list('event_id', flat=True).distinct().order_by('event_id'))
+
+        skipped = 0
+        for event_id in event_ids:
+            start = time.perf_counter()
+            counts = rescore_event_highlights(event_id, measure_missing=options['measure_missing'])
+            skipped += counts['skipped']
+            self.stdout.write(
+                f"Event {event_id}: re-scored {counts['rescored']} photos in {time.perf_counter() - start:.2f}s, "
+                f"skipped {counts['skipped']} without current features"
+            )
+
+        self.stdout.write(self.style.SUCCESS(f"Re-scored {len(event_ids)} events"))
+        if skipped:
+            self.stdout.write(self.style.WARNING(
+                f"{skipped} photos were skipped; run with --measure-missing to measure them"
+            ))
@@ -1,6 +1,6 @@
 # highlights/middleware.py
 from events.models import Event
-from .models import BestShot, DuplicateGroup
+from .summary import get_highlights_summary
 
 class HighlightsMiddleware:
     def __init__(self, get_response):
@@ -17,16 +17,17 @@ class HighlightsMiddleware:
             
             # Only process if event is an Event instance
             if isinstance(event, Event):
-                # Add highlights data to the context
-                best_shots = BestShot.objects.filter(event=event)
-                response.context_data['has_highlights'] = best_shots.exists()
-                response.context_data['has_duplicates'] = DuplicateGroup.objects.filter(event=event).exists()
-                response.context_data['duplicate_count'] = DuplicateGroup.objects.filter(event=event).count()
+                # Add highlights data to the context, from the cached summary (no queries when warm)
+                summary = get_highlights_summary(event.id)
+                category_counts = summary['category_counts']
+                response.context_data['has_highlights'] = bool(category_counts)
+                response.context_data['has_duplicates'] = summary['duplicate_count'] > 0
+                response.context_data['duplicate_count'] = summary['duplicate_count']
                 
                 # Add problem photo counts
-                response.context_data['blurry_count'] = best_shots.filter(category='BLURRY').count()
-                response.context_data['underexposed_count'] = best_shots.filter(category='UNDEREXPOSED').count()
-                response.context_data['overexposed_count'] = best_shots.filter(category='OVEREXPOSED').count()
-                response.context_data['accidental_count'] = best_shots.filter(category='ACCIDENTAL').count()
+                response.context_data['blurry_count'] = category_counts.get('BLURRY', 0)
+                response.context_data['underexposed_count'] = category_counts.get('UNDEREXPOSED', 0)
+                response.context_data['overexposed_count'] = category_counts.get('OVEREXPOSED', 0)
+                response.context_data['accidental_count'] = category_counts.get('ACCIDENTAL', 0)
                 
-        return response
\ No newline at end of file
+        return response
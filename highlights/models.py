@@ -58,4 +58,60 @@ class DuplicatePhoto(models.Model):
         ordering = ['-is_primary', '-similarity_score']
     
     def __str__(self):
-        return f"{self.photo.id} - {'Primary' if self.is_primary else 'Duplicate'} - {self.similarity_score}"
\ No newline at end of file
+        return f"{self.photo.id} - {'Primary' if self.is_primary else 'Duplicate'} - {self.similarity_score}"
+
+
+class PhotoSignature(models.Model):
+    """Duplicate-detection signature of a photo, computed once at ingest."""
+    photo = models.OneToOneField(EventPhoto, on_delete=models.CASCADE, related_name='signature')
+    event = models.ForeignKey(Event, on_delete=models.CASCADE, related_name='photo_signatures')
+    phash = models.BinaryField(help_text="16x16 average hash, bit-packed (32 bytes)")
+    color_hist = models.BinaryField(help_text="64x64 RGB histogram as float32, normalized to sum to 1")
+    resolution = models.BigIntegerField(default=0, help_text="Width x height of the original")
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Signature of photo {self.photo_id}"
+
+
+class PhotoHighlight(models.Model):
+    """Highlight analysis of a photo: the score it ranks with in each best-shot category."""
+    photo = models.OneToOneField(EventPhoto, on_delete=models.CASCADE, related_name='highlight')
+    event = models.ForeignKey(Event, on_delete=models.CASCADE, related_name='photo_highlights')
+    quality_score = models.FloatField()
+    category_scores = models.JSONField(default=dict, help_text="Best-shot category -> score")
+    merged = models.BooleanField(default=True, help_text="False until the scores are merged into BestShot")
+    analyzed_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Highlights of photo {self.photo_id} - {self.quality_score}"
+
+
+class HighlightProcessingStatus(models.Model):
+    """Progress of the latest batch highlight run of an event."""
+    class Status(models.TextChoices):
+        ANALYZING = 'ANALYZING', 'Analyzing photos'
+        FINALIZING = 'FINALIZING', 'Ranking best shots and grouping duplicates'
+        COMPLETED = 'COMPLETED', 'Completed'
+        FAILED = 'FAILED', 'Stopped without finishing'
+
+    event = models.OneToOneField(Event, on_delete=models.CASCADE, related_name='highlight_processing')
+    run_id = models.CharField(max_length=32, help_text="Identifies the run; chunks of older runs are ignored")
+    status = models.CharField(max_length=20, choices=Status.choices, default=Status.ANALYZING)
+    total_photos = models.PositiveIntegerField(default=0)
+    processed_photos = models.PositiveIntegerField(default=0)
+    total_chunks = models.PositiveIntegerField(default=0)
+    completed_chunks = models.PositiveIntegerField(default=0)
+    started_at = models.DateTimeField()
+    finished_at = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    @property
+    def progress(self):
+        """Percentage of the photos analyzed so far."""
+        if not self.total_photos:
+            return 100.0 if self.status == self.Status.COMPLETED else 0.0
+        return round(100.0 * self.processed_photos / self.total_photos, 1)
+
+    def __str__(self):
+        return f"Highlights of event {self.event_id} - {self.get_status_display()} ({self.progress}%)"
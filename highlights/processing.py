@@ -0,0 +1,128 @@
+# highlights/processing.py
+"""
+Chunked highlight analysis of a whole event.
+
+`start_highlight_processing` splits the photos of an event into chunks of
+HIGHLIGHT_CHUNK_SIZE and runs them as a Celery chord: each chunk analyzes
+its photos in one worker invocation and stores them in one transaction,
+and the chord callback re-ranks the best shots and rebuilds the duplicate
+groups once, after the last chunk. The run stays FINALIZING until both
+jobs have actually run. Progress is kept in the event's
+HighlightProcessingStatus row; every run has its own id, so chunks and
+callbacks of a superseded run leave the newer one alone. A run that made
+no progress for HIGHLIGHT_RUN_TIMEOUT seconds is recovered by
+recover_stale_runs(): a chunk that died keeps the chord from calling back,
+so a stuck analysis is finalized with the chunks that did finish, and a
+stuck finalization is marked FAILED.
+"""
+import logging
+import uuid
+from datetime import timedelta
+
+from celery import chord # type: ignore
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+
+from photos.models import EventPhoto
+from .models import HighlightProcessingStatus
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 50
+DEFAULT_RUN_TIMEOUT = 60 * 60
+
+Status = HighlightProcessingStatus.Status
+
+
+def get_chunk_size():
+    return getattr(settings, 'HIGHLIGHT_CHUNK_SIZE', DEFAULT_CHUNK_SIZE)
+
+
+def get_run_timeout():
+    return getattr(settings, 'HIGHLIGHT_RUN_TIMEOUT', DEFAULT_RUN_TIMEOUT)
+
+
+def start_highlight_processing(event_id, photo_ids=None, chunk_size=None):
+    """Analyze the photos of an event (all of them by default) in chunks; returns the run id."""
+    if photo_ids is None:
+        photo_ids = list(EventPhoto.objects.filter(event_id=event_id).order_by('id').values_list('id', flat=True))
+    chunk_size = chunk_size or get_chunk_size()
+    chunks = [photo_ids[offset:offset + chunk_size] for offset in range(0, len(photo_ids), chunk_size)]
+
+    run_id = uuid.uuid4().hex
+    HighlightProcessingStatus.objects.update_or_create(
+        event_id=event_id,
+        defaults={
+            'run_id': run_id,
+            'status': Status.ANALYZING,
+            'total_photos': len(photo_ids),
+            'processed_photos': 0,
+            'total_chunks': len(chunks),
+            'completed_chunks': 0,
+            'started_at': timezone.now(),
+            'finished_at': None,
+        }
+    )
+
+    from .tasks import analyze_highlight_chunk, finalize_highlight_processing
+
+    finalize = finalize_highlight_processing.si(event_id, run_id)
+    if chunks:
+        chord(analyze_highlight_chunk.si(event_id, run_id, chunk) for chunk in chunks)(finalize)
+    else:
+        finalize.delay()
+
+    logger.info(f"Started highlight run {run_id} for event {event_id}: {len(photo_ids)} photos in {len(chunks)} chunks")
+    return run_id
+
+
+def record_chunk_progress(event_id, run_id, photo_count):
+    """Count a finished chunk of a run; False if the run has been superseded."""
+    return HighlightProcessingStatus.objects.filter(
+        event_id=event_id, run_id=run_id, status=Status.ANALYZING
+    ).update(
+        processed_photos=F('processed_photos') + photo_count,
+        completed_chunks=F('completed_chunks') + 1,
+        updated_at=timezone.now(),
+    ) == 1
+
+
+def claim_finalization(event_id, run_id):
+    """Move a run to FINALIZING; True only for the one caller that did, so it finalizes once."""
+    return HighlightProcessingStatus.objects.filter(
+        event_id=event_id, run_id=run_id, status=Status.ANALYZING
+    ).update(status=Status.FINALIZING, updated_at=timezone.now()) == 1
+
+
+def complete_run(event_id, run_id):
+    now = timezone.now()
+    HighlightProcessingStatus.objects.filter(
+        event_id=event_id, run_id=run_id, status=Status.FINALIZING
+    ).update(status=Status.COMPLETED, finished_at=now, updated_at=now)
+
+
+def run_is_finalizing(event_id, run_id):
+    return HighlightProcessingStatus.objects.filter(
+        event_id=event_id, run_id=run_id, status=Status.FINALIZING
+    ).exists()
+
+
+def recover_stale_runs(timeout=None):
+    """Finalize analyses and fail finalizations that made no progress within the timeout."""
+    cutoff = timezone.now() - timedelta(seconds=get_run_timeout() if timeout is None else timeout)
+    stale = HighlightProcessingStatus.objects.filter(updated_at__lt=cutoff)
+
+    from .tasks import finalize_highlight_processing
+
+    recovered = 0
+    for event_id, run_id in stale.filter(status=Status.ANALYZING).values_list('event_id', 'run_id'):
+        logger.warning(f"Highlight run {run_id} of event {event_id} stalled while analyzing; finalizing it")
+        finalize_highlight_processing.delay(event_id, run_id)
+        recovered += 1
+
+    now = timezone.now()
+    failed = stale.filter(status=Status.FINALIZING).update(status=Status.FAILED, finished_at=now, updated_at=now)
+    if failed:
+        logger.warning(f"Marked {failed} stalled highlight runs as failed")
+    return recovered + failed
@@ -0,0 +1,130 @@
+# highlights/scheduling.py
+"""
+Debounced per-event maintenance jobs.
+
+`schedule_event_job(job, event_id)` collapses every request for the same
+(job, event) within EVENT_JOB_WINDOW seconds into one Celery execution:
+the first request sets a pending marker and enqueues run_event_job with a
+countdown, later ones only bump a coalesced counter. Executions hold a
+per-event lock, so two maintenance jobs never run on the same event at
+once. Markers, counters and locks live in the EVENT_JOB_CACHE cache alias,
+whose atomic add() works with Redis or the database cache backend.
+"""
+import logging
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+# Job name -> callable taking an event id
+JOBS = {
+    'rebuild_duplicates': 'highlights.duplicates.rebuild_duplicate_groups',
+    'cleanup_duplicates': 'highlights.duplicates.prune_duplicate_groups',
+    'best_shots': 'highlights.tasks.update_event_best_shots',
+    'merge_best_shots': 'highlights.tasks.merge_event_best_shots',
+}
+
+DEFAULT_WINDOW = 30
+DEFAULT_LOCK_TIMEOUT = 30 * 60
+
+# A pending marker outlives its window by this much, in case the queue is backed up;
+# if the task is lost the marker expires and the next request schedules a new run
+PENDING_GRACE = 10 * 60
+
+COUNTERS = ('requested', 'coalesced', 'executed')
+
+
+def get_job_cache():
+    return caches[getattr(settings, 'EVENT_JOB_CACHE', 'default')]
+
+
+def get_job_window():
+    return getattr(settings, 'EVENT_JOB_WINDOW', DEFAULT_WINDOW)
+
+
+def _key(job, event_id, name):
+    return f"event_job:{job}:{event_id}:{name}"
+
+
+def _lock_key(event_id):
+    return f"event_job:lock:{event_id}"
+
+
+def _incr(cache, key):
+    cache.add(key, 0, timeout=None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Evicted between add() and incr()
+        cache.add(key, 1, timeout=None)
+
+
+def schedule_event_job(job, event_id, window=None):
+    """
+    Request a run of `job` for an event; returns True if this request enqueued it.
+
+    Requests made while a run is already pending are coalesced into it.
+    """
+    if job not in JOBS:
+        raise ValueError(f"Unknown event job: {job}")
+
+    cache = get_job_cache()
+    window = get_job_window() if window is None else window
+    _incr(cache, _key(job, event_id, 'requested'))
+
+    if not cache.add(_key(job, event_id, 'pending'), time.time(), timeout=window + PENDING_GRACE):
+        _incr(cache, _key(job, event_id, 'coalesced'))
+        return False
+
+    from .tasks import run_event_job
+    run_event_job.apply_async((job, event_id), countdown=window)
+    return True
+
+
+def run_event_job_now(job, event_id):
+    """
+    Run a job under the event lock.
+
+    Returns False without running it when another job holds the lock.
+    """
+    cache = get_job_cache()
+    lock_key = _lock_key(event_id)
+    token = uuid.uuid4().hex
+    if not cache.add(lock_key, token, timeout=getattr(settings, 'EVENT_JOB_LOCK_TIMEOUT', DEFAULT_LOCK_TIMEOUT)):
+        return False
+
+    try:
+        # Clear the marker first: requests arriving during the run may not be
+        # covered by it and schedule the next run
+        cache.delete(_key(job, event_id, 'pending'))
+
+        start = time.perf_counter()
+        import_string(JOBS[job])(event_id)
+        _incr(cache, _key(job, event_id, 'executed'))
+        logger.info(f"Ran {job} for event {event_id} in {time.perf_counter() - start:.2f}s")
+    finally:
+        if cache.get(lock_key) == token:
+            cache.delete(lock_key)
+    return True
+
+
+def defer_event_job(job, event_id, window=None):
+    """Push a pending run back by one window, keeping its marker so requests keep coalescing."""
+    window = get_job_window() if window is None else window
+    get_job_cache().set(_key(job, event_id, 'pending'), time.time(), timeout=window + PENDING_GRACE)
+
+    from .tasks import run_event_job
+    run_event_job.apply_async((job, event_id), countdown=window)
+
+
+def event_job_stats(job, event_id):
+    """Requested, coalesced and executed counts of a job for an event, and whether a run is pending."""
+    cache = get_job_cache()
+    values = cache.get_many([_key(job, event_id, name) for name in COUNTERS + ('pending',)])
+    stats = {name: values.get(_key(job, event_id, name), 0) for name in COUNTERS}
+    stats['pending'] = _key(job, event_id, 'pending') in values
+    return stats
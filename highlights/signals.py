@@ -1,9 +1,11 @@
 # highlights/signals.py
 from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
-from events.models import Event
 from photos.models import EventPhoto
-from .tasks import process_new_photo, update_event_best_shots, find_duplicate_photos
+from .models import BestShot, DuplicateGroup
+from .scheduling import schedule_event_job
+from .summary import invalidate_highlights_summary
+from .tasks import process_new_photo
 
 @receiver(post_save, sender=EventPhoto)
 def photo_post_save(sender, instance, created, **kwargs):
@@ -15,5 +17,15 @@ def photo_post_save(sender, instance, created, **kwargs):
 def photo_post_delete(sender, instance, **kwargs):
     """Signal handler for when a photo is deleted."""
     if instance.event_id:
-        update_event_best_shots.delay(instance.event_id)
-        find_duplicate_photos.delay(instance.event_id)
+        # Deleting many photos at once collapses into one run of each job
+        schedule_event_job('best_shots', instance.event_id)
+        schedule_event_job('cleanup_duplicates', instance.event_id)
+
+
+@receiver(post_save, sender=BestShot)
+@receiver(post_delete, sender=BestShot)
+@receiver(post_save, sender=DuplicateGroup)
+@receiver(post_delete, sender=DuplicateGroup)
+def highlights_changed(sender, instance, **kwargs):
+    """Drop the cached highlights summary of the event (bulk writers invalidate it themselves)."""
+    invalidate_highlights_summary(instance.event_id)
@@ -0,0 +1,92 @@
+# highlights/summary.py
+"""
+Cached per-event highlights summary.
+
+HighlightsMiddleware adds best-shot category counts and the number of
+duplicate groups to every template response about an event. They are
+computed with two queries and kept in the HIGHLIGHTS_SUMMARY_CACHE cache
+alias under the event's current generation, a counter bumped whenever
+BestShot or DuplicateGroup rows of the event change. A summary computed
+from data read before a change is therefore stored under a generation
+nobody reads any more, instead of replacing the fresh one. A warm page
+costs two cache reads. The generation is the summary's version, which
+keys the cached fragments of the highlights page.
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import Count
+
+from .models import BestShot, DuplicateGroup
+
+DEFAULT_TIMEOUT = 60 * 60
+
+
+def get_summary_cache():
+    return caches[getattr(settings, 'HIGHLIGHTS_SUMMARY_CACHE', 'default')]
+
+
+def get_summary_timeout():
+    return getattr(settings, 'HIGHLIGHTS_SUMMARY_TIMEOUT', DEFAULT_TIMEOUT)
+
+
+def generation_key(event_id):
+    return f"highlights_summary:{event_id}:generation"
+
+
+def summary_key(event_id, generation):
+    return f"highlights_summary:{event_id}:{generation}"
+
+
+def get_generation(event_id):
+    """Current generation of an event's summary, started when it is first read."""
+    cache = get_summary_cache()
+    generation = cache.get(generation_key(event_id))
+    if generation is None:
+        # A clock start, so a counter that was evicted never reuses an old generation's keys
+        cache.add(generation_key(event_id), time.time_ns(), timeout=None)
+        generation = cache.get(generation_key(event_id))
+    return generation
+
+
+def build_highlights_summary(event_id, generation=None):
+    """Best-shot counts per category and duplicate-group count of an event, from the database."""
+    category_counts = dict(
+        BestShot.objects.filter(event_id=event_id).order_by().values_list('category').annotate(count=Count('id'))
+    )
+    return {
+        'category_counts': category_counts,
+        'duplicate_count': DuplicateGroup.objects.filter(event_id=event_id).count(),
+        # Bumped by every change, so it also versions the cached highlights fragments
+        'version': generation,
+    }
+
+
+def get_highlights_summary(event_id):
+    """The summary of an event: one cache read, computed and cached on a miss."""
+    cache = get_summary_cache()
+    # Read before the database: a change committed after this read bumps the
+    # generation, so a summary built from older rows lands under a dead key
+    generation = get_generation(event_id)
+    summary = cache.get(summary_key(event_id, generation))
+    if summary is None:
+        summary = build_highlights_summary(event_id, generation)
+        cache.add(summary_key(event_id, generation), summary, timeout=get_summary_timeout())
+    return summary
+
+
+def drop_highlights_summary(event_id):
+    """Move an event to a new generation, leaving its cached summary and fragments behind."""
+    cache = get_summary_cache()
+    try:
+        cache.incr(generation_key(event_id))
+    except ValueError:
+        # Never read, or evicted: the next read starts a new generation
+        cache.add(generation_key(event_id), time.time_ns(), timeout=None)
+
+
+def invalidate_highlights_summary(event_id):
+    """Bump the summary generation of an event once the current transaction commits."""
+    transaction.on_commit(lambda: drop_highlights_summary(event_id))
@@ -1,16 +1,16 @@
 # highlights/tasks.py
-import io
-import numpy as np
 from celery import shared_task
-from PIL import Image, ImageChops, ImageStat
-from django.conf import settings
-from django.db import transaction
-from django.db.models.signals import post_save
-from django.dispatch import receiver
+from celery.exceptions import Retry
 
-from events.models import Event
 from photos.models import EventPhoto
-from .models import BestShot, DuplicateGroup, DuplicatePhoto
+from photos.transactions import run_in_transaction
+from .duplicates import add_photo_to_duplicate_groups, prune_duplicate_groups, rebuild_duplicate_groups
+from .leaderboard import Leaderboard, category_scores, merge_pending_best_shots, rerank_event_best_shots
+from .processing import (
+    claim_finalization, complete_run, record_chunk_progress, recover_stale_runs, run_is_finalizing,
+    start_highlight_processing,
+)
+from .scheduling import defer_event_job, get_job_window, run_event_job_now
 
 import logging
 logger = logging.getLogger(__name__)
@@ -19,7 +19,7 @@ logger = logging.getLogger(__name__)
 # ----- Best Shots Tasks -----
 @shared_task
 def analyze_photo_quality(photo_id):
-    """Analyze a single photo for quality metrics using advanced analysis."""
+    """Analyze a single photo for quality metrics and rank it in the best shots of its event."""
     try:
         photo = EventPhoto.objects.get(id=photo_id)
         
@@ -27,348 +27,201 @@ def analyze_photo_quality(photo_id):
         if photo.highlights and photo.quality_score is not None:
             return
         
-        # Import here to avoid circular imports
-        from .analysis import analyze_photo_advanced
+        # Stored now, merged into the best shots once per scheduling window
+        leaderboard = Leaderboard(defer_merge=True)
+        quality_score = record_photo_highlight(photo, leaderboard)
+        leaderboard.flush()
+        return quality_score
         
-        # Perform advanced analysis
-        results = analyze_photo_advanced(photo)
-        
-        # Save the quality score to the photo
-        photo.quality_score = results['quality_score']
-        photo.highlights = True
-        photo.save(update_fields=['quality_score', 'highlights'])
-        
-        # Create or update best shots by category
-        event = photo.event
-        
-        # Define thresholds for good categories
-        good_categories = {
-            'OVERALL': {'limit': 10, 'min_score': 75},
-            'PORTRAIT': {'limit': 5, 'min_score': 75},
-            'GROUP': {'limit': 5, 'min_score': 75},
-            'ACTION': {'limit': 5, 'min_score': 75},
-            'COMPOSITION': {'limit': 5, 'min_score': 80},
-            'LIGHTING': {'limit': 5, 'min_score': 80},
-        }
-        
-        # Define thresholds for problem categories with shot-type awareness
-        problem_categories = {
-            'BLURRY': {
-                'limit': 10, 
-                'portrait_threshold': 30,  # More permissive for portraits
-                'group_threshold': 35,     # Slightly more permissive for groups
-                'standard_threshold': 40   # Standard threshold for other shots
-            },
-            'UNDEREXPOSED': {'limit': 10, 'threshold': True},  # Boolean value
-            'OVEREXPOSED': {'limit': 10, 'threshold': True},  # Boolean value
-            'ACCIDENTAL': {'limit': 10, 'threshold': True},  # Boolean value
-        }
-        
-        # Only add to OVERALL if it's actually a good photo (not blurry/exposure issues)
-        if (results['quality_score'] > good_categories['OVERALL']['min_score'] and 
-            results['blur_score'] >= 50 and
-            not results['is_underexposed'] and 
-            not results['is_overexposed'] and
-            not results['is_accidental']):
-            update_category_best_shot(event, photo, results['quality_score'], 'OVERALL', 
-                                     good_categories['OVERALL']['limit'])
-        
-        # Add to specific good categories based on analysis results
-        for category in results['categories']:
-            if category in good_categories:
-                # Get category-specific score
-                if category == 'COMPOSITION':
-                    category_score = results['composition_score']
-                elif category == 'LIGHTING':
-                    category_score = results['lighting_score']
-                else:
-                    category_score = results['quality_score']
-                
-                # Only add to good categories if score meets minimum and no major issues
-                if (category_score > good_categories[category]['min_score'] and
-                    results['blur_score'] >= 50 and  # Not too blurry
-                    not results['is_accidental']):
-                    update_category_best_shot(event, photo, category_score, category, 
-                                            good_categories[category]['limit'])
-        
-        # Handle problem categories separately with shot-type awareness
-        # BLURRY photos - use different thresholds based on shot type
-        shot_type = results['shot_type']
-        
-        # Determine blur threshold based on shot type
-        if shot_type == 'PORTRAIT':
-            blur_threshold = problem_categories['BLURRY']['portrait_threshold']
-        elif shot_type == 'GROUP':
-            blur_threshold = problem_categories['BLURRY']['group_threshold']
-        else:
-            blur_threshold = problem_categories['BLURRY']['standard_threshold']
-            
-        if results['blur_score'] < blur_threshold:
-            # For problem categories, lower score = worse = higher priority to show
-            inverted_score = 100 - results['blur_score']
-            update_problem_shot(event, photo, inverted_score, 'BLURRY', 
-                               problem_categories['BLURRY']['limit'])
-        
-        # UNDEREXPOSED photos
-        if results['is_underexposed']:
-            inverted_score = 100 - results['exposure_score']
-            update_problem_shot(event, photo, inverted_score, 'UNDEREXPOSED', 
-                               problem_categories['UNDEREXPOSED']['limit'])
-        
-        # OVEREXPOSED photos
-        if results['is_overexposed']:
-            inverted_score = 100 - results['exposure_score']
-            update_problem_shot(event, photo, inverted_score, 'OVEREXPOSED', 
-                               problem_categories['OVEREXPOSED']['limit'])
-        
-        # ACCIDENTAL photos
-        if results['is_accidental']:
-            inverted_score = 100 - results['quality_score']
-            update_problem_shot(event, photo, inverted_score, 'ACCIDENTAL', 
-                               problem_categories['ACCIDENTAL']['limit'])
+    except Exception as e:
+        logger.error(f"Error analyzing photo {photo_id}: {str(e)}")
+        return None
+
+
+def record_photo_highlight(photo, leaderboard):
+    """Analyze a photo and offer its scores to a leaderboard, which stores them when flushed."""
+    # Import here to avoid circular imports
+    from .analysis import analyze_photo_advanced
+    
+    results = analyze_photo_advanced(photo)
+    leaderboard.offer(photo.event_id, photo.id, results['quality_score'], category_scores(results))
+    return results['quality_score']
+
+
+@shared_task
+def analyze_highlight_chunk(event_id, run_id, photo_ids):
+    """Analyze one chunk of a highlight run and store it, with the run's progress, in one transaction."""
+    leaderboard = Leaderboard()
+    try:
+        photos = EventPhoto.objects.filter(id__in=photo_ids, event_id=event_id).exclude(
+            highlights=True, quality_score__isnull=False
+        ).select_related('features')
         
-        # Check for duplicates after processing
-        find_duplicate_photos.delay(photo.event.id)
+        for photo in photos:
+            try:
+                record_photo_highlight(photo, leaderboard)
+            except Exception as e:
+                logger.error(f"Error analyzing photo {photo.id}: {str(e)}")
         
-        return results['quality_score']
+        analyzed = len(leaderboard)
+        run_in_transaction(store_highlight_chunk, leaderboard, event_id, run_id, len(photo_ids))
+        return analyzed
         
     except Exception as e:
-        logger.error(f"Error analyzing photo {photo_id}: {str(e)}")
-        return None
+        # Never fail the chunk, or the chord would never finalize the run
+        logger.error(f"Error analyzing highlight chunk of event {event_id}: {str(e)}")
+        return 0
+
+
+def store_highlight_chunk(leaderboard, event_id, run_id, photo_count):
+    """Flush a chunk's scores together with the run's progress."""
+    # Progress first: the flush clears the leaderboard only once it succeeded,
+    # so a retried transaction stores the same scores again
+    record_chunk_progress(event_id, run_id, photo_count)
+    leaderboard.flush()
+
+
+FINALIZE_JOBS = ('best_shots', 'rebuild_duplicates')
 
 
-def update_problem_shot(event, photo, inverted_score, category, limit):
-    """Helper function to update problem shots for a category.
-    For problem shots, higher inverted_score means worse quality (more problematic)."""
+@shared_task(bind=True, max_retries=None)
+def finalize_highlight_processing(self, event_id, run_id, jobs=FINALIZE_JOBS):
+    """Chord callback of a highlight run: re-rank best shots and rebuild duplicate groups once."""
     try:
-        with transaction.atomic():
-            existing_count = BestShot.objects.filter(event=event, category=category).count()
-            
-            if existing_count < limit:
-                # Always add if we have fewer than the limit
-                BestShot.objects.create(
-                    event=event,
-                    photo=photo,
-                    score=inverted_score,  # For problem categories, higher score = worse quality
-                    category=category
-                )
-            else:
-                # For problem shots, we want the WORST ones (highest inverted score)
-                lowest_shot = BestShot.objects.filter(
-                    event=event, category=category
-                ).order_by('score').first()
-                
-                if lowest_shot and inverted_score > lowest_shot.score:
-                    lowest_shot.photo = photo
-                    lowest_shot.score = inverted_score
-                    lowest_shot.save()
+        if self.request.retries:
+            if not run_is_finalizing(event_id, run_id):
+                # Superseded, or given up on as stale
+                return
+        elif not claim_finalization(event_id, run_id):
+            # Already finalized, or superseded by a newer run
+            return
+        
+        pending = [job for job in jobs if not run_event_job_now(job, event_id)]
+        if pending:
+            # Another job holds the event lock: the run stays FINALIZING and
+            # the jobs that did not run are tried again after one window
+            raise self.retry(args=(event_id, run_id, pending), countdown=get_job_window())
+        
+        complete_run(event_id, run_id)
+        logger.info(f"Finished highlight run {run_id} for event {event_id}")
+    except Retry:
+        raise
     except Exception as e:
-        logger.error(f"Error updating problem shot for category {category}: {str(e)}")
+        logger.error(f"Error finalizing highlight run {run_id} for event {event_id}: {str(e)}")
 
 
-def update_category_best_shot(event, photo, score, category, limit):
-    """Helper function to update best shots for a category."""
+@shared_task
+def recover_stale_highlight_runs():
+    """Periodic sweep of highlight runs that stopped making progress."""
     try:
-        with transaction.atomic():
-            existing_count = BestShot.objects.filter(event=event, category=category).count()
-            
-            if existing_count < limit:
-                # Always add if we have fewer than the limit
-                BestShot.objects.create(
-                    event=event,
-                    photo=photo,
-                    score=score,
-                    category=category
-                )
-            else:
-                # Otherwise, replace the lowest-scoring shot if this one is better
-                lowest_shot = BestShot.objects.filter(
-                    event=event, category=category
-                ).order_by('score').first()
-                
-                if lowest_shot and score > lowest_shot.score:
-                    lowest_shot.photo = photo
-                    lowest_shot.score = score
-                    lowest_shot.save()
+        return recover_stale_runs()
     except Exception as e:
-        logger.error(f"Error updating best shot for category {category}: {str(e)}")
+        logger.error(f"Error recovering stale highlight runs: {str(e)}")
+        return 0
 
 
 @shared_task
+def rescore_event_highlights(event_id, measure_missing=False):
+    """
+    Score every photo of an event again from its stored features, without reading any image.
+
+    Photos without current features are skipped and counted, or measured
+    from their analysis proxy with measure_missing. Returns the
+    {'rescored', 'skipped'} counts.
+    """
+    from photos.features import FEATURES_VERSION, features_from_record, get_photo_features
+    from .analysis import score_photo
+    
+    leaderboard = Leaderboard()
+    photos = EventPhoto.objects.filter(
+        event_id=event_id, features__version=FEATURES_VERSION
+    ).select_related('features')
+    
+    for photo in photos:
+        results = score_photo(photo, features_from_record(photo.features))
+        leaderboard.offer(event_id, photo.id, results['quality_score'], category_scores(results))
+    
+    outdated = EventPhoto.objects.filter(event_id=event_id).exclude(features__version=FEATURES_VERSION)
+    skipped = 0
+    if measure_missing:
+        for photo in outdated.select_related('features'):
+            try:
+                results = score_photo(photo, get_photo_features(photo))
+                leaderboard.offer(event_id, photo.id, results['quality_score'], category_scores(results))
+            except Exception as e:
+                logger.error(f"Error measuring features of photo {photo.id}: {str(e)}")
+                skipped += 1
+    else:
+        skipped = outdated.count()
+    
+    rescored = len(leaderboard)
+    leaderboard.flush()
+    logger.info(f"Re-scored {rescored} photos of event {event_id}, skipped {skipped} without current features")
+    return {'rescored': rescored, 'skipped': skipped}
+
+
 def update_event_best_shots(event_id):
-    """Update the best shots for an event."""
+    """Re-rank every best-shot category of an event from its analyzed photos."""
     try:
-        event = Event.objects.get(id=event_id)
-        photos = EventPhoto.objects.filter(event=event, highlights=True).exclude(quality_score=None)
-        
-        if not photos.exists():
-            return
-        
-        with transaction.atomic():
-            # Get best overall quality photos (top 5)
-            best_overall = photos.order_by('-quality_score')[:5]
-            
-            # Clear existing best shots for this event and category
-            BestShot.objects.filter(event=event, category='OVERALL').delete()
-            
-            # Create new best shot entries
-            for photo in best_overall:
-                BestShot.objects.create(
-                    event=event,
-                    photo=photo,
-                    score=photo.quality_score,
-                    category='OVERALL'
-                )
-            
+        rerank_event_best_shots(event_id)
     except Exception as e:
         logger.error(f"Error updating best shots for event {event_id}: {str(e)}")
 
 
+def merge_event_best_shots(event_id):
+    """Merge the photos analyzed on upload into the best shots of an event."""
+    try:
+        merge_pending_best_shots(event_id)
+    except Exception as e:
+        logger.error(f"Error merging best shots for event {event_id}: {str(e)}")
+
+
 # ----- Duplicate Detection Tasks -----
+@shared_task
+def detect_photo_duplicates(photo_id):
+    """Insert a newly ingested photo into the duplicate groups of its event."""
+    try:
+        photo = EventPhoto.objects.get(id=photo_id)
+        group = add_photo_to_duplicate_groups(photo)
+        return group.id if group else None
+    except EventPhoto.DoesNotExist:
+        return None
+    except Exception as e:
+        logger.error(f"Error detecting duplicates of photo {photo_id}: {str(e)}")
+        return None
+
+
 @shared_task
 def find_duplicate_photos(event_id):
-    """Find duplicate photos for an event using improved detection."""
+    """Rebuild all duplicate groups of an event from the stored photo signatures."""
     try:
-        event = Event.objects.get(id=event_id)
-        photos = EventPhoto.objects.filter(event=event)
-        
-        if photos.count() < 2:
-            return
-        
-        # Dictionary to store multiple signatures for better comparison
-        photo_signatures = {}
-        
-        # Calculate signatures for all photos
-        for photo in photos:
-            try:
-                # Calculate both perceptual hash and color histogram for better comparison
-                img = Image.open(photo.image.path)
-                
-                # 1. Perceptual hash (sensitive to structure)
-                img_small = img.resize((16, 16), Image.Resampling.LANCZOS).convert('L')
-                pixels = np.array(img_small).flatten()
-                phash = (pixels > np.mean(pixels)).astype(int)
-                
-                # 2. Color histogram (sensitive to color distribution)
-                img_rgb = img.resize((64, 64), Image.Resampling.LANCZOS).convert('RGB')
-                r, g, b = img_rgb.split()
-                hist_r = np.array(r.histogram()) / 256.0
-                hist_g = np.array(g.histogram()) / 256.0
-                hist_b = np.array(b.histogram()) / 256.0
-                
-                # Store both signatures
-                photo_signatures[photo.id] = {
-                    'phash': phash,
-                    'color_hist': np.concatenate([hist_r, hist_g, hist_b]),
-                    'quality_score': photo.quality_score or 0,
-                    'file_size': photo.image.size,
-                    'resolution': img.size[0] * img.size[1],
-                    'photo_obj': photo  # Store the photo object for convenience
-                }
-            except Exception as e:
-                logger.error(f"Error processing photo {photo.id}: {str(e)}")
-        
-        # Clear existing duplicate groups
-        with transaction.atomic():
-            old_groups = DuplicateGroup.objects.filter(event=event)
-            if old_groups.exists():
-                old_groups.delete()
-        
-        # Find groups with improved detection
-        processed = set()
-        duplicate_groups = []
-        
-        # Set more strict thresholds to avoid false positives
-        phash_threshold = 0.92  # Increased from 0.85 to 0.92 (92% similarity required)
-        color_threshold = 0.88  # Increased from 0.80 to 0.88 (88% similarity required)
-        
-        # Function to calculate structural similarity using hamming distance
-        def calculate_phash_similarity(hash1, hash2):
-            # Use hamming distance (count of differing bits)
-            hamming_distance = np.sum(hash1 != hash2)
-            # Convert to similarity score (0-1)
-            max_distance = len(hash1)
-            similarity = 1.0 - (hamming_distance / max_distance)
-            return similarity
-        
-        # Function to calculate color histogram similarity
-        def calculate_color_similarity(hist1, hist2):
-            # Use histogram intersection metric
-            intersection = np.sum(np.minimum(hist1, hist2))
-            return intersection
-        
-        for photo_id, signatures in photo_signatures.items():
-            if photo_id in processed:
-                continue
-                
-            # Start a new group with this photo
-            current_group = [(photo_id, 1.0, signatures)]  # Add original with perfect similarity
-            processed.add(photo_id)
-            
-            # Compare with all other unprocessed photos
-            for other_id, other_signatures in photo_signatures.items():
-                if photo_id == other_id or other_id in processed:
-                    continue
-                    
-                # Calculate structural similarity (perceptual hash)
-                phash_sim = calculate_phash_similarity(signatures['phash'], other_signatures['phash'])
-                
-                # Calculate color similarity (using histogram intersection)
-                color_sim = calculate_color_similarity(signatures['color_hist'], other_signatures['color_hist'])
-                
-                # Calculate time difference if available
-                time_factor = 1.0  # Default - no time adjustment
-                if hasattr(signatures['photo_obj'], 'taken_at') and hasattr(other_signatures['photo_obj'], 'taken_at'):
-                    if signatures['photo_obj'].taken_at and other_signatures['photo_obj'].taken_at:
-                        # Photos taken far apart in time are less likely to be duplicates
-                        time_diff = abs((signatures['photo_obj'].taken_at - other_signatures['photo_obj'].taken_at).total_seconds())
-                        if time_diff > 300:  # More than 5 minutes apart
-                            time_factor = 0.7  # Reduce similarity score
-                
-                # Combined similarity score (weighted average)
-                combined_sim = (phash_sim * 0.6) + (color_sim * 0.4)
-                combined_sim *= time_factor  # Apply time factor adjustment
-                
-                # Photos must meet BOTH thresholds to be considered duplicates
-                if phash_sim >= phash_threshold and color_sim >= color_threshold:
-                    current_group.append((other_id, combined_sim, other_signatures))
-                    processed.add(other_id)
-            
-            # Only create a group if we found actual duplicates
-            if len(current_group) > 1:
-                # Sort by combined quality metrics (similarity, quality score, resolution)
-                current_group.sort(key=lambda x: (
-                    x[1],  # Similarity
-                    x[2]['quality_score'],  # Quality score
-                    x[2]['resolution']  # Resolution
-                ), reverse=True)
-                
-                duplicate_groups.append(current_group)
-        
-        # Save the duplicate groups
-        with transaction.atomic():
-            for group_photos in duplicate_groups:
-                dup_group = DuplicateGroup.objects.create(
-                    event=event,
-                    similarity_threshold=phash_threshold
-                )
-                
-                # Add photos to the group
-                for i, (photo_id, similarity, signatures) in enumerate(group_photos):
-                    DuplicatePhoto.objects.create(
-                        group=dup_group,
-                        photo=signatures['photo_obj'],
-                        is_primary=(i == 0),  # First photo is primary
-                        similarity_score=similarity
-                    )
-        
-        return len(duplicate_groups)
-        
+        return rebuild_duplicate_groups(event_id)
     except Exception as e:
         logger.error(f"Error finding duplicates for event {event_id}: {str(e)}")
         return None
 
 
+@shared_task
+def cleanup_duplicate_groups(event_id):
+    """Fix up the duplicate groups of an event after photos were deleted."""
+    try:
+        prune_duplicate_groups(event_id)
+    except Exception as e:
+        logger.error(f"Error cleaning up duplicate groups for event {event_id}: {str(e)}")
+
+
+# ----- Scheduled Maintenance -----
+@shared_task
+def run_event_job(job, event_id):
+    """Coalesced run of a per-event maintenance job (see highlights.scheduling)."""
+    try:
+        if not run_event_job_now(job, event_id):
+            # Another job is running on this event; try again after one window
+            defer_event_job(job, event_id)
+    except Exception as e:
+        logger.error(f"Error running {job} for event {event_id}: {str(e)}")
+
+
 # ----- Signal Handlers -----
 
 @shared_task
@@ -376,73 +229,24 @@ def process_new_photo(photo_id):
     """Process a newly uploaded or modified photo."""
     # First analyze quality
     analyze_photo_quality(photo_id)
-    
-    # Then check for duplicates
-    photo = EventPhoto.objects.get(id=photo_id)
-    find_duplicate_photos(photo.event.id)
 
+    # Then insert it into the existing duplicate groups of its event
+    detect_photo_duplicates(photo_id)
 
-import logging
-from django.db import transaction
-from functools import lru_cache
-
-logger = logging.getLogger(__name__)
-
-# Using LRU cache to avoid re-computing signatures for photos
-@lru_cache(maxsize=128)
-def calculate_photo_signature(photo_path):
-    """Calculate a perceptual hash for an image."""
-    try:
-        img = Image.open(photo_path).resize((16, 16), Image.Resampling.LANCZOS).convert('L')
-        pixels = np.array(img).flatten()
-        # Normalize
-        return (pixels > np.mean(pixels)).astype(int)
-    except Exception as e:
-        logger.error(f"Error calculating signature for {photo_path}: {str(e)}")
-        return None
 
 @shared_task
-def process_photos_in_batches(event_id, batch_size=50):
-    """Process photos in batches for large events."""
+def process_photos_in_batches(event_id, batch_size=None):
+    """Analyze all photos of an event in chunks of `batch_size` (see highlights.processing)."""
     try:
-        event = Event.objects.get(id=event_id)
-        all_photos = EventPhoto.objects.filter(event=event).order_by('id')
-        total_photos = all_photos.count()
-        
-        if total_photos == 0:
-            return
-        
-        # Process in batches
-        for offset in range(0, total_photos, batch_size):
-            batch = all_photos[offset:offset+batch_size]
-            for photo in batch:
-                analyze_photo_quality.delay(photo.id)
-                
-        # After all batches are processed, find duplicates
-        find_duplicate_photos.delay(event_id)
-            
+        return start_highlight_processing(event_id, chunk_size=batch_size)
     except Exception as e:
         logger.error(f"Error processing photos in batches for event {event_id}: {str(e)}")
 
 
 @shared_task
 def process_event_photos(event_id):
-    """Process all photos for an event, using batches for large events."""
+    """Process all photos for an event; progress is kept in its HighlightProcessingStatus."""
     try:
-        event = Event.objects.get(id=event_id)
-        photo_count = EventPhoto.objects.filter(event=event).count()
-        
-        # Use batch processing for large events
-        if photo_count > 100:
-            process_photos_in_batches.delay(event_id)
-        else:
-            # Process directly for smaller events
-            photos = EventPhoto.objects.filter(event=event)
-            for photo in photos:
-                analyze_photo_quality.delay(photo.id)
-            
-            # Find duplicates after all photos are processed
-            find_duplicate_photos.delay(event_id)
-            
+        return start_highlight_processing(event_id)
     except Exception as e:
-        logger.error(f"Error initiating photo processing for event {event_id}: {str(e)}")
\ No newline at end of file
+        logger.error(f"Error initiating photo processing for event {event_id}: {str(e)}")
@@ -0,0 +1,886 @@
+import threading
+from io import StringIO
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from unittest import mock
+
+import numpy as np # type: ignore
+from celery.exceptions import Retry # type: ignore
+
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.core.cache import caches
+from django.template.response import TemplateResponse
+from django.db import connection
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase
+from django.urls import reverse
+from django.utils import timezone
+
+from events.models import Event
+
+from photos.features import FEATURES_VERSION, measure_photo, save_photo_features
+from photos.models import EventPhoto
+
+from . import scheduling, summary
+from .middleware import HighlightsMiddleware
+from .models import (
+    BestShot, DuplicateGroup, DuplicatePhoto, HighlightProcessingStatus, PhotoHighlight, PhotoSignature,
+)
+from .analysis import score_photo
+from .bursts import split_bursts, window_pairs
+from .duplicates import (
+    HASH_BITS, PHASH_RADIUS, UnionFind, add_photo_to_duplicate_groups, cluster_signatures, rebuild_duplicate_groups,
+)
+from .hamming import (
+    MultiIndexHashIndex, hamming_distances, invalidate_event_hash_index, pack_hashes, pairs_within_radius,
+    popcount64,
+)
+from .leaderboard import CATEGORY_LIMITS, Leaderboard, category_scores, merge_pending_best_shots, top_k
+from .processing import recover_stale_runs, start_highlight_processing
+from .tasks import analyze_highlight_chunk, finalize_highlight_processing, rescore_event_highlights, run_event_job
+from .views import group_best_shots
+
+EVENT_ID = 42
+rebuilds = []
+
+
+def fake_rebuild(event_id):
+    rebuilds.append(event_id)
+
+
+class CoalescingSchedulerTests(SimpleTestCase):
+    """Bursts of requests for one (job, event) run the job once per window."""
+
+    workers = 8
+
+    def setUp(self):
+        super().setUp()
+        caches['default'].clear()
+        rebuilds.clear()
+
+        jobs = mock.patch.dict(scheduling.JOBS, {'test_rebuild': 'highlights.tests.fake_rebuild'})
+        jobs.start()
+        self.addCleanup(jobs.stop)
+
+        enqueue = mock.patch.object(run_event_job, 'apply_async')
+        self.apply_async = enqueue.start()
+        self.addCleanup(enqueue.stop)
+
+    def fire(self, count):
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            return list(pool.map(lambda _: scheduling.schedule_event_job('test_rebuild', EVENT_ID), range(count)))
+
+    def run_enqueued(self):
+        """Execute the last enqueued task the way the worker would."""
+        args, kwargs = self.apply_async.call_args
+        run_event_job(*args[0])
+
+    def test_500_triggers_rebuild_once_per_window(self):
+        enqueued = self.fire(500)
+
+        self.assertEqual(enqueued.count(True), 1)
+        self.assertEqual(self.apply_async.call_count, 1)
+        self.assertEqual(self.apply_async.call_args.kwargs['countdown'], scheduling.get_job_window())
+        self.assertEqual(rebuilds, [])
+
+        self.run_enqueued()
+        self.assertEqual(rebuilds, [EVENT_ID])
+
+        stats = scheduling.event_job_stats('test_rebuild', EVENT_ID)
+        self.assertEqual(stats['requested'], 500)
+        self.assertEqual(stats['coalesced'], 499)
+        self.assertEqual(stats['executed'], 1)
+        self.assertFalse(stats['pending'])
+
+        # Next window: another burst, another single rebuild
+        self.fire(500)
+        self.assertEqual(self.apply_async.call_count, 2)
+        self.run_enqueued()
+        self.assertEqual(rebuilds, [EVENT_ID, EVENT_ID])
+        self.assertEqual(scheduling.event_job_stats('test_rebuild', EVENT_ID)['coalesced'], 998)
+
+    def test_run_is_deferred_while_event_is_locked(self):
+        self.fire(10)
+        scheduling.get_job_cache().add(scheduling._lock_key(EVENT_ID), 'other-job')
+
+        self.run_enqueued()
+        self.assertEqual(rebuilds, [])
+        # Re-enqueued, and new requests still coalesce into the deferred run
+        self.assertEqual(self.apply_async.call_count, 2)
+        self.assertFalse(scheduling.schedule_event_job('test_rebuild', EVENT_ID))
+
+        scheduling.get_job_cache().delete(scheduling._lock_key(EVENT_ID))
+        self.run_enqueued()
+        self.assertEqual(rebuilds, [EVENT_ID])
+
+    def test_request_during_run_schedules_next_run(self):
+        self.fire(3)
+
+        def rebuild_and_trigger(event_id):
+            rebuilds.append(event_id)
+            scheduling.schedule_event_job('test_rebuild', event_id)
+
+        with mock.patch(f"{__name__}.fake_rebuild", rebuild_and_trigger):
+            self.run_enqueued()
+
+        self.assertEqual(rebuilds, [EVENT_ID])
+        self.assertEqual(self.apply_async.call_count, 2)
+
+
+
+class LeaderboardTests(SimpleTestCase):
+    """Category scoring and per-category top-K selection."""
+
+    results = {
+        'quality_score': 90, 'blur_score': 80, 'exposure_score': 60,
+        'composition_score': 85, 'lighting_score': 70,
+        'is_underexposed': False, 'is_overexposed': False, 'is_accidental': False,
+        'categories': ['PORTRAIT', 'LIGHTING'], 'shot_type': 'PORTRAIT',
+    }
+
+    def test_category_scores(self):
+        self.assertEqual(category_scores(self.results), {'OVERALL': 90, 'PORTRAIT': 90})
+
+        blurry = dict(self.results, blur_score=20, is_underexposed=True)
+        self.assertEqual(category_scores(blurry), {'BLURRY': 80, 'UNDEREXPOSED': 40})
+
+    def test_top_k_keeps_highest_scores_up_to_limit(self):
+        board = {photo_id: float(photo_id % 37) for photo_id in range(500)}
+        winners = top_k({'OVERALL': board, 'UNKNOWN': board})
+
+        limit = CATEGORY_LIMITS['OVERALL']
+        expected = sorted(board.items(), key=lambda item: item[1], reverse=True)[:limit]
+        self.assertEqual(len(winners), limit)
+        self.assertEqual(sorted(winners.values()), sorted(score for _, score in expected))
+        self.assertTrue(all(category == 'OVERALL' for category, _ in winners))
+
+
+class ConcurrentLeaderboardTests(TransactionTestCase):
+    """Workers flushing the same event at once keep every score and no category exceeds its limit."""
+
+    def setUp(self):
+        organizer = get_user_model().objects.create_user(
+            'organizer', 'organizer@example.com', 'password', role='ORGANIZER'
+        )
+        self.event = Event.objects.create(
+            title='Concurrent', description='Event', location='Hall', organizer=organizer,
+            start_date=timezone.now(), end_date=timezone.now(),
+        )
+        photos = EventPhoto.objects.bulk_create([
+            EventPhoto(event=self.event, image=f'events/test/{index}.jpg') for index in range(60)
+        ])
+        # Distinct scores, so the expected top-K is unambiguous
+        self.scores = {
+            photo.id: {'OVERALL': 40.0 + (index * 7) % 61, 'BLURRY': 100.0 - (index * 11) % 61}
+            for index, photo in enumerate(photos)
+        }
+
+    def flush_concurrently(self, defer_merge, workers=3):
+        photo_ids = list(self.scores)
+        chunks = [photo_ids[index::workers] for index in range(workers)]
+
+        # Every worker reads before any of them writes
+        barrier = threading.Barrier(workers)
+        bulk_update = EventPhoto.objects.bulk_update
+        waited = threading.local()
+
+        def bulk_update_after_all_read(*args, **kwargs):
+            if not getattr(waited, 'done', False):
+                waited.done = True
+                try:
+                    barrier.wait(timeout=5)
+                except threading.BrokenBarrierError:
+                    pass
+            return bulk_update(*args, **kwargs)
+
+        errors = []
+
+        def flush(chunk):
+            try:
+                leaderboard = Leaderboard(defer_merge=defer_merge)
+                for photo_id in chunk:
+                    scores = self.scores[photo_id]
+                    leaderboard.offer(self.event.id, photo_id, scores['OVERALL'], scores)
+                leaderboard.flush()
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        with mock.patch.object(EventPhoto.objects, 'bulk_update', bulk_update_after_all_read):
+            threads = [threading.Thread(target=flush, args=(chunk,)) for chunk in chunks]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(errors, [])
+
+    def assert_best_shots_are_top_k(self):
+        boards = {'OVERALL': {}, 'BLURRY': {}}
+        for photo_id, scores in self.scores.items():
+            for category, score in scores.items():
+                boards[category][photo_id] = score
+
+        stored = {
+            (category, photo_id): score
+            for category, photo_id, score in BestShot.objects.filter(event=self.event).values_list(
+                'category', 'photo_id', 'score'
+            )
+        }
+        self.assertEqual(stored, top_k(boards))
+        self.assertEqual(PhotoHighlight.objects.filter(event=self.event).count(), len(self.scores))
+
+    def test_concurrent_flushes_keep_limits_and_scores(self):
+        self.flush_concurrently(defer_merge=False)
+
+        self.assertFalse(PhotoHighlight.objects.filter(merged=False).exists())
+        self.assert_best_shots_are_top_k()
+
+    def test_rescored_best_shot_makes_room_for_the_next_best(self):
+        for defer_merge in (False, True):
+            with self.subTest(defer_merge=defer_merge):
+                leaderboard = Leaderboard()
+                for photo_id, scores in self.scores.items():
+                    leaderboard.offer(self.event.id, photo_id, scores['OVERALL'], scores)
+                leaderboard.flush()
+
+                # The best photo drops below the tenth and leaves BLURRY
+                best = max(self.scores, key=lambda photo_id: self.scores[photo_id]['OVERALL'])
+                self.scores[best] = {'OVERALL': 1.0}
+                with mock.patch('highlights.leaderboard.schedule_event_job'):
+                    leaderboard = Leaderboard(defer_merge=defer_merge)
+                    leaderboard.offer(self.event.id, best, 1.0, self.scores[best])
+                    leaderboard.flush()
+                merge_pending_best_shots(self.event.id)
+
+                self.assert_best_shots_are_top_k()
+                self.assertFalse(BestShot.objects.filter(photo_id=best).exists())
+
+    def test_upload_flushes_are_merged_by_one_job(self):
+        with mock.patch('highlights.leaderboard.schedule_event_job') as schedule:
+            self.flush_concurrently(defer_merge=True)
+
+        self.assertEqual(schedule.call_count, 3)
+        schedule.assert_called_with('merge_best_shots', self.event.id)
+        self.assertFalse(BestShot.objects.exists())
+
+        self.assertEqual(merge_pending_best_shots(self.event.id), len(self.scores))
+        self.assertEqual(merge_pending_best_shots(self.event.id), 0)
+        self.assert_best_shots_are_top_k()
+
+
+class ConcurrentDuplicateInsertTests(TransactionTestCase):
+    """Photos of one event inserted at once end up in a single duplicate group."""
+
+    def test_concurrent_inserts_share_one_group(self):
+        organizer = get_user_model().objects.create_user(
+            'organizer', 'organizer@example.com', 'password', role='ORGANIZER'
+        )
+        event = Event.objects.create(
+            title='Duplicates', description='Event', location='Hall', organizer=organizer,
+            start_date=timezone.now(), end_date=timezone.now(),
+        )
+        photos = EventPhoto.objects.bulk_create([
+            EventPhoto(event=event, image=f'events/test/{index}.jpg') for index in range(3)
+        ])
+        histogram = np.full(768, 1 / 768, dtype=np.float32).tobytes()
+        PhotoSignature.objects.bulk_create([
+            PhotoSignature(photo=photo, event=event, phash=bytes(32), color_hist=histogram, resolution=100)
+            for photo in photos
+        ])
+        invalidate_event_hash_index(event.id)
+        self.addCleanup(invalidate_event_hash_index, event.id)
+
+        # Both inserts find the first photo ungrouped before either creates a group
+        barrier = threading.Barrier(2)
+        create = DuplicateGroup.objects.create
+        waited = threading.local()
+
+        def create_after_both_read(*args, **kwargs):
+            if not getattr(waited, 'done', False):
+                waited.done = True
+                try:
+                    barrier.wait(timeout=5)
+                except threading.BrokenBarrierError:
+                    pass
+            return create(*args, **kwargs)
+
+        errors = []
+
+        def insert(photo):
+            try:
+                add_photo_to_duplicate_groups(photo)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        with mock.patch.object(DuplicateGroup.objects, 'create', create_after_both_read):
+            threads = [threading.Thread(target=insert, args=(photo,)) for photo in photos[1:]]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(DuplicateGroup.objects.filter(event=event).count(), 1)
+        self.assertEqual(
+            sorted(DuplicatePhoto.objects.values_list('photo_id', flat=True)), [photo.id for photo in photos]
+        )
+        self.assertEqual(DuplicatePhoto.objects.filter(is_primary=True).count(), 1)
+
+
+def near_hashes(count, seed=0):
+    """Packed 256-bit hashes in clusters of bases with a few to many bits flipped."""
+    rng = np.random.default_rng(seed)
+    bases = rng.integers(0, 256, (count // 5 + 1, 32), dtype=np.uint8)
+    hashes = []
+    for index in range(count):
+        bits = np.unpackbits(bases[index // 5])
+        flipped = rng.choice(256, size=rng.integers(0, 48), replace=False)
+        bits[flipped] ^= 1
+        hashes.append(np.packbits(bits).tobytes())
+    return hashes
+
+
+def brute_force_distance(a, b):
+    return bin(int.from_bytes(a, 'big') ^ int.from_bytes(b, 'big')).count('1')
+
+
+class HammingTests(SimpleTestCase):
+    """The multi-index lookup and the tiled all-pairs scan agree with brute-force Hamming distances."""
+
+    def setUp(self):
+        self.hashes = near_hashes(100)
+        self.words = pack_hashes(self.hashes)
+
+    def brute_force_pairs(self, radius):
+        pairs = set()
+        for i in range(len(self.hashes)):
+            for j in range(i + 1, len(self.hashes)):
+                distance = brute_force_distance(self.hashes[i], self.hashes[j])
+                if distance <= radius:
+                    pairs.add((i, j, distance))
+        return pairs
+
+    def test_search_matches_brute_force(self):
+        index = MultiIndexHashIndex()
+        ids = np.arange(1000, 1000 + len(self.hashes))
+        # Added in two batches, as signatures arrive
+        index.add(ids[:60], self.words[:60], last_signature_id=60)
+        index.add(ids[60:], self.words[60:], last_signature_id=100)
+        self.assertEqual(len(index), len(self.hashes))
+
+        for radius in (0, 10, 20, 35):
+            for query in (0, 17, 99):
+                found_ids, distances = index.search(self.words[query], radius)
+                expected = {
+                    1000 + row: brute_force_distance(self.hashes[query], hash_)
+                    for row, hash_ in enumerate(self.hashes)
+                    if brute_force_distance(self.hashes[query], hash_) <= radius
+                }
+                self.assertEqual(dict(zip(found_ids.tolist(), distances.tolist())), expected)
+
+    def test_pairs_within_radius_match_brute_force_across_tiles(self):
+        # 37 leaves a ragged last tile; 50 splits the hashes into two full tiles
+        for tile_size in (37, 50, 1024):
+            for radius in (10, 20, 35):
+                i, j, distances = pairs_within_radius(self.words, radius, tile_size=tile_size)
+                found = set(zip(i.tolist(), j.tolist(), distances.tolist()))
+                self.assertEqual(len(found), len(i))
+                self.assertEqual(found, self.brute_force_pairs(radius))
+
+    def test_popcount_fallback_matches_bitwise_count(self):
+        values = np.random.default_rng(1).integers(0, 2 ** 63, (64, 4), dtype=np.uint64)
+        values[0] = np.iinfo(np.uint64).max
+        values[1] = 0
+        expected = [[bin(int(value)).count('1') for value in row] for row in values.tolist()]
+
+        with mock.patch.object(np, 'bitwise_count'):
+            # Numpy before 2.0 has no bitwise_count
+            del np.bitwise_count
+            counts = popcount64(values.copy())
+            distances = hamming_distances(self.words[0], self.words)
+            i, j, pair_distances = pairs_within_radius(self.words, 35, tile_size=37)
+
+        self.assertEqual(counts.tolist(), expected)
+        self.assertEqual(
+            distances.tolist(), [brute_force_distance(self.hashes[0], hash_) for hash_ in self.hashes]
+        )
+        self.assertEqual(set(zip(i.tolist(), j.tolist(), pair_distances.tolist())), self.brute_force_pairs(35))
+
+
+def flip_bits(hash_, positions):
+    bits = np.unpackbits(np.frombuffer(hash_, dtype=np.uint8))
+    bits[list(positions)] ^= 1
+    return np.packbits(bits).tobytes()
+
+
+UNIFORM_HISTOGRAM = np.full(768, 1 / 768, dtype=np.float32).tobytes()
+
+
+class DuplicateClusteringTests(SimpleTestCase):
+    """Duplicate groups are the connected components of the duplicate graph."""
+
+    def setUp(self):
+        # a-b and b-c are within the radius, a-c is not; d is far from all of them
+        step = PHASH_RADIUS - 5
+        self.a = bytes(32)
+        self.b = flip_bits(self.a, range(step))
+        self.c = flip_bits(self.b, range(step, 2 * step))
+        self.d = flip_bits(self.a, range(128, HASH_BITS))
+
+    def cluster(self, hashes, ranks):
+        histograms = np.frombuffer(UNIFORM_HISTOGRAM * len(hashes), dtype=np.float32).reshape(len(hashes), -1)
+        return cluster_signatures(pack_hashes(hashes), histograms, ranks)
+
+    def test_union_find(self):
+        sets = UnionFind(6)
+        sets.union(0, 1)
+        sets.union(2, 1)
+        sets.union(4, 5)
+        self.assertEqual(sorted(sorted(group) for group in sets.groups()), [[0, 1, 2], [4, 5]])
+        self.assertEqual(sets.find(0), sets.find(2))
+        self.assertNotEqual(sets.find(0), sets.find(3))
+
+    def test_transitive_pairs_form_one_group(self):
+        groups = self.cluster([self.a, self.b, self.c, self.d], [(80, 100)] * 4)
+
+        self.assertEqual(len(groups), 1)
+        self.assertEqual(sorted(index for index, _ in groups[0]), [0, 1, 2])
+
+    def test_primary_has_best_quality_then_resolution(self):
+        groups = self.cluster([self.a, self.b, self.c], [(70, 900), (90, 100), (90, 400)])
+
+        primary, similarity = groups[0][0]
+        self.assertEqual((primary, similarity), (2, 1.0))
+        self.assertTrue(all(0 < similarity < 1 for _, similarity in groups[0][1:]))
+
+
+class RebuildDuplicateGroupsTests(TransactionTestCase):
+    """A rebuild replaces the groups of an event in one transaction."""
+
+    def setUp(self):
+        organizer = get_user_model().objects.create_user(
+            'organizer', 'organizer@example.com', 'password', role='ORGANIZER'
+        )
+        self.event = Event.objects.create(
+            title='Rebuild', description='Event', location='Hall', organizer=organizer,
+            start_date=timezone.now(), end_date=timezone.now(),
+        )
+        # Three copies of one shot, with the best quality last, and one unrelated photo
+        self.photos = EventPhoto.objects.bulk_create([
+            EventPhoto(event=self.event, image=f'events/test/{index}.jpg', quality_score=score)
+            for index, score in enumerate([60, 70, 90, 50])
+        ])
+        hashes = [bytes(32)] * 3 + [flip_bits(bytes(32), range(128, HASH_BITS))]
+        PhotoSignature.objects.bulk_create([
+            PhotoSignature(photo=photo, event=self.event, phash=hash_, color_hist=UNIFORM_HISTOGRAM, resolution=100)
+            for photo, hash_ in zip(self.photos, hashes)
+        ])
+
+        # A stale group pairing the unrelated photo with the first copy
+        self.old_group = DuplicateGroup.objects.create(event=self.event, similarity_threshold=0.9)
+        DuplicatePhoto.objects.bulk_create([
+            DuplicatePhoto(group=self.old_group, photo=self.photos[3], is_primary=True, similarity_score=1.0),
+            DuplicatePhoto(group=self.old_group, photo=self.photos[0], is_primary=False, similarity_score=0.9),
+        ])
+
+    def test_rebuild_replaces_old_groups(self):
+        self.assertEqual(rebuild_duplicate_groups(self.event.id), 1)
+
+        self.assertFalse(DuplicateGroup.objects.filter(id=self.old_group.id).exists())
+        group = DuplicateGroup.objects.get(event=self.event)
+        members = dict(group.photos.values_list('photo_id', 'is_primary'))
+        self.assertEqual(members, {self.photos[0].id: False, self.photos[1].id: False, self.photos[2].id: True})
+
+    def test_failed_rebuild_keeps_old_groups(self):
+        with mock.patch.object(DuplicatePhoto.objects, 'bulk_create', side_effect=RuntimeError('write failed')):
+            with self.assertRaises(RuntimeError):
+                rebuild_duplicate_groups(self.event.id)
+
+        self.assertEqual(list(DuplicateGroup.objects.values_list('id', flat=True)), [self.old_group.id])
+        self.assertEqual(self.old_group.photos.count(), 2)
+
+
+class ScoreFromFeaturesTests(SimpleTestCase):
+    """Highlights are scored from stored features, faces and tags without reading the image."""
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        # Sharp face region on a smooth background, at half the original resolution
+        image = np.full((400, 600), 120, dtype=np.uint8)
+        image[100:300, 200:400] = rng.integers(0, 255, (200, 200), dtype=np.uint8)
+        self.faces = [{'x': 400, 'y': 200, 'width': 400, 'height': 400}]
+        self.features = measure_photo(image, [[400, 200, 400, 400]], scale=2.0)
+
+    def photo(self, **fields):
+        return EventPhoto(id=7, image_width=1200, image_height=800, **fields)
+
+    def test_json_fields_are_used_without_io(self):
+        with mock.patch('photos.proxies.open_analysis_proxy', side_effect=AssertionError('image read')):
+            results = score_photo(self.photo(detected_faces=self.faces, scene_tags=['sport']), self.features)
+
+        self.assertEqual(results['face_count'], 1)
+        self.assertEqual(results['shot_type'], 'PORTRAIT')
+        self.assertIn('ACTION', results['categories'])
+        self.assertEqual(len(self.features['face_sharpness']), 1)
+
+    def test_rescoring_is_reproducible(self):
+        photo = self.photo(detected_faces=[], scene_tags=[])
+        self.assertEqual(score_photo(photo, self.features), score_photo(photo, self.features))
+
+
+class HighlightsSummaryTests(SimpleTestCase):
+    """The middleware reads the event summary from the cache; SimpleTestCase fails on any query."""
+
+    event = Event(id=EVENT_ID)
+    summary_data = {'category_counts': {'OVERALL': 10, 'BLURRY': 3}, 'duplicate_count': 4}
+
+    def setUp(self):
+        super().setUp()
+        caches['default'].clear()
+        self.middleware = HighlightsMiddleware(lambda request: None)
+
+    def render(self):
+        response = TemplateResponse(RequestFactory().get('/'), 'unused.html', {'event': self.event})
+        return self.middleware.process_template_response(None, response).context_data
+
+    def test_warm_cache_adds_no_queries(self):
+        generation = summary.get_generation(EVENT_ID)
+        summary.get_summary_cache().set(summary.summary_key(EVENT_ID, generation), self.summary_data)
+
+        context = self.render()
+
+        self.assertTrue(context['has_highlights'])
+        self.assertTrue(context['has_duplicates'])
+        self.assertEqual(context['duplicate_count'], 4)
+        self.assertEqual(context['blurry_count'], 3)
+        self.assertEqual(context['accidental_count'], 0)
+
+    def test_cold_cache_builds_once_until_dropped(self):
+        with mock.patch.object(summary, 'build_highlights_summary', return_value=self.summary_data) as build:
+            self.render()
+            self.render()
+            self.assertEqual(build.call_count, 1)
+
+            summary.drop_highlights_summary(EVENT_ID)
+            self.render()
+            self.assertEqual(build.call_count, 2)
+
+    def test_summary_built_before_a_change_is_not_served(self):
+        stale = dict(self.summary_data, duplicate_count=1)
+
+        def build_during_change(event_id, generation):
+            # The change commits while this reader is still building from older rows
+            summary.drop_highlights_summary(event_id)
+            return dict(stale, version=generation)
+
+        with mock.patch.object(summary, 'build_highlights_summary', side_effect=build_during_change):
+            self.assertEqual(summary.get_highlights_summary(EVENT_ID)['duplicate_count'], 1)
+
+        with mock.patch.object(summary, 'build_highlights_summary', return_value=self.summary_data) as build:
+            self.assertEqual(summary.get_highlights_summary(EVENT_ID)['duplicate_count'], 4)
+            self.assertEqual(build.call_count, 1)
+
+
+class BurstTests(SimpleTestCase):
+    """Candidates and bursts only join photos of one camera taken close in time."""
+
+    def test_window_pairs_match_brute_force(self):
+        rng = np.random.default_rng(0)
+        cameras = [f"serial:{camera}" for camera in rng.integers(0, 3, 300)]
+        times = rng.uniform(0, 600, 300)
+
+        rows, cols = window_pairs(cameras, times, 10)
+        found = {tuple(sorted(pair)) for pair in zip(rows.tolist(), cols.tolist())}
+        expected = {
+            (i, j) for i in range(300) for j in range(i + 1, 300)
+            if cameras[i] == cameras[j] and abs(times[i] - times[j]) <= 10
+        }
+        self.assertEqual(found, expected)
+        self.assertEqual(len(rows), len(found))
+
+    def test_bursts_split_on_gaps_and_cameras(self):
+        frames = [
+            ('serial:A', 0.0, 1, 10, 70.0),
+            ('serial:A', 0.5, 2, 11, 90.0),
+            ('serial:A', 1.0, 3, 12, None),
+            ('serial:A', 9.0, 4, 13, 80.0),
+            ('serial:B', 0.2, 1, 20, 60.0),
+            ('serial:B', 0.4, 2, 21, 60.0),
+        ]
+        bursts = split_bursts(frames, gap=2)
+        self.assertEqual([[frame[3] for frame in burst] for burst in bursts], [[10, 11, 12], [20, 21]])
+
+
+class HighlightsPageQueryTests(TestCase):
+    """Query budgets of the highlights pages do not grow with the number of shots or groups."""
+
+    @classmethod
+    def setUpTestData(cls):
+        User = get_user_model()
+        organizer = User.objects.create_user(
+            'organizer', 'organizer@example.com', 'password', role='ORGANIZER', is_staff=True
+        )
+        # The dashboard layout shows the avatar; set without save() so no embedding task is queued
+        User.objects.filter(id=organizer.id).update(avatar='user_avatars/organizer.jpg')
+        cls.organizer = User.objects.get(id=organizer.id)
+        cls.event = Event.objects.create(
+            title='Highlights', description='Event', location='Hall', organizer=cls.organizer,
+            start_date=timezone.now(), end_date=timezone.now(),
+        )
+
+    def setUp(self):
+        caches['default'].clear()
+        self.client.force_login(self.organizer)
+
+    def add_photos(self, count):
+        return EventPhoto.objects.bulk_create([
+            EventPhoto(event=self.event, image=f'events/test/{index}.jpg') for index in range(count)
+        ])
+
+    def add_best_shots(self, count):
+        categories = list(CATEGORY_LIMITS)
+        BestShot.objects.bulk_create([
+            BestShot(event=self.event, photo=photo, category=categories[index % len(categories)], score=index)
+            for index, photo in enumerate(self.add_photos(count))
+        ])
+        summary.drop_highlights_summary(self.event.id)
+
+    def add_duplicate_groups(self, count, size=3):
+        for _ in range(count):
+            group = DuplicateGroup.objects.create(event=self.event, similarity_threshold=0.9)
+            DuplicatePhoto.objects.bulk_create([
+                DuplicatePhoto(group=group, photo=photo, is_primary=(index == 0), similarity_score=1.0)
+                for index, photo in enumerate(self.add_photos(size))
+            ])
+
+    def get(self, name):
+        response = self.client.get(reverse(f'highlights:{name}', args=[self.event.slug]))
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_best_shots_are_loaded_in_one_query(self):
+        self.add_best_shots(20)
+
+        with self.assertNumQueries(1):
+            grouped = group_best_shots(self.event)
+            captions = [shot.photo.caption for shots in grouped['good'].values() for shot in shots]
+
+        self.assertEqual(len(captions), 12)
+        self.assertEqual(list(grouped['problem']), ['BLURRY', 'UNDEREXPOSED', 'OVEREXPOSED', 'ACCIDENTAL'])
+
+    def test_highlights_page_budget(self):
+        self.add_best_shots(30)
+
+        # Session, user, event, notification count, summary (2) and best shots
+        with self.assertNumQueries(7):
+            self.get('event_highlights')
+
+        # Cached summary and category blocks: no highlights query at all
+        with self.assertNumQueries(4):
+            self.get('event_highlights')
+
+    def test_best_shot_changes_refresh_the_cached_blocks(self):
+        self.add_best_shots(3)
+        self.assertContains(self.get('event_highlights'), 'Overall Best Shots')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            BestShot.objects.filter(event=self.event, category='OVERALL').delete()
+        self.assertNotContains(self.get('event_highlights'), 'Overall Best Shots')
+
+    def add_burst_photos(self, bursts, size=4):
+        start = timezone.now()
+        photos = self.add_photos(bursts * size)
+        for index, photo in enumerate(photos):
+            photo.taken_at = start + timezone.timedelta(seconds=(index // size) * 60 + index % size)
+            photo.camera_serial = 'CAM1'
+            photo.quality_score = index % size
+        EventPhoto.objects.bulk_update(photos, ['taken_at', 'camera_serial', 'quality_score'])
+        return photos
+
+    def test_burst_page_budget_does_not_grow_with_bursts(self):
+        photos = self.add_burst_photos(2)
+        # Session, user, event, notification count, capture metadata and the photos of the page
+        with self.assertNumQueries(6):
+            response = self.get('burst_photos')
+        self.assertEqual([burst['best_photo_id'] for burst in response.context['page_obj']], [photos[3].id, photos[7].id])
+
+        self.add_burst_photos(10)
+        with self.assertNumQueries(6):
+            self.get('burst_photos')
+
+    def test_duplicate_page_budget_does_not_grow_with_groups(self):
+        self.add_duplicate_groups(2)
+        # Session, user, event, notification count, groups and their prefetched photos
+        with self.assertNumQueries(6):
+            self.get('duplicate_photos')
+
+        self.add_duplicate_groups(10)
+        with self.assertNumQueries(6):
+            self.get('duplicate_photos')
+
+
+def fake_highlight(photo, leaderboard):
+    leaderboard.offer(photo.event_id, photo.id, 80.0, {'OVERALL': 80.0})
+    return 80.0
+
+
+class HighlightProcessingTests(TestCase):
+    """Whole-event runs analyze photos in chunks and finalize exactly once."""
+
+    @classmethod
+    def setUpTestData(cls):
+        organizer = get_user_model().objects.create_user(
+            'organizer', 'organizer@example.com', 'password', role='ORGANIZER'
+        )
+        cls.event = Event.objects.create(
+            title='Batch', description='Event', location='Hall', organizer=organizer,
+            start_date=timezone.now(), end_date=timezone.now(),
+        )
+        # bulk_create sends no post_save, so no ingestion is queued
+        EventPhoto.objects.bulk_create([
+            EventPhoto(event=cls.event, image=f'events/test/{index}.jpg') for index in range(120)
+        ])
+
+    def setUp(self):
+        dispatch = mock.patch('highlights.processing.chord')
+        self.chord = dispatch.start()
+        self.addCleanup(dispatch.stop)
+
+        analyze = mock.patch('highlights.tasks.record_photo_highlight', side_effect=fake_highlight)
+        analyze.start()
+        self.addCleanup(analyze.stop)
+
+        jobs = mock.patch('highlights.tasks.run_event_job_now', return_value=True)
+        self.run_job = jobs.start()
+        self.addCleanup(jobs.stop)
+
+    def start(self):
+        run_id = start_highlight_processing(self.event.id, chunk_size=50)
+        header = list(self.chord.call_args.args[0])
+        return run_id, [signature.args for signature in header]
+
+    def status(self):
+        return HighlightProcessingStatus.objects.get(event=self.event)
+
+    def test_chunks_report_progress_and_finalize_once(self):
+        run_id, chunks = self.start()
+        self.assertEqual([len(args[2]) for args in chunks], [50, 50, 20])
+
+        analyze_highlight_chunk(*chunks[0])
+        status = self.status()
+        self.assertEqual((status.processed_photos, status.completed_chunks, status.total_chunks), (50, 1, 3))
+        self.assertEqual(status.progress, 41.7)
+
+        for args in chunks[1:]:
+            analyze_highlight_chunk(*args)
+        self.assertEqual(PhotoHighlight.objects.filter(event=self.event).count(), 120)
+
+        finalize_highlight_processing(self.event.id, run_id)
+        finalize_highlight_processing(self.event.id, run_id)
+        self.assertEqual(
+            [call.args for call in self.run_job.call_args_list],
+            [('best_shots', self.event.id), ('rebuild_duplicates', self.event.id)],
+        )
+        status = self.status()
+        self.assertEqual(status.status, HighlightProcessingStatus.Status.COMPLETED)
+        self.assertIsNotNone(status.finished_at)
+
+    def test_run_stays_finalizing_until_deferred_jobs_run(self):
+        run_id, chunks = self.start()
+        for args in chunks:
+            analyze_highlight_chunk(*args)
+
+        # The duplicate rebuild finds the event locked by another job
+        self.run_job.side_effect = lambda job, event_id: job == 'best_shots'
+        with mock.patch.object(finalize_highlight_processing, 'retry', side_effect=Retry()) as retry:
+            with self.assertRaises(Retry):
+                finalize_highlight_processing(self.event.id, run_id)
+        self.assertEqual(retry.call_args.kwargs['args'], (self.event.id, run_id, ['rebuild_duplicates']))
+        self.assertEqual(self.status().status, HighlightProcessingStatus.Status.FINALIZING)
+
+        # The retry only runs the job that was left
+        self.run_job.reset_mock(side_effect=True)
+        self.run_job.return_value = True
+        finalize_highlight_processing.apply(args=retry.call_args.kwargs['args'], retries=1)
+        self.assertEqual([call.args for call in self.run_job.call_args_list], [('rebuild_duplicates', self.event.id)])
+        self.assertEqual(self.status().status, HighlightProcessingStatus.Status.COMPLETED)
+
+    def test_stale_runs_are_recovered(self):
+        run_id, chunks = self.start()
+        # The last chunk died, so the chord never calls back
+        for args in chunks[:-1]:
+            analyze_highlight_chunk(*args)
+        HighlightProcessingStatus.objects.update(updated_at=timezone.now() - timedelta(hours=2))
+
+        with mock.patch.object(finalize_highlight_processing, 'delay',
+                               side_effect=lambda *args: finalize_highlight_processing(*args)):
+            self.assertEqual(recover_stale_runs(timeout=3600), 1)
+        status = self.status()
+        self.assertEqual((status.status, status.processed_photos), (HighlightProcessingStatus.Status.COMPLETED, 100))
+
+        # A finalization that stalls is given up on
+        HighlightProcessingStatus.objects.update(
+            status=HighlightProcessingStatus.Status.FINALIZING, updated_at=timezone.now() - timedelta(hours=2),
+        )
+        self.assertEqual(recover_stale_runs(timeout=3600), 1)
+        self.assertEqual(self.status().status, HighlightProcessingStatus.Status.FAILED)
+
+    def test_superseded_run_is_ignored(self):
+        old_run, old_chunks = self.start()
+        new_run, _ = self.start()
+
+        analyze_highlight_chunk(*old_chunks[0])
+        finalize_highlight_processing(self.event.id, old_run)
+
+        status = self.status()
+        self.assertEqual(status.run_id, new_run)
+        self.assertEqual((status.processed_photos, status.status), (0, HighlightProcessingStatus.Status.ANALYZING))
+        self.run_job.assert_not_called()
+
+
+class RescoreHighlightsTests(TestCase):
+    """Re-scoring uses stored features and reports the photos it could not score."""
+
+    @classmethod
+    def setUpTestData(cls):
+        organizer = get_user_model().objects.create_user(
+            'organizer', 'organizer@example.com', 'password', role='ORGANIZER'
+        )
+        cls.event = Event.objects.create(
+            title='Rescore', description='Event', location='Hall', organizer=organizer,
+            start_date=timezone.now(), end_date=timezone.now(),
+        )
+        photos = EventPhoto.objects.bulk_create([
+            EventPhoto(event=cls.event, image=f'events/test/{index}.jpg', image_width=600, image_height=400)
+            for index in range(4)
+        ])
+        image = np.random.default_rng(0).integers(0, 255, (400, 600), dtype=np.uint8)
+        cls.features = measure_photo(image)
+        for photo in photos[:2]:
+            save_photo_features(photo, cls.features)
+        # Measured by an older analyzer
+        save_photo_features(photos[2], dict(cls.features, version=FEATURES_VERSION - 1))
+        cls.photos = photos
+
+    def test_photos_without_current_features_are_counted(self):
+        with mock.patch('photos.features.get_photo_features', side_effect=AssertionError('image read')):
+            self.assertEqual(rescore_event_highlights(self.event.id), {'rescored': 2, 'skipped': 2})
+        self.assertEqual(PhotoHighlight.objects.filter(event=self.event).count(), 2)
+
+        out = StringIO()
+        with mock.patch('photos.features.get_photo_features', side_effect=AssertionError('image read')):
+            call_command('rescore_highlights', event=self.event.id, stdout=out)
+        self.assertIn('skipped 2 without current features', out.getvalue())
+        self.assertIn('--measure-missing', out.getvalue())
+
+    def test_missing_features_are_measured_on_request(self):
+        with mock.patch('photos.features.get_photo_features', return_value=self.features) as measure:
+            self.assertEqual(
+                rescore_event_highlights(self.event.id, measure_missing=True), {'rescored': 4, 'skipped': 0}
+            )
+        self.assertEqual(sorted(call.args[0].id for call in measure.call_args_list),
+                         [photo.id for photo in self.photos[2:]])
+        self.assertEqual(PhotoHighlight.objects.filter(event=self.event).count(), 4)
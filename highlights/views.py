@@ -2,10 +2,31 @@
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
+from django.core.paginator import Paginator
 from django.db import transaction
-from .models import Event, DuplicateGroup
+from django.db.models import Count, Prefetch
+from django.utils.functional import SimpleLazyObject
 from events.models import Event
+from photos.models import EventPhoto
 from .models import BestShot, DuplicateGroup, DuplicatePhoto
+from .bursts import event_bursts
+from .leaderboard import GOOD_CATEGORIES, PROBLEM_CATEGORIES
+from .summary import get_highlights_summary, get_summary_timeout
+
+BURSTS_PER_PAGE = 24
+
+
+def group_best_shots(event):
+    """Best shots of an event by category, good and problem categories apart, in one query."""
+    by_category = {}
+    for shot in BestShot.objects.filter(event=event).select_related('photo').order_by('category', '-score'):
+        by_category.setdefault(shot.category, []).append(shot)
+
+    return {
+        'good': {category: by_category[category] for category in GOOD_CATEGORIES if category in by_category},
+        'problem': {category: by_category[category] for category in PROBLEM_CATEGORIES if category in by_category},
+    }
+
 
 @login_required
 def event_highlights(request, event_slug):
@@ -13,33 +34,23 @@ def event_highlights(request, event_slug):
     event = get_object_or_404(Event, slug=event_slug)
     
     # Check if user has access to this event
-    if not (request.user == event.organizer or 
-            event.crew_members.filter(member=request.user).exists() or
+    is_manager = (request.user.id == event.organizer_id or
+                  event.crew_members.filter(member=request.user).exists())
+    if not (is_manager or
             event.participants.filter(user=request.user).exists() or
             event.is_public):
         messages.error(request, "You don't have access to this event.")
         return redirect('events:dashboard')
     
-    # Get best shots by category - separate good and problem categories
-    good_shots = {}
-    problem_shots = {}
-    
-    # Good categories
-    for category in ['OVERALL', 'PORTRAIT', 'GROUP', 'ACTION', 'COMPOSITION', 'LIGHTING']:
-        category_shots = BestShot.objects.filter(event=event, category=category).order_by('-score')
-        if category_shots.exists():
-            good_shots[category] = category_shots
-    
-    # Problem categories - for these, higher score means worse quality
-    for category in ['BLURRY', 'UNDEREXPOSED', 'OVEREXPOSED', 'ACCIDENTAL']:
-        category_shots = BestShot.objects.filter(event=event, category=category).order_by('-score')
-        if category_shots.exists():
-            problem_shots[category] = category_shots
-    
     context = {
         'event': event,
-        'good_shots': good_shots,
-        'problem_shots': problem_shots,
+        'can_manage_duplicates': is_manager,
+        # Loaded only when the cached category blocks have to be rendered again;
+        # problem categories have higher scores for worse quality
+        'best_shots': SimpleLazyObject(lambda: group_best_shots(event)),
+        # Changes whenever the event's best shots or duplicate groups change
+        'highlights_version': get_highlights_summary(event.id).get('version'),
+        'highlights_cache_timeout': get_summary_timeout(),
     }
     
     return render(request, 'highlights/event_highlights.html', context)
@@ -51,17 +62,25 @@ def duplicate_photos(request, event_slug):
     event = get_object_or_404(Event, slug=event_slug)
     
     # Check if user is organizer or crew
-    if not (request.user == event.organizer or 
+    if not (request.user.id == event.organizer_id or 
             event.crew_members.filter(member=request.user).exists()):
         messages.error(request, "Only organizers and crew members can manage duplicate photos.")
         return redirect('events:dashboard')
     
-    # Get duplicate groups
-    duplicate_groups = DuplicateGroup.objects.filter(event=event).prefetch_related("photos")
+    # Get duplicate groups with their photos, primary first, in one prefetch
+    duplicate_groups = DuplicateGroup.objects.filter(event=event).annotate(
+        photo_count=Count('photos')
+    ).prefetch_related(
+        Prefetch(
+            'photos',
+            queryset=DuplicatePhoto.objects.select_related('photo').order_by('-is_primary', 'id'),
+            to_attr='members',
+        )
+    )
 
     # Assign primary photo for each group
     for group in duplicate_groups:
-        group.primary_photo = group.photos.filter(is_primary=True).first()
+        group.primary_photo = group.members[0] if group.members and group.members[0].is_primary else None
 
     context = {
         'event': event,
@@ -71,6 +90,36 @@ def duplicate_photos(request, event_slug):
     return render(request, 'highlights/duplicate_photos.html', context)
 
 
+@login_required
+def burst_photos(request, event_slug):
+    """View for browsing the bursts of an event, each shown by its best frame."""
+    event = get_object_or_404(Event, slug=event_slug)
+    
+    # Check if user is organizer or crew
+    if not (request.user.id == event.organizer_id or 
+            event.crew_members.filter(member=request.user).exists()):
+        messages.error(request, "Only organizers and crew members can review bursts.")
+        return redirect('events:dashboard')
+    
+    # Bursts come from one query over the indexed capture metadata; only the
+    # photos of the current page are loaded
+    page = Paginator(event_bursts(event.id), BURSTS_PER_PAGE).get_page(request.GET.get('page'))
+    photos = EventPhoto.objects.in_bulk(
+        [photo_id for burst in page for photo_id in burst['photo_ids']]
+    )
+    for burst in page:
+        burst['best_photo'] = photos.get(burst['best_photo_id'])
+        burst['frames'] = [photos[photo_id] for photo_id in burst['photo_ids'] if photo_id in photos]
+        burst['duration'] = burst['ended_at'] - burst['started_at']
+    
+    context = {
+        'event': event,
+        'page_obj': page,
+    }
+    
+    return render(request, 'highlights/burst_photos.html', context)
+
+
 @login_required
 def duplicate_group_detail(request, group_id):
     """View for displaying details of a duplicate photo group."""
@@ -0,0 +1,356 @@
+# photos/ann.py
+"""
+Approximate nearest-neighbour index over participant embeddings.
+
+Very large events (thousands of participants) search an inverted-file
+(IVF) index per event and DeepFace model instead of scoring every user:
+embeddings are grouped around spherical k-means centroids and a face is
+only compared with the users of its closest lists. Smaller events keep
+using exact search in EventFaceMatcher.
+
+Indexes are persisted as .npz files under MEDIA_ROOT and updated
+incrementally when participants are added. Writers of the same event and
+model hold a lock key in the default cache while they read, change and
+save the file, so concurrent workers do not lose each other's users.
+"""
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import numpy as np # type: ignore
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ANN_MIN_USERS = 5000
+DEFAULT_ANN_PROBES = 8
+
+# Retrain the centroids once the index grew this much since the last training
+RETRAIN_GROWTH = 4
+
+DEFAULT_ANN_LOCK_TIMEOUT = 5 * 60  # seconds a writer may hold the lock
+DEFAULT_ANN_LOCK_WAIT = 60  # seconds a writer waits for the lock
+LOCK_POLL_INTERVAL = 0.05  # seconds between attempts to take the lock
+
+
+class IndexBusy(Exception):
+    """Another writer held the index lock for the whole wait."""
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return np.ascontiguousarray(vectors / norms)
+
+
+def spherical_kmeans(vectors, n_lists, iterations=10, seed=0):
+    """Centroids of L2-normalized vectors under cosine similarity."""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), n_lists, replace=False)].copy()
+
+    for _ in range(iterations):
+        assignments = np.argmax(vectors @ centroids.T, axis=1)
+        for list_id in range(n_lists):
+            members = vectors[assignments == list_id]
+            if len(members):
+                centroids[list_id] = members.sum(axis=0)
+            else:
+                # Re-seed empty lists with a random vector
+                centroids[list_id] = vectors[rng.integers(len(vectors))]
+        centroids = _normalize(centroids)
+
+    return centroids
+
+
+class IVFIndex:
+    """
+    Inverted-file index with cosine similarity over normalized vectors.
+
+    Vectors are kept sorted by list, so the members of list i are the
+    contiguous rows offsets[i]:offsets[i + 1].
+    """
+
+    def __init__(self, centroids, vectors, ids, assignments, trained_size):
+        self.centroids = centroids
+        self.trained_size = trained_size
+        self._set_rows(vectors, ids, assignments)
+
+    def _set_rows(self, vectors, ids, assignments):
+        order = np.argsort(assignments, kind='stable')
+        self.vectors = np.ascontiguousarray(vectors[order], dtype=np.float32)
+        self.ids = np.asarray(ids, dtype=np.int64)[order]
+        self.assignments = np.asarray(assignments, dtype=np.int32)[order]
+        self.offsets = np.searchsorted(self.assignments, np.arange(len(self.centroids) + 1))
+
+    @classmethod
+    def build(cls, ids, vectors, n_lists=None, seed=0):
+        vectors = _normalize(vectors)
+        ids = np.asarray(ids, dtype=np.int64)
+        n_lists = max(1, min(n_lists or int(np.sqrt(len(vectors))), len(vectors)))
+
+        # Training on a sample keeps the build time bounded for huge events
+        rng = np.random.default_rng(seed)
+        sample = vectors
+        if len(vectors) > 64 * n_lists:
+            sample = vectors[rng.choice(len(vectors), 64 * n_lists, replace=False)]
+
+        centroids = spherical_kmeans(sample, n_lists, seed=seed)
+        assignments = np.argmax(vectors @ centroids.T, axis=1)
+        return cls(centroids, vectors, ids, assignments, len(vectors))
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def dimensions(self):
+        return self.centroids.shape[1]
+
+    @property
+    def needs_retrain(self):
+        return len(self.ids) > RETRAIN_GROWTH * max(self.trained_size, 1)
+
+    def remove(self, ids):
+        keep = ~np.isin(self.ids, np.asarray(list(ids), dtype=np.int64))
+        self._set_rows(self.vectors[keep], self.ids[keep], self.assignments[keep])
+
+    def add(self, ids, vectors):
+        """Insert (or replace) vectors without retraining the centroids."""
+        ids = np.asarray(ids, dtype=np.int64)
+        if not len(ids):
+            return
+
+        vectors = _normalize(vectors)
+        assignments = np.argmax(vectors @ self.centroids.T, axis=1)
+        keep = ~np.isin(self.ids, ids)
+        self._set_rows(
+            np.vstack([self.vectors[keep], vectors]),
+            np.concatenate([self.ids[keep], ids]),
+            np.concatenate([self.assignments[keep], assignments]),
+        )
+
+    def search(self, queries, n_probe=None, runner_up=False):
+        """
+        Return (best ids, best cosine similarities) for each query vector.
+
+        With runner_up=True the similarity of the second-best user among the
+        probed lists is returned as a third array (-inf if there is none).
+        """
+        queries = _normalize(np.atleast_2d(queries))
+        n_probe = max(1, min(n_probe or DEFAULT_ANN_PROBES, len(self.centroids)))
+
+        best_rows = np.full(len(queries), -1, dtype=np.int64)
+        best_scores = np.full(len(queries), -np.inf, dtype=np.float32)
+        second_scores = np.full(len(queries), -np.inf, dtype=np.float32)
+        if not len(self.ids):
+            return (best_rows, best_scores, second_scores) if runner_up else (best_rows, best_scores)
+
+        # Closest lists of every query
+        probes = np.argpartition(-(queries @ self.centroids.T), n_probe - 1, axis=1)[:, :n_probe]
+
+        # Visit each probed list once and score all queries that probe it together
+        for list_id in np.unique(probes):
+            start, end = self.offsets[list_id], self.offsets[list_id + 1]
+            if start == end:
+                continue
+            rows = np.flatnonzero((probes == list_id).any(axis=1))
+            scores = queries[rows] @ self.vectors[start:end].T
+            best = np.argmax(scores, axis=1)
+            list_best = scores[np.arange(len(rows)), best]
+
+            if runner_up:
+                if end - start > 1:
+                    list_second = np.partition(scores, -2, axis=1)[:, -2]
+                else:
+                    list_second = np.full(len(rows), -np.inf, dtype=np.float32)
+                # Second best overall is the best of what the new list and the old best leave over
+                second_scores[rows] = np.maximum(
+                    np.maximum(second_scores[rows], list_second),
+                    np.minimum(best_scores[rows], list_best),
+                )
+
+            better = list_best > best_scores[rows]
+            best_scores[rows[better]] = list_best[better]
+            best_rows[rows[better]] = start + best[better]
+
+        found = best_rows >= 0
+        best_ids = np.full(len(queries), -1, dtype=np.int64)
+        best_ids[found] = self.ids[best_rows[found]]
+        if runner_up:
+            return best_ids, best_scores, second_scores
+        return best_ids, best_scores
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, centroids=self.centroids, vectors=self.vectors, ids=self.ids,
+                     assignments=self.assignments, trained_size=self.trained_size)
+        # Atomic replace so concurrent workers never read a partial file
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['centroids'], data['vectors'], data['ids'],
+                       data['assignments'], int(data['trained_size']))
+
+
+def ann_enabled_for(user_count):
+    return user_count >= getattr(settings, 'FACE_ANN_MIN_USERS', DEFAULT_ANN_MIN_USERS)
+
+
+def ann_index_path(event_id, model_name):
+    return os.path.join(settings.MEDIA_ROOT, 'ann_indexes', f"event_{event_id}", f"{model_name}.npz")
+
+
+# index path -> (file mtime, IVFIndex) for this worker process
+_loaded_indexes = {}
+_lock = threading.Lock()
+
+
+def _load_index(path):
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+
+    with _lock:
+        cached = _loaded_indexes.get(path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+
+    try:
+        index = IVFIndex.load(path)
+    except (OSError, ValueError, KeyError) as e:
+        logger.warning(f"Could not load ANN index {path}: {str(e)}")
+        return None
+
+    with _lock:
+        _loaded_indexes[path] = (mtime, index)
+    return index
+
+
+def _store_index(path, index):
+    index.save(path)
+    with _lock:
+        _loaded_indexes[path] = (os.path.getmtime(path), index)
+
+
+@contextmanager
+def index_write_lock(event_id, model_name):
+    """Hold the write lock of an event's index for a model; raises IndexBusy when it stays taken."""
+    key = f"ann_index:lock:{event_id}:{model_name}"
+    token = uuid.uuid4().hex
+    deadline = time.monotonic() + getattr(settings, 'FACE_ANN_LOCK_WAIT', DEFAULT_ANN_LOCK_WAIT)
+    while not cache.add(key, token, timeout=getattr(settings, 'FACE_ANN_LOCK_TIMEOUT', DEFAULT_ANN_LOCK_TIMEOUT)):
+        if time.monotonic() >= deadline:
+            raise IndexBusy(f"{model_name} ANN index of event {event_id} is locked")
+        time.sleep(LOCK_POLL_INTERVAL)
+
+    try:
+        yield
+    finally:
+        # The lock may have expired and been taken by another writer meanwhile
+        if cache.get(key) == token:
+            cache.delete(key)
+
+
+def _model_vectors(event_users_data, model_name):
+    ids, vectors = [], []
+    for user_id, user_data in event_users_data.items():
+        embedding = (user_data or {}).get('deepface_representations', {}).get(model_name)
+        if embedding is not None and len(embedding):
+            ids.append(user_id)
+            vectors.append(np.asarray(embedding, dtype=np.float32))
+    return ids, vectors
+
+
+def sync_event_index(event_id, model_name, event_users_data):
+    """Load the index of an event and model, building or updating it to match the users."""
+    path = ann_index_path(event_id, model_name)
+    ids, vectors = _model_vectors(event_users_data, model_name)
+    if not ids:
+        return None
+
+    # Up to date: no write, so no lock
+    index = _load_index(path)
+    if (index is not None and index.dimensions == len(vectors[0]) and not index.needs_retrain
+            and set(index.ids.tolist()) == set(ids)):
+        return index
+
+    with index_write_lock(event_id, model_name):
+        # Loaded again, as another writer may have saved it meanwhile
+        index = _load_index(path)
+        if index is not None and index.dimensions != len(vectors[0]):
+            index = None
+
+        if index is None or index.needs_retrain:
+            index = IVFIndex.build(ids, vectors)
+            _store_index(path, index)
+            logger.info(f"Built {model_name} ANN index for event {event_id} with {len(index)} users")
+            return index
+
+        # Incremental update for participants added (or removed) since the last save
+        known = set(index.ids.tolist())
+        wanted = dict(zip(ids, vectors))
+        added = [user_id for user_id in wanted if user_id not in known]
+        removed = known - wanted.keys()
+
+        if added or removed:
+            if removed:
+                index.remove(removed)
+            if added:
+                index.add(added, [wanted[user_id] for user_id in added])
+            _store_index(path, index)
+            logger.info(f"Updated {model_name} ANN index for event {event_id}: +{len(added)} -{len(removed)}")
+
+    return index
+
+
+def get_event_indexes(event_id, event_users_data, model_names):
+    """ANN indexes per model for large events; empty for events that use exact search."""
+    if not ann_enabled_for(len(event_users_data)):
+        return {}
+
+    indexes = {}
+    for model_name in model_names:
+        try:
+            index = sync_event_index(event_id, model_name, event_users_data)
+            if index is not None:
+                indexes[model_name] = index
+        except Exception as e:
+            logger.error(f"ANN index unavailable for event {event_id} ({model_name}), using exact search: {str(e)}")
+    return indexes
+
+
+def add_users_to_event_index(event_id, user_data_by_id):
+    """Insert newly registered users into the existing indexes of an event."""
+    for model_name in {name for data in user_data_by_id.values() for name in data['deepface_representations']}:
+        path = ann_index_path(event_id, model_name)
+        if not os.path.exists(path):
+            # Event has no index yet (still small enough for exact search)
+            continue
+
+        try:
+            with index_write_lock(event_id, model_name):
+                index = _load_index(path)
+                if index is None:
+                    continue
+
+                ids, vectors = _model_vectors(user_data_by_id, model_name)
+                ids_vectors = [(i, v) for i, v in zip(ids, vectors) if len(v) == index.dimensions]
+                if not ids_vectors:
+                    continue
+
+                index.add([i for i, _ in ids_vectors], [v for _, v in ids_vectors])
+                _store_index(path, index)
+        except IndexBusy as e:
+            # The next sync_event_index adds them
+            logger.warning(f"Users not added to ANN index: {str(e)}")
+            continue
+        logger.info(f"Added {len(ids_vectors)} users to {model_name} ANN index of event {event_id}")
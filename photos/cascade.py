@@ -0,0 +1,90 @@
+# photos/cascade.py
+"""
+Cost-aware order of the DeepFace embedding models.
+
+Faces are embedded with the first (cheapest) model of FACE_MODEL_CASCADE
+and matched right away; a face whose best user beats the second-best by
+the stage margin is settled, and only the remaining, ambiguous faces are
+embedded with the next model. Per-stage counters in the Django cache show
+what share of faces needed the expensive models.
+"""
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+CACHE_PREFIX = 'face_cascade'
+
+
+def get_cascade_stages(embedding_models):
+    """
+    [(model name, margin)] in the order the models should run.
+
+    A margin of None never settles a face early. Without FACE_MODEL_CASCADE
+    every embedding model runs on every face; configured models missing from
+    the cascade run last.
+    """
+    cascade = getattr(settings, 'FACE_MODEL_CASCADE', None) or []
+    stages = [(model_name, margin) for model_name, margin in cascade if model_name in embedding_models]
+    listed = {model_name for model_name, _ in stages}
+    stages.extend((model_name, None) for model_name in embedding_models if model_name not in listed)
+    return stages
+
+
+def _counter_key(model_name, counter):
+    return f"{CACHE_PREFIX}:{model_name}:{counter}"
+
+
+def record_cascade_stage(model_name, embedded, settled):
+    """Add one batch to the counters of a stage."""
+    for counter, value in (('embedded', embedded), ('settled', settled)):
+        if not value:
+            continue
+        key = _counter_key(model_name, counter)
+        try:
+            cache.add(key, 0, timeout=None)
+            cache.incr(key, value)
+        except Exception as e:
+            logger.warning(f"Could not update cascade counter {key}: {str(e)}")
+
+
+def cascade_stats(embedding_models=None):
+    """
+    Counters per stage: faces embedded with the model, faces it settled, and
+    the share of all faces that reached it.
+    """
+    if embedding_models is None:
+        embedding_models = getattr(settings, 'FACE_EMBEDDING_MODELS', [])
+    stages = get_cascade_stages(list(embedding_models))
+
+    keys = [_counter_key(model_name, counter) for model_name, _ in stages for counter in ('embedded', 'settled')]
+    values = cache.get_many(keys)
+
+    stats = []
+    total = None
+    for model_name, margin in stages:
+        embedded = values.get(_counter_key(model_name, 'embedded'), 0)
+        settled = values.get(_counter_key(model_name, 'settled'), 0)
+        if total is None:
+            total = embedded
+        stats.append({
+            'model': model_name,
+            'margin': margin,
+            'embedded': embedded,
+            'settled': settled,
+            'hit_rate': round(settled / embedded, 4) if embedded else None,
+            'share_of_faces': round(embedded / total, 4) if total else None,
+        })
+    return stats
+
+
+def reset_cascade_stats(embedding_models=None):
+    if embedding_models is None:
+        embedding_models = getattr(settings, 'FACE_EMBEDDING_MODELS', [])
+    cache.delete_many([
+        _counter_key(model_name, counter)
+        for model_name in embedding_models
+        for counter in ('embedded', 'settled')
+    ])
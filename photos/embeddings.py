@@ -0,0 +1,289 @@
+# photos/embeddings.py
+"""
+Persistent store of face embeddings.
+
+Avatar embeddings are computed once per (user, avatar content, model) and
+kept in UserFaceEmbedding, so every worker process shares them and nothing
+is lost on restart. Reads go through a bounded in-process LRU. The name of
+the avatar file they were computed from is stored with them and compared
+with the user's avatar on read, so an avatar changed without the post_save
+refresh (e.g. by a queryset update) is treated as never processed.
+
+Embeddings of the faces detected in event photos are kept in
+PhotoFaceEmbedding, so new participants can be matched against an event
+without decoding photos or running the detector again.
+"""
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy as np # type: ignore
+from django.conf import settings
+from django.db import transaction
+
+from .models import PhotoFaceEmbedding, UserFaceEmbedding
+
+logger = logging.getLogger(__name__)
+
+# Model name used for dlib/face_recognition encodings
+FACE_RECOGNITION_MODEL = 'face_recognition'
+
+# Stored when the avatar was processed but no face was found in it
+NO_FACE_MODEL = 'no_face'
+
+
+class EmbeddingLRU:
+    """Thread-safe, size-bounded LRU of decoded embedding vectors."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._data:
+                return None
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def discard_user(self, user_id):
+        with self._lock:
+            for key in [key for key in self._data if key[0] == user_id]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+embedding_cache = EmbeddingLRU(getattr(settings, 'FACE_EMBEDDING_CACHE_SIZE', 20000))
+
+
+def avatar_content_hash(user):
+    """SHA-256 of the user's avatar file, or None if there is no readable avatar."""
+    if not user.avatar:
+        return None
+
+    digest = hashlib.sha256()
+    try:
+        with user.avatar.open('rb') as avatar_file:
+            for chunk in iter(lambda: avatar_file.read(65536), b''):
+                digest.update(chunk)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Could not read avatar of user {user.id}: {str(e)}")
+        return None
+    return digest.hexdigest()
+
+
+def to_vector(embedding):
+    """Convert a stored or freshly computed embedding to a float32 vector."""
+    if isinstance(embedding, (bytes, memoryview)):
+        return np.frombuffer(bytes(embedding), dtype=np.float32)
+    return np.asarray(embedding, dtype=np.float32)
+
+
+def get_stored_user_embeddings(user_ids):
+    """
+    Return stored embeddings for users, in the format the face matcher uses.
+
+    Returns (user_data, processed_ids): user_data maps user id to
+    {'face_recognition_encoding': vector or None,
+     'deepface_representations': {model_name: vector}}; processed_ids holds
+    every user whose current avatar has been processed, including users
+    whose avatar has no detectable face. Embeddings of an older avatar are
+    left out of both.
+    """
+    user_ids = list(user_ids)
+    if not user_ids:
+        return {}, set()
+
+    # Cheap index query; vectors are only fetched for LRU misses
+    rows = [
+        (row_id, user_id, avatar_hash, model_name)
+        for row_id, user_id, avatar_hash, model_name, avatar_name, current_avatar
+        in UserFaceEmbedding.objects.filter(user_id__in=user_ids).values_list(
+            'id', 'user_id', 'avatar_hash', 'model_name', 'avatar_name', 'user__avatar'
+        )
+        if avatar_name == current_avatar
+    ]
+
+    vectors = {}
+    missing = {}
+    for row_id, user_id, avatar_hash, model_name in rows:
+        if model_name == NO_FACE_MODEL:
+            continue
+        key = (user_id, avatar_hash, model_name)
+        vector = embedding_cache.get(key)
+        if vector is None:
+            missing[row_id] = key
+        else:
+            vectors[key] = vector
+
+    if missing:
+        for row_id, embedding in UserFaceEmbedding.objects.filter(id__in=missing).values_list('id', 'embedding'):
+            vector = to_vector(embedding)
+            embedding_cache.set(missing[row_id], vector)
+            vectors[missing[row_id]] = vector
+
+    user_data = {}
+    processed_ids = {user_id for _, user_id, _, _ in rows}
+
+    for (user_id, _, model_name), vector in vectors.items():
+        data = user_data.setdefault(user_id, {
+            'user_id': user_id,
+            'face_recognition_encoding': None,
+            'deepface_representations': {},
+        })
+        if model_name == FACE_RECOGNITION_MODEL:
+            data['face_recognition_encoding'] = vector
+        else:
+            data['deepface_representations'][model_name] = vector
+
+    return user_data, processed_ids
+
+
+def save_user_embeddings(user, avatar_hash, user_data):
+    """Replace the stored embeddings of a user with those of the given avatar."""
+    rows = []
+    if user_data:
+        fr_encoding = user_data.get('face_recognition_encoding')
+        if fr_encoding is not None:
+            rows.append((FACE_RECOGNITION_MODEL, to_vector(fr_encoding)))
+        for model_name, embedding in user_data.get('deepface_representations', {}).items():
+            if embedding is not None and len(embedding):
+                rows.append((model_name, to_vector(embedding)))
+
+    if not rows:
+        rows.append((NO_FACE_MODEL, np.zeros(0, dtype=np.float32)))
+
+    with transaction.atomic():
+        UserFaceEmbedding.objects.filter(user=user).delete()
+        UserFaceEmbedding.objects.bulk_create([
+            UserFaceEmbedding(
+                user=user,
+                avatar_hash=avatar_hash,
+                avatar_name=user.avatar.name or '',
+                model_name=model_name,
+                embedding=vector.tobytes(),
+                dimensions=len(vector),
+            )
+            for model_name, vector in rows
+        ])
+
+    embedding_cache.discard_user(user.id)
+    logger.info(f"Stored {len(rows)} avatar embeddings for user {user.id}")
+
+
+def has_current_embeddings(user, avatar_hash):
+    """
+    Whether the embeddings of this exact avatar are already stored.
+
+    They are relabelled with the avatar's current file name, so the same
+    picture uploaded again is not embedded again.
+    """
+    return UserFaceEmbedding.objects.filter(user=user, avatar_hash=avatar_hash).update(
+        avatar_name=user.avatar.name or ''
+    ) > 0
+
+
+def save_photo_face_embeddings(photo, face_reps):
+    """Replace the stored face embeddings of a photo with the given face representations."""
+    rows = []
+    for face_rep in face_reps:
+        embeddings = dict(face_rep.get('deepface_representations', {}))
+        embeddings[FACE_RECOGNITION_MODEL] = face_rep.get('face_recognition_encoding')
+
+        for model_name, embedding in embeddings.items():
+            if embedding is None or not len(embedding):
+                continue
+            vector = to_vector(embedding)
+            rows.append(PhotoFaceEmbedding(
+                photo_id=photo.id,
+                event_id=photo.event_id,
+                face_index=face_rep['index'],
+                model_name=model_name,
+                embedding=vector.tobytes(),
+                dimensions=len(vector),
+            ))
+
+    with transaction.atomic():
+        PhotoFaceEmbedding.objects.filter(photo_id=photo.id).delete()
+        PhotoFaceEmbedding.objects.bulk_create(rows)
+
+
+def iter_event_face_reps(event_id, batch_size=500):
+    """
+    Yield (keys, face_reps) batches for the stored faces of an event.
+
+    keys are (photo_id, face_index) pairs; face_reps use the format of the
+    face matcher. Rows are streamed so memory stays bounded for large events.
+    """
+    rows = (PhotoFaceEmbedding.objects
+            .filter(event_id=event_id)
+            .order_by('photo_id', 'face_index')
+            .values_list('photo_id', 'face_index', 'model_name', 'embedding')
+            .iterator(chunk_size=2000))
+
+    keys, face_reps = [], []
+    for photo_id, face_index, model_name, embedding in rows:
+        key = (photo_id, face_index)
+        if not keys or keys[-1] != key:
+            if len(face_reps) >= batch_size:
+                yield keys, face_reps
+                keys, face_reps = [], []
+            keys.append(key)
+            face_reps.append({
+                'index': face_index,
+                'face_recognition_encoding': None,
+                'deepface_representations': {},
+            })
+
+        vector = to_vector(embedding)
+        if model_name == FACE_RECOGNITION_MODEL:
+            face_reps[-1]['face_recognition_encoding'] = vector
+        else:
+            face_reps[-1]['deepface_representations'][model_name] = vector
+
+    if face_reps:
+        yield keys, face_reps
+
+
+def get_photo_face_reps(photo_ids):
+    """{photo id: face_reps} of the stored faces of the given photos, in one query."""
+    rows = (PhotoFaceEmbedding.objects
+            .filter(photo_id__in=list(photo_ids))
+            .order_by('photo_id', 'face_index')
+            .values_list('photo_id', 'face_index', 'model_name', 'embedding'))
+
+    photo_reps = {}
+    for photo_id, face_index, model_name, embedding in rows:
+        face_reps = photo_reps.setdefault(photo_id, [])
+        if not face_reps or face_reps[-1]['index'] != face_index:
+            face_reps.append({
+                'index': face_index,
+                'face_recognition_encoding': None,
+                'deepface_representations': {},
+            })
+
+        vector = to_vector(embedding)
+        if model_name == FACE_RECOGNITION_MODEL:
+            face_reps[-1]['face_recognition_encoding'] = vector
+        else:
+            face_reps[-1]['deepface_representations'][model_name] = vector
+    return photo_reps
+
+
+def clear_embedding_cache():
+    embedding_cache.clear()
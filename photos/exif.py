@@ -0,0 +1,93 @@
+# photos/exif.py
+"""
+Capture metadata from EXIF headers.
+
+When the analysis proxy is built, the capture time, camera body serial
+and frame number of the original are read from its EXIF header (no pixel
+data is decoded) and stored on the EventPhoto. Burst and duplicate
+detection only compare photos taken by the same camera a few seconds
+apart, using these fields.
+"""
+import logging
+import os
+import re
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+EXIF_IFD = 0x8769
+
+# IFD0 tags
+DATETIME = 0x0132
+
+# Exif IFD tags
+DATETIME_ORIGINAL = 0x9003
+OFFSET_TIME_ORIGINAL = 0x9011
+SUBSEC_TIME_ORIGINAL = 0x9291
+IMAGE_NUMBER = 0x9211
+BODY_SERIAL_NUMBER = 0xA431
+
+_OFFSET = re.compile(r'^([+-])(\d{2}):?(\d{2})$')
+# Trailing frame number, before the suffix storage adds to clashing names
+_TRAILING_NUMBER = re.compile(r'(\d+)(?:_[A-Za-z0-9]{7})?$')
+
+
+def _text(value):
+    if isinstance(value, bytes):
+        value = value.decode('ascii', errors='ignore')
+    return str(value).strip('\x00 ') if value is not None else ''
+
+
+def parse_exif_datetime(value, subsec='', offset=''):
+    """Aware datetime of an EXIF 'YYYY:MM:DD HH:MM:SS' value, or None."""
+    try:
+        taken_at = datetime.strptime(_text(value), '%Y:%m:%d %H:%M:%S')
+    except ValueError:
+        return None
+
+    digits = ''.join(ch for ch in _text(subsec) if ch.isdigit())
+    if digits:
+        taken_at = taken_at.replace(microsecond=int(digits[:6].ljust(6, '0')))
+
+    match = _OFFSET.match(_text(offset))
+    if match:
+        sign, hours, minutes = match.groups()
+        delta = timedelta(hours=int(hours), minutes=int(minutes))
+        return taken_at.replace(tzinfo=dt_timezone(delta if sign == '+' else -delta))
+    # Camera clock without a zone: only ever compared with the same camera,
+    # so reading it in the default zone is enough
+    return timezone.make_aware(taken_at, timezone.get_default_timezone())
+
+
+def sequence_from_filename(filename):
+    """Frame number in a camera file name such as IMG_0423.JPG, or None."""
+    match = _TRAILING_NUMBER.search(os.path.splitext(os.path.basename(filename or ''))[0])
+    return int(match.group(1)) if match else None
+
+
+def read_capture_info(img, filename=''):
+    """{'taken_at', 'camera_serial', 'capture_sequence'} of an opened PIL image."""
+    info = {'taken_at': None, 'camera_serial': '', 'capture_sequence': None}
+    try:
+        exif = img.getexif()
+        exif_ifd = exif.get_ifd(EXIF_IFD)
+    except Exception as e:
+        logger.warning(f"Unreadable EXIF in {filename}: {str(e)}")
+        exif, exif_ifd = {}, {}
+
+    info['taken_at'] = (
+        parse_exif_datetime(
+            exif_ifd.get(DATETIME_ORIGINAL), exif_ifd.get(SUBSEC_TIME_ORIGINAL), exif_ifd.get(OFFSET_TIME_ORIGINAL)
+        )
+        or parse_exif_datetime(exif.get(DATETIME))
+    )
+    info['camera_serial'] = _text(exif_ifd.get(BODY_SERIAL_NUMBER))[:64]
+
+    sequence = exif_ifd.get(IMAGE_NUMBER)
+    try:
+        info['capture_sequence'] = int(sequence) if sequence is not None else sequence_from_filename(filename)
+    except (TypeError, ValueError):
+        info['capture_sequence'] = sequence_from_filename(filename)
+    return info
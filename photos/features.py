@@ -0,0 +1,136 @@
+# photos/features.py
+"""
+Per-photo feature store.
+
+The ingest pipeline measures a photo once, on the analysis proxy it has
+already decoded: Laplacian sharpness, grayscale statistics and histogram,
+a tile sharpness map and the sharpness of every detected face. The
+measurements are stored in PhotoFeatures so that quality, tags and
+highlight scoring read them instead of decoding the image again. Rows
+measured by an older FEATURES_VERSION are measured again on next use.
+"""
+import logging
+
+import cv2 # type: ignore
+import numpy as np # type: ignore
+
+from .models import PhotoFeatures
+
+logger = logging.getLogger(__name__)
+
+# Bump when a measurement changes, so stored features are measured again
+FEATURES_VERSION = 1
+
+# The tile sharpness map is TILE_GRID x TILE_GRID tiles
+TILE_GRID = 8
+
+
+def face_boxes_of(detected_faces):
+    """[x, y, width, height] of each entry of photo.detected_faces, in original pixels."""
+    boxes = []
+    for face in detected_faces or []:
+        if isinstance(face, dict) and all(key in face for key in ('x', 'y', 'width', 'height')):
+            boxes.append([int(face['x']), int(face['y']), int(face['width']), int(face['height'])])
+    return boxes
+
+
+def tile_sharpness_map(laplacian, grid=TILE_GRID):
+    """Variance of the Laplacian in each tile of a grid x grid split, row-major."""
+    tiles = np.zeros((grid, grid), dtype=np.float32)
+    for row, band in enumerate(np.array_split(laplacian, grid, axis=0)):
+        for col, tile in enumerate(np.array_split(band, grid, axis=1)):
+            if tile.size:
+                tiles[row, col] = tile.var()
+    return tiles
+
+
+def measure_photo(image, face_boxes=(), scale=1.0):
+    """
+    Measure a decoded BGR (or grayscale) proxy.
+
+    `face_boxes` are in original pixels and `scale` maps proxy pixels to
+    original pixels, as for face detection.
+    """
+    gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    height, width = gray.shape
+    laplacian = cv2.Laplacian(gray, cv2.CV_64F)
+
+    histogram = np.bincount(gray.ravel(), minlength=256).astype(np.float64)
+    histogram /= max(histogram.sum(), 1)
+
+    face_sharpness = []
+    for x, y, w, h in face_boxes:
+        # Face box in proxy pixels, clipped to the image
+        fx, fy = max(0, int(x / scale)), max(0, int(y / scale))
+        fw, fh = min(width - fx, int(w / scale)), min(height - fy, int(h / scale))
+        if fw > 0 and fh > 0:
+            face_sharpness.append(float(cv2.Laplacian(gray[fy:fy + fh, fx:fx + fw], cv2.CV_64F).var()))
+        else:
+            face_sharpness.append(None)
+
+    return {
+        'version': FEATURES_VERSION,
+        'width': width,
+        'height': height,
+        'sharpness': float(laplacian.var()),
+        'brightness': float(gray.mean()),
+        'contrast': float(gray.std()),
+        'histogram': histogram.astype(np.float32),
+        'tile_sharpness': tile_sharpness_map(laplacian),
+        'face_boxes': [list(box) for box in face_boxes],
+        'face_sharpness': face_sharpness,
+    }
+
+
+def save_photo_features(photo, features):
+    """Store measured features for a photo, replacing older ones."""
+    PhotoFeatures.objects.update_or_create(
+        photo=photo,
+        defaults={
+            'version': features['version'],
+            'width': features['width'],
+            'height': features['height'],
+            'sharpness': features['sharpness'],
+            'brightness': features['brightness'],
+            'contrast': features['contrast'],
+            'histogram': np.asarray(features['histogram'], dtype=np.float32).tobytes(),
+            'tile_sharpness': np.asarray(features['tile_sharpness'], dtype=np.float32).tobytes(),
+            'face_boxes': features['face_boxes'],
+            'face_sharpness': features['face_sharpness'],
+        }
+    )
+
+
+def features_from_record(record):
+    """Feature dict of a PhotoFeatures row, with the arrays decoded."""
+    return {
+        'version': record.version,
+        'width': record.width,
+        'height': record.height,
+        'sharpness': record.sharpness,
+        'brightness': record.brightness,
+        'contrast': record.contrast,
+        'histogram': np.frombuffer(bytes(record.histogram), dtype=np.float32),
+        'tile_sharpness': np.frombuffer(bytes(record.tile_sharpness), dtype=np.float32).reshape(TILE_GRID, TILE_GRID),
+        'face_boxes': record.face_boxes,
+        'face_sharpness': record.face_sharpness,
+    }
+
+
+def get_photo_features(photo, force=False):
+    """Stored features of a photo, measured from its analysis proxy if missing or outdated."""
+    if not force:
+        try:
+            record = photo.features
+            if record.version == FEATURES_VERSION:
+                return features_from_record(record)
+        except PhotoFeatures.DoesNotExist:
+            pass
+
+    from .proxies import load_analysis_proxy, proxy_scale
+
+    image = load_analysis_proxy(photo)
+    features = measure_photo(image, face_boxes_of(photo.detected_faces), proxy_scale(photo, image.shape[1]))
+    save_photo_features(photo, features)
+    logger.info(f"Measured features v{FEATURES_VERSION} of photo {photo.id}")
+    return features
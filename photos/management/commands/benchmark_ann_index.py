@@ -0,0 +1,65 @@
+import time
+
+import numpy as np # type: ignore
+from django.core.management.base import BaseCommand
+
+from photos.ann import IVFIndex
+
+
+class Command(BaseCommand):
+    help = 'Benchmark recall and latency of the face ANN index against exact search'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, nargs='+', default=[5000, 20000],
+                            help='Participant counts to benchmark')
+        parser.add_argument('--dimensions', type=int, default=512, help='Embedding size (ArcFace is 512)')
+        parser.add_argument('--queries', type=int, default=200, help='Faces searched per run')
+        parser.add_argument('--probes', type=int, nargs='+', default=[1, 4, 8, 16, 32])
+        parser.add_argument('--seed', type=int, default=0)
+
+    def make_embeddings(self, rng, user_count, dimensions):
+        # Embeddings of real faces are clustered (age, ethnicity, lighting...),
+        # so draw users around a set of random group centres
+        centres = rng.normal(size=(max(user_count // 20, 1), dimensions))
+        groups = rng.integers(len(centres), size=user_count)
+        return (centres[groups] + rng.normal(0, 1.0, (user_count, dimensions))).astype(np.float32)
+
+    def handle(self, *args, **options):
+        rng = np.random.default_rng(options['seed'])
+        dimensions = options['dimensions']
+
+        for user_count in options['users']:
+            users = self.make_embeddings(rng, user_count, dimensions)
+            ids = np.arange(1, user_count + 1)
+
+            # Faces are noisy captures of random participants
+            sources = rng.integers(user_count, size=options['queries'])
+            queries = users[sources] + rng.normal(0, 1.0, (len(sources), dimensions)).astype(np.float32)
+
+            start = time.perf_counter()
+            index = IVFIndex.build(ids, users)
+            build_time = time.perf_counter() - start
+
+            # Exact search over the same normalized vectors
+            normalized = index.vectors
+            query_matrix = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+            start = time.perf_counter()
+            exact_ids = index.ids[np.argmax(query_matrix @ normalized.T, axis=1)]
+            exact_time = (time.perf_counter() - start) / len(queries)
+
+            self.stdout.write(
+                f"\n{user_count} users, {dimensions} dims, {len(index.centroids)} lists "
+                f"(build {build_time:.2f}s), exact search {exact_time * 1000:.3f} ms/face"
+            )
+            self.stdout.write(f"{'probes':>8} {'recall@1':>10} {'ms/face':>10} {'speedup':>9}")
+
+            for n_probe in options['probes']:
+                start = time.perf_counter()
+                ann_ids, _ = index.search(queries, n_probe)
+                ann_time = (time.perf_counter() - start) / len(queries)
+
+                recall = np.mean(ann_ids == exact_ids)
+                self.stdout.write(
+                    f"{n_probe:>8} {recall:>10.3f} {ann_time * 1000:>10.3f} "
+                    f"{exact_time / max(ann_time, 1e-9):>8.1f}x"
+                )
@@ -0,0 +1,44 @@
+import time
+
+import numpy as np # type: ignore
+from django.core.management.base import BaseCommand
+
+from photos.ml import model_registry, synthetic_face
+
+
+class Command(BaseCommand):
+    help = 'Measure face embedding throughput (faces/sec) for several batch sizes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 8, 32, 64])
+        parser.add_argument('--faces', type=int, default=256, help='Face crops embedded per run')
+        parser.add_argument('--models', nargs='+', help='Embedding models (default: FACE_EMBEDDING_MODELS)')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = np.random.default_rng(options['seed'])
+        models = options.get('models') or model_registry.embedding_models
+
+        # Crops of varying size, like the faces cut out of real photos
+        faces = []
+        for _ in range(options['faces']):
+            face = synthetic_face(int(rng.integers(80, 240)))
+            noise = rng.integers(-20, 20, face.shape)
+            faces.append(np.clip(face.astype(np.int16) + noise, 0, 255).astype(np.uint8))
+
+        self.stdout.write(f"{len(faces)} faces per run")
+        self.stdout.write(f"{'model':>10} {'batch':>6} {'seconds':>9} {'faces/sec':>10}")
+
+        for model_name in models:
+            # Warm-up pass so graph tracing for each batch shape is not measured
+            for batch_size in options['batch_sizes']:
+                model_registry.represent_batch(faces[:batch_size], model_name, batch_size=batch_size)
+
+            for batch_size in options['batch_sizes']:
+                start = time.perf_counter()
+                model_registry.represent_batch(faces, model_name, batch_size=batch_size)
+                elapsed = time.perf_counter() - start
+
+                self.stdout.write(
+                    f"{model_name:>10} {batch_size:>6} {elapsed:>9.2f} {len(faces) / elapsed:>10.1f}"
+                )
@@ -0,0 +1,112 @@
+import time
+
+import numpy as np # type: ignore
+from django.core.management.base import BaseCommand
+from scipy.spatial.distance import cosine  # type: ignore
+
+from photos.matching import (
+    DEFAULT_MODEL_THRESHOLD, FACE_RECOGNITION_FALLBACK_BELOW,
+    FACE_RECOGNITION_THRESHOLD, MODEL_THRESHOLDS, EventFaceMatcher,
+)
+
+# Embedding sizes of the models used by the photo pipeline
+MODEL_DIMENSIONS = {'Facenet': 128, 'VGG-Face': 4096, 'ArcFace': 512}
+FACE_RECOGNITION_DIMENSIONS = 128
+
+
+def legacy_match(face_rep, event_users_data):
+    """Per-user loop the pipeline used before EventFaceMatcher, kept as reference."""
+    best_match, best_confidence, best_method = None, 0, None
+
+    for model_name, face_embedding in face_rep['deepface_representations'].items():
+        threshold = MODEL_THRESHOLDS.get(model_name, DEFAULT_MODEL_THRESHOLD)
+        for user_id, user_data in event_users_data.items():
+            user_embedding = user_data['deepface_representations'].get(model_name)
+            confidence = (1 - cosine(np.array(face_embedding), np.array(user_embedding))) * 100
+            if confidence > threshold and confidence > best_confidence:
+                best_match, best_confidence, best_method = user_id, confidence, f"deepface_{model_name}"
+
+    fr_encoding = face_rep['face_recognition_encoding']
+    if best_match is None or best_confidence < FACE_RECOGNITION_FALLBACK_BELOW:
+        for user_id, user_data in event_users_data.items():
+            # face_recognition.face_distance([known], face)[0]
+            distance = np.linalg.norm(user_data['face_recognition_encoding'] - fr_encoding)
+            confidence = (1 - distance) * 100
+            if confidence > FACE_RECOGNITION_THRESHOLD and confidence > best_confidence:
+                best_match, best_confidence, best_method = user_id, confidence, "face_recognition"
+
+    if best_match:
+        return {'user_id': best_match, 'confidence': round(best_confidence, 2), 'matched_by': best_method}
+    return None
+
+
+class Command(BaseCommand):
+    help = 'Benchmark vectorized face matching against the per-user loop'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, nargs='+', default=[10, 100, 500, 2000],
+                            help='Participant counts to benchmark')
+        parser.add_argument('--faces', type=int, default=10, help='Faces per photo')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def make_data(self, rng, user_count, face_count):
+        event_users_data = {}
+        for user_id in range(1, user_count + 1):
+            event_users_data[user_id] = {
+                'user_id': user_id,
+                'face_recognition_encoding': rng.normal(0, 0.1, FACE_RECOGNITION_DIMENSIONS),
+                'deepface_representations': {
+                    model_name: rng.normal(size=dims) for model_name, dims in MODEL_DIMENSIONS.items()
+                },
+            }
+
+        # Faces are noisy copies of random participants so that matches occur
+        face_reps = []
+        for index in range(face_count):
+            source = event_users_data[int(rng.integers(1, user_count + 1))]
+            face_reps.append({
+                'index': index,
+                'face_recognition_encoding':
+                    source['face_recognition_encoding'] + rng.normal(0, 0.02, FACE_RECOGNITION_DIMENSIONS),
+                'deepface_representations': {
+                    model_name: embedding + rng.normal(0, 0.8, len(embedding))
+                    for model_name, embedding in source['deepface_representations'].items()
+                },
+            })
+        return event_users_data, face_reps
+
+    def handle(self, *args, **options):
+        rng = np.random.default_rng(options['seed'])
+        face_count = options['faces']
+
+        self.stdout.write(
+            f"{'users':>8} {'loop (ms)':>12} {'matrix (ms)':>12} {'scoring (ms)':>13} {'speedup':>9} {'agree':>7}"
+        )
+
+        for user_count in options['users']:
+            event_users_data, face_reps = self.make_data(rng, user_count, face_count)
+
+            start = time.perf_counter()
+            legacy = [legacy_match(face_rep, event_users_data) for face_rep in face_reps]
+            legacy_time = time.perf_counter() - start
+
+            # Includes building the user matrices, as the pipeline does per photo
+            start = time.perf_counter()
+            matcher = EventFaceMatcher(event_users_data)
+            vectorized = matcher.match_faces(face_reps)
+            vectorized_time = time.perf_counter() - start
+
+            # Scoring alone, with the user matrices already built
+            start = time.perf_counter()
+            matcher.match_faces(face_reps)
+            scoring_time = time.perf_counter() - start
+
+            agree = sum(
+                (a and a['user_id'], a and a['matched_by']) == (b and b['user_id'], b and b['matched_by'])
+                for a, b in zip(legacy, vectorized)
+            )
+
+            self.stdout.write(
+                f"{user_count:>8} {legacy_time * 1000:>12.1f} {vectorized_time * 1000:>12.1f} {scoring_time * 1000:>13.1f} "
+                f"{legacy_time / max(vectorized_time, 1e-9):>8.1f}x {agree:>3}/{face_count}"
+            )
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from photos.models import EventPhoto
+from photos.proxies import create_analysis_proxy
+
+class Command(BaseCommand):
+    help = 'Create analysis proxies for photos that do not have one yet'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--event', type=int, help='Only build proxies for this event ID')
+        parser.add_argument('--force', action='store_true', help='Rebuild existing proxies')
+
+    def handle(self, *args, **options):
+        photos = EventPhoto.objects.select_related('event')
+
+        if options.get('event'):
+            photos = photos.filter(event_id=options['event'])
+        if not options.get('force'):
+            photos = photos.filter(Q(analysis_proxy='') | Q(analysis_proxy__isnull=True))
+
+        count = photos.count()
+        self.stdout.write(f"Building analysis proxies for {count} photos")
+
+        built = 0
+        for photo in photos.iterator():
+            try:
+                create_analysis_proxy(photo, force=options.get('force', False))
+                built += 1
+            except Exception as e:
+                self.stdout.write(self.style.ERROR(f"Error building proxy for photo {photo.id}: {str(e)}"))
+
+        self.stdout.write(self.style.SUCCESS(f"Successfully built {built} analysis proxies"))
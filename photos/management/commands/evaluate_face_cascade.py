@@ -0,0 +1,137 @@
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from photos.cascade import get_cascade_stages
+from photos.matching import EventFaceMatcher
+from photos.ml import model_registry
+from photos.pipeline import (
+    MIN_FACE_CONFIDENCE, align_face, build_face_reps, cascade_embed_faces, embed_faces, read_image,
+)
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare CPU time and accuracy of the model cascade with running every model, '
+        'on a labelled directory: <dataset>/<person>/<image>'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('dataset', help='Directory with one sub-directory of face images per person')
+        parser.add_argument('--gallery-per-person', type=int, default=1,
+                            help='Images per person used as registered avatars; the rest are probes')
+        parser.add_argument('--cascade', nargs='+', metavar='MODEL[:MARGIN]',
+                            help='Stages to evaluate instead of FACE_MODEL_CASCADE, e.g. Facenet:10 VGG-Face')
+        parser.add_argument('--repeat', type=int, default=1, help='Timed runs per configuration')
+
+    def parse_stages(self, options):
+        if not options.get('cascade'):
+            return get_cascade_stages(model_registry.embedding_models)
+
+        stages = []
+        for stage in options['cascade']:
+            model_name, _, margin = stage.partition(':')
+            stages.append((model_name, float(margin) if margin else None))
+        return stages
+
+    def load_face(self, path):
+        """Aligned crop of the largest confident face in an image, or None."""
+        image = read_image(path)
+        if image is None:
+            return None
+
+        faces = [
+            face for face in model_registry.extract_faces(image, align=True)
+            if face.get('facial_area', {}).get('w') and float(face.get('confidence') or 0) >= MIN_FACE_CONFIDENCE
+        ]
+        if not faces:
+            return None
+
+        area = max(faces, key=lambda face: face['facial_area']['w'] * face['facial_area']['h'])['facial_area']
+        x, y = max(0, area['x']), max(0, area['y'])
+        return align_face(image[y:y + area['h'], x:x + area['w']])
+
+    def load_dataset(self, root, gallery_per_person):
+        gallery, probes = [], []
+        people = sorted(name for name in os.listdir(root) if os.path.isdir(os.path.join(root, name)))
+
+        for person_id, person in enumerate(people, start=1):
+            paths = sorted(
+                os.path.join(root, person, name) for name in os.listdir(os.path.join(root, person))
+                if name.lower().endswith(IMAGE_EXTENSIONS)
+            )
+            faces = [face for face in (self.load_face(path) for path in paths) if face is not None]
+            gallery.extend((person_id, face) for face in faces[:gallery_per_person])
+            probes.extend((person_id, face) for face in faces[gallery_per_person:])
+
+        return people, gallery, probes
+
+    def run(self, matcher, faces, stages, repeat, cascade):
+        """Best CPU seconds over the runs, with the matches and embeddings of the last one."""
+        cpu_seconds = []
+        for _ in range(repeat):
+            start = time.process_time()
+            if not cascade:
+                representations = embed_faces(faces, model_names=[model_name for model_name, _ in stages])
+            else:
+                representations = cascade_embed_faces(faces, [matcher] * len(faces), stages=stages, record_stats=False)
+            matches = matcher.match_faces(build_face_reps([None] * len(faces), representations))
+            cpu_seconds.append(time.process_time() - start)
+        return min(cpu_seconds), matches, representations
+
+    def handle(self, *args, **options):
+        if not os.path.isdir(options['dataset']):
+            raise CommandError(f"{options['dataset']} is not a directory")
+
+        stages = self.parse_stages(options)
+        models = [model_name for model_name, _ in stages]
+        model_registry.load()
+
+        people, gallery, probes = self.load_dataset(options['dataset'], options['gallery_per_person'])
+        if not gallery or not probes:
+            raise CommandError('Need at least one gallery and one probe face')
+        self.stdout.write(f"{len(people)} people, {len(gallery)} gallery faces, {len(probes)} probe faces")
+
+        # Registered users from the gallery faces, embedded with every model (not timed)
+        event_users_data = {}
+        gallery_representations = embed_faces([face for _, face in gallery], model_names=models)
+        for (person_id, _), representations in zip(gallery, gallery_representations):
+            event_users_data.setdefault(person_id, {
+                'user_id': person_id,
+                'face_recognition_encoding': None,
+                'deepface_representations': representations,
+            })
+        matcher = EventFaceMatcher(event_users_data)
+
+        labels = [person_id for person_id, _ in probes]
+        faces = [face for _, face in probes]
+
+        # Warm-up so graph tracing is not measured
+        embed_faces(faces[:1], model_names=models)
+
+        results = {}
+        for name, cascade in (('all models', False), ('cascade', True)):
+            cpu_seconds, matches, representations = self.run(matcher, faces, stages, options['repeat'], cascade)
+            correct = sum(1 for label, match in zip(labels, matches) if match and match['user_id'] == label)
+            results[name] = (cpu_seconds, matches, representations)
+            self.stdout.write(
+                f"{name:>10}: {cpu_seconds:8.2f} CPU s, {cpu_seconds / len(faces) * 1000:7.1f} ms/face, "
+                f"accuracy {correct / len(faces):.3f}"
+            )
+
+        full_seconds, full_matches, _ = results['all models']
+        cascade_seconds, cascade_matches, cascade_representations = results['cascade']
+        agreement = sum(
+            1 for a, b in zip(full_matches, cascade_matches) if (a and a['user_id']) == (b and b['user_id'])
+        )
+        self.stdout.write(
+            f"CPU time reduction {1 - cascade_seconds / full_seconds:.1%}, "
+            f"cascade agrees with all models on {agreement / len(faces):.1%} of faces"
+        )
+
+        for model_name, margin in stages:
+            embedded = sum(1 for representations in cascade_representations if model_name in representations)
+            self.stdout.write(f"  {model_name:>10} (margin {margin}): {embedded / len(faces):.1%} of faces")
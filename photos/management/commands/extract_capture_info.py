@@ -0,0 +1,51 @@
+from PIL import Image
+from django.core.management.base import BaseCommand
+from photos.exif import read_capture_info
+from photos.models import EventPhoto
+
+CAPTURE_FIELDS = ['taken_at', 'camera_serial', 'capture_sequence']
+
+class Command(BaseCommand):
+    help = 'Read capture time, camera serial and frame number from the EXIF header of existing photos'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--event', type=int, help='Only read photos of this event ID')
+        parser.add_argument('--force', action='store_true', help='Read photos that already have a capture time')
+        parser.add_argument('--batch-size', type=int, default=500, help='Photos written per query')
+
+    def handle(self, *args, **options):
+        photos = EventPhoto.objects.only('id', 'image')
+
+        if options.get('event'):
+            photos = photos.filter(event_id=options['event'])
+        if not options.get('force'):
+            photos = photos.filter(taken_at__isnull=True)
+
+        self.stdout.write(f"Reading capture metadata of {photos.count()} photos")
+
+        pending = []
+        updated = 0
+        for photo in photos.iterator():
+            try:
+                # Opening reads the header only; no pixels are decoded
+                with Image.open(photo.image.path) as img:
+                    info = read_capture_info(img, photo.image.name)
+            except Exception as e:
+                self.stdout.write(self.style.ERROR(f"Error reading photo {photo.id}: {str(e)}"))
+                continue
+
+            for field, value in info.items():
+                setattr(photo, field, value)
+            pending.append(photo)
+
+            if len(pending) >= options['batch_size']:
+                # bulk_update does not send post_save, which would re-run ingestion
+                EventPhoto.objects.bulk_update(pending, CAPTURE_FIELDS)
+                updated += len(pending)
+                pending = []
+
+        if pending:
+            EventPhoto.objects.bulk_update(pending, CAPTURE_FIELDS)
+            updated += len(pending)
+
+        self.stdout.write(self.style.SUCCESS(f"Successfully updated {updated} photos"))
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from photos.cascade import cascade_stats, reset_cascade_stats
+
+
+class Command(BaseCommand):
+    help = 'Show how many faces each stage of the embedding model cascade embedded and settled'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='Reset the counters after printing them')
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"{'model':>10} {'margin':>7} {'embedded':>9} {'settled':>8} {'hit rate':>9} {'share':>7}")
+        for stage in cascade_stats():
+            hit_rate = f"{stage['hit_rate']:.1%}" if stage['hit_rate'] is not None else '-'
+            share = f"{stage['share_of_faces']:.1%}" if stage['share_of_faces'] is not None else '-'
+            self.stdout.write(
+                f"{stage['model']:>10} {str(stage['margin']):>7} {stage['embedded']:>9} "
+                f"{stage['settled']:>8} {hit_rate:>9} {share:>7}"
+            )
+
+        if options['reset']:
+            reset_cascade_stats()
+            self.stdout.write('Counters reset')
@@ -1,6 +1,6 @@
 from django.core.management.base import BaseCommand
 from photos.models import EventPhoto
-from photos.tasks import process_photo
+from photos.tasks import enqueue_photo_processing
 
 class Command(BaseCommand):
     help = 'Process all pending photos that have not been processed yet'
@@ -11,8 +11,8 @@ class Command(BaseCommand):
         
         self.stdout.write(f"Found {count} photos to process")
         
-        for photo in pending_photos:
-            self.stdout.write(f"Queuing photo {photo.id} for processing")
-            process_photo.delay(photo.id)
+        photo_ids = list(pending_photos.values_list('id', flat=True))
+        self.stdout.write(f"Queuing photos {photo_ids} for processing")
+        enqueue_photo_processing(photo_ids)
         
         self.stdout.write(self.style.SUCCESS(f"Successfully queued {count} photos for processing"))
\ No newline at end of file
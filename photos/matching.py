@@ -0,0 +1,230 @@
+# photos/matching.py
+"""
+Vectorized matching of detected faces against the users of an event.
+
+User embeddings are stacked once per model into contiguous, L2-normalized
+float32 matrices, so scoring every face of a photo against every user is a
+single matrix product per DeepFace model plus one vectorized euclidean
+distance for face_recognition encodings. Very large events can pass
+per-model ANN indexes (photos.ann) to search instead of the exact product.
+"""
+import logging
+
+import numpy as np # type: ignore
+
+logger = logging.getLogger(__name__)
+
+# Minimum confidence (cosine similarity * 100) for a DeepFace match
+MODEL_THRESHOLDS = {
+    'Facenet': 45,
+    'VGG-Face': 55,
+    'ArcFace': 50,
+}
+DEFAULT_MODEL_THRESHOLD = 50
+
+# Minimum confidence ((1 - euclidean distance) * 100) for a face_recognition match
+FACE_RECOGNITION_THRESHOLD = 45
+
+# face_recognition is only consulted when DeepFace found nothing better than this
+FACE_RECOGNITION_FALLBACK_BELOW = 60
+
+
+def _normalize_rows(matrix):
+    """L2-normalize rows; zero vectors stay zero and never match."""
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return np.ascontiguousarray(matrix / norms, dtype=np.float32)
+
+
+class EventFaceMatcher:
+    """Scores faces against all users of an event with one matrix product per model."""
+
+    def __init__(self, event_users_data, ann_indexes=None, ann_probes=None):
+        self.user_count = len(event_users_data)
+
+        # model_name -> IVFIndex for large events; these models skip exact search
+        self.ann_indexes = ann_indexes or {}
+        self.ann_probes = ann_probes
+
+        # model_name -> (user ids, normalized embedding matrix)
+        self.models = {}
+        stacked = {}
+        fr_ids, fr_vectors = [], []
+
+        for user_id, user_data in event_users_data.items():
+            if not user_data:
+                continue
+
+            for model_name, embedding in user_data.get('deepface_representations', {}).items():
+                if embedding is None or not len(embedding) or model_name in self.ann_indexes:
+                    continue
+                stacked.setdefault(model_name, ([], []))
+                stacked[model_name][0].append(user_id)
+                stacked[model_name][1].append(np.asarray(embedding, dtype=np.float32))
+
+            fr_encoding = user_data.get('face_recognition_encoding')
+            if fr_encoding is not None and len(fr_encoding):
+                fr_ids.append(user_id)
+                fr_vectors.append(np.asarray(fr_encoding, dtype=np.float32))
+
+        for model_name, (user_ids, vectors) in stacked.items():
+            try:
+                self.models[model_name] = (np.array(user_ids), _normalize_rows(np.vstack(vectors)))
+            except ValueError as e:
+                logger.error(f"Inconsistent {model_name} embedding sizes for event users: {str(e)}")
+
+        self.fr_user_ids = np.array(fr_ids)
+        self.fr_matrix = np.ascontiguousarray(np.vstack(fr_vectors)) if fr_vectors else None
+        self.fr_sq_norms = np.einsum('ij,ij->i', self.fr_matrix, self.fr_matrix) if fr_vectors else None
+
+    def _deepface_ranking(self, model_name, face_reps, face_indexes=None, runner_up=False):
+        """
+        Best user of each face for one model, using one matmul.
+
+        Returns {face index: (user id, confidence, runner-up confidence)}; the
+        runner-up confidence is only computed with runner_up=True and is
+        -inf when there is no second user.
+        """
+        index = self.ann_indexes.get(model_name)
+        if index is not None:
+            dimensions = index.dimensions
+        else:
+            user_ids, user_matrix = self.models[model_name]
+            dimensions = user_matrix.shape[1]
+
+        rows, face_vectors = [], []
+        for i in range(len(face_reps)) if face_indexes is None else face_indexes:
+            embedding = face_reps[i]['deepface_representations'].get(model_name)
+            if embedding is None or not len(embedding) or len(embedding) != dimensions:
+                continue
+            rows.append(i)
+            face_vectors.append(np.asarray(embedding, dtype=np.float32))
+
+        if not face_vectors:
+            return {}
+
+        face_matrix = _normalize_rows(np.vstack(face_vectors))
+        second_confidences = np.full(len(rows), -np.inf, dtype=np.float32)
+        if index is not None:
+            result = index.search(face_matrix, self.ann_probes, runner_up=runner_up)
+            best_ids, best_confidences = result[0], result[1] * 100
+            if runner_up:
+                second_confidences = result[2] * 100
+        else:
+            # (faces x dims) @ (dims x users) -> cosine similarity of every pair
+            confidences = (face_matrix @ user_matrix.T) * 100
+            best = np.argmax(confidences, axis=1)
+            best_ids = user_ids[best]
+            best_confidences = confidences[np.arange(len(best)), best]
+            if runner_up and confidences.shape[1] > 1:
+                second_confidences = np.partition(confidences, -2, axis=1)[:, -2]
+
+        return {
+            face_index: (best_ids[row].item(), float(best_confidences[row]), float(second_confidences[row]))
+            for row, face_index in enumerate(rows)
+        }
+
+    def _deepface_scores(self, model_name, face_reps):
+        """Best (user id, confidence) above threshold for each face."""
+        threshold = MODEL_THRESHOLDS.get(model_name, DEFAULT_MODEL_THRESHOLD)
+        return {
+            i: (user_id, confidence)
+            for i, (user_id, confidence, _) in self._deepface_ranking(model_name, face_reps).items()
+            if confidence > threshold
+        }
+
+    def has_model(self, model_name):
+        return model_name in self.models or model_name in self.ann_indexes
+
+    def decisive_faces(self, model_name, face_reps, face_indexes, margin):
+        """
+        Faces whose match with this model alone can be trusted.
+
+        A face is decisive when its best user clears the model threshold and
+        beats the second-best user by at least `margin` confidence points.
+        """
+        if not self.has_model(model_name):
+            return set()
+
+        threshold = MODEL_THRESHOLDS.get(model_name, DEFAULT_MODEL_THRESHOLD)
+        ranking = self._deepface_ranking(model_name, face_reps, face_indexes, runner_up=True)
+        return {
+            i for i, (_, confidence, runner_up) in ranking.items()
+            if confidence > threshold and confidence - runner_up >= margin
+        }
+
+    def _face_recognition_scores(self, face_reps, face_indexes):
+        """Best (user id, confidence) above threshold for the given faces."""
+        rows, vectors = [], []
+        for i in face_indexes:
+            encoding = face_reps[i]['face_recognition_encoding']
+            if encoding is None or len(encoding) != self.fr_matrix.shape[1]:
+                continue
+            rows.append(i)
+            vectors.append(np.asarray(encoding, dtype=np.float32))
+
+        if not vectors:
+            return {}
+
+        # Same distance face_recognition.face_distance computes, for all pairs at once
+        # ||f - u||^2 = ||f||^2 + ||u||^2 - 2 f.u, without a faces x users x dims temporary
+        faces = np.vstack(vectors)
+        squared = (
+            np.einsum('ij,ij->i', faces, faces)[:, None]
+            + self.fr_sq_norms[None, :]
+            - 2 * (faces @ self.fr_matrix.T)
+        )
+        distances = np.sqrt(np.maximum(squared, 0))
+        confidences = (1 - distances) * 100
+        best = np.argmax(confidences, axis=1)
+        best_confidences = confidences[np.arange(len(best)), best]
+
+        return {
+            rows[row]: (self.fr_user_ids[best[row]].item(), float(best_confidences[row]))
+            for row in range(len(best))
+            if best_confidences[row] > FACE_RECOGNITION_THRESHOLD
+        }
+
+    def match_faces(self, face_reps):
+        """
+        Match face representations with event users.
+
+        Returns one entry per face, in order: None, or
+        {'user_id', 'confidence', 'matched_by'} for the best match across models.
+        """
+        best = [None] * len(face_reps)
+        if not face_reps or not self.user_count:
+            return best
+
+        # DeepFace models in the order the faces were embedded with them
+        model_order = []
+        for face_rep in face_reps:
+            for model_name in face_rep['deepface_representations']:
+                if model_name not in model_order:
+                    model_order.append(model_name)
+
+        for model_name in model_order:
+            if not self.has_model(model_name):
+                continue
+            for i, (user_id, confidence) in self._deepface_scores(model_name, face_reps).items():
+                if best[i] is None or confidence > best[i][1]:
+                    best[i] = (user_id, confidence, f"deepface_{model_name}")
+
+        # face_recognition as fallback for faces without a confident DeepFace match
+        if self.fr_matrix is not None:
+            fallback = [
+                i for i, match in enumerate(best)
+                if match is None or match[1] < FACE_RECOGNITION_FALLBACK_BELOW
+            ]
+            for i, (user_id, confidence) in self._face_recognition_scores(face_reps, fallback).items():
+                if best[i] is None or confidence > best[i][1]:
+                    best[i] = (user_id, confidence, "face_recognition")
+
+        return [
+            {'user_id': match[0], 'confidence': round(match[1], 2), 'matched_by': match[2]}
+            if match else None
+            for match in best
+        ]
+
+    def match_face(self, face_rep):
+        return self.match_faces([face_rep])[0]
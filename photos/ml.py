@@ -0,0 +1,244 @@
+# photos/ml.py
+"""
+Worker-resident registry of the face detection and embedding models.
+
+Each Celery worker process loads the configured DeepFace detector and
+embedding models, plus the dlib models behind face_recognition, once at
+`worker_process_init` and runs a warm-up inference on a synthetic image,
+so the first photo a process handles does not pay for TensorFlow graph
+construction and weight loading. Task code borrows the models through
+`model_registry` instead of importing the libraries itself.
+
+Processes that did not warm up (web server, shell, solo pool) load the
+models on first use.
+"""
+import logging
+import os
+import threading
+import time
+
+import numpy as np # type: ignore
+from celery.signals import worker_process_init  # type: ignore
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DETECTOR_BACKEND = 'retinaface'
+DEFAULT_EMBEDDING_MODELS = ['Facenet', 'VGG-Face', 'ArcFace']
+DEFAULT_EMBEDDING_BATCH_SIZE = 32
+
+
+def get_embedding_batch_size():
+    return max(1, int(getattr(settings, 'FACE_EMBEDDING_BATCH_SIZE', DEFAULT_EMBEDDING_BATCH_SIZE)))
+
+
+def current_rss_mb():
+    """Resident memory of this process in MB."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        import resource
+        # Peak instead of current RSS where /proc is not available (kB on Linux, bytes on macOS)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def synthetic_face(size=160):
+    """Simple face-like BGR image, enough to drive every layer of the models."""
+    image = np.full((size, size, 3), 180, dtype=np.uint8)
+    center = size // 2
+    yy, xx = np.ogrid[:size, :size]
+    face = ((xx - center) / (size * 0.35)) ** 2 + ((yy - center) / (size * 0.45)) ** 2 <= 1
+    image[face] = (140, 170, 210)
+    for eye_x in (center - size // 6, center + size // 6):
+        image[center - size // 10:center - size // 20, eye_x - size // 20:eye_x + size // 20] = 40
+    image[center + size // 6:center + size // 5, center - size // 8:center + size // 8] = 60
+    return image
+
+
+class ModelRegistry:
+    """Loads the face models once per process and hands them out to task code."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._deepface = None
+        self._face_recognition = None
+        self.models = {}
+        self.load_seconds = {}
+        self.warmup_seconds = None
+        self.rss_before_mb = None
+        self.rss_after_mb = None
+
+    @property
+    def detector_backend(self):
+        return getattr(settings, 'FACE_DETECTOR_BACKEND', DEFAULT_DETECTOR_BACKEND)
+
+    @property
+    def embedding_models(self):
+        return list(getattr(settings, 'FACE_EMBEDDING_MODELS', DEFAULT_EMBEDDING_MODELS))
+
+    @property
+    def loaded(self):
+        return self._deepface is not None
+
+    def load(self, warmup=True):
+        """Import the libraries and build every configured model (idempotent)."""
+        if self.loaded:
+            return self
+
+        with self._lock:
+            if self.loaded:
+                return self
+
+            self.rss_before_mb = current_rss_mb()
+
+            start = time.perf_counter()
+            from deepface import DeepFace  # type: ignore
+            import face_recognition  # type: ignore
+            self.load_seconds['import'] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            self.models[self.detector_backend] = DeepFace.build_model(
+                model_name=self.detector_backend, task='face_detector'
+            )
+            self.load_seconds[self.detector_backend] = time.perf_counter() - start
+
+            for model_name in self.embedding_models:
+                start = time.perf_counter()
+                self.models[model_name] = DeepFace.build_model(model_name=model_name)
+                self.load_seconds[model_name] = time.perf_counter() - start
+
+            self._deepface = DeepFace
+            self._face_recognition = face_recognition
+
+            if warmup:
+                self._warm_up()
+
+            self.rss_after_mb = current_rss_mb()
+
+        logger.info(
+            f"Loaded face models {list(self.models)} in {sum(self.load_seconds.values()):.1f}s "
+            f"(warm-up {self.warmup_seconds or 0:.1f}s, "
+            f"+{self.rss_after_mb - self.rss_before_mb:.0f} MB, RSS {self.rss_after_mb:.0f} MB)"
+        )
+        return self
+
+    def _warm_up(self):
+        """Run one inference per model so that graphs and kernels are initialized."""
+        start = time.perf_counter()
+        image = synthetic_face()
+
+        try:
+            self._deepface.extract_faces(
+                img_path=image, detector_backend=self.detector_backend, enforce_detection=False
+            )
+        except Exception as e:
+            logger.warning(f"Detector warm-up failed: {str(e)}")
+
+        for model_name in self.embedding_models:
+            try:
+                self._deepface.represent(
+                    img_path=image, model_name=model_name, detector_backend='skip', enforce_detection=False
+                )
+            except Exception as e:
+                logger.warning(f"{model_name} warm-up failed: {str(e)}")
+
+        rgb = image[:, :, ::-1].copy()
+        self._face_recognition.face_encodings(rgb, [(0, rgb.shape[1], rgb.shape[0], 0)])
+        self._face_recognition.face_landmarks(rgb, [(0, rgb.shape[1], rgb.shape[0], 0)])
+
+        self.warmup_seconds = time.perf_counter() - start
+
+    @property
+    def deepface(self):
+        return self.load()._deepface
+
+    @property
+    def face_recognition(self):
+        return self.load()._face_recognition
+
+    def extract_faces(self, image, **kwargs):
+        """DeepFace.extract_faces with the configured detector."""
+        kwargs.setdefault('detector_backend', self.detector_backend)
+        kwargs.setdefault('enforce_detection', False)
+        return self.deepface.extract_faces(img_path=image, **kwargs)
+
+    def represent(self, image, model_name, **kwargs):
+        """DeepFace.represent with a model that is already built in this process."""
+        kwargs.setdefault('enforce_detection', False)
+        return self.deepface.represent(img_path=image, model_name=model_name, **kwargs)
+
+    def represent_batch(self, faces, model_name, batch_size=None):
+        """
+        Embeddings of already cropped BGR faces, one forward pass per batch.
+
+        Applies the same preprocessing as DeepFace.represent with
+        detector_backend='skip', but stacks the faces into one tensor instead
+        of running the network once per face.
+        """
+        if not faces:
+            return []
+
+        from deepface import DeepFace  # type: ignore
+        from deepface.models.FacialRecognition import FacialRecognition  # type: ignore
+        from deepface.modules import preprocessing  # type: ignore
+
+        # Built once per process; DeepFace keeps its own singleton as well
+        model = self.models.get(model_name)
+        if model is None:
+            model = self.models[model_name] = DeepFace.build_model(model_name=model_name)
+        batch_size = batch_size or get_embedding_batch_size()
+        target_size = (model.input_shape[1], model.input_shape[0])
+
+        # Keras models without a custom forward() can take a whole batch;
+        # VGG-Face only adds an L2 normalization on top of the network output
+        batchable = type(model).forward is FacialRecognition.forward or model_name == 'VGG-Face'
+
+        embeddings = []
+        for start in range(0, len(faces), batch_size):
+            tensor = np.concatenate([
+                preprocessing.normalize_input(
+                    preprocessing.resize_image(face[:, :, ::-1], target_size=target_size), normalization='base'
+                )
+                for face in faces[start:start + batch_size]
+            ])
+
+            if not batchable:
+                embeddings.extend(np.asarray(model.forward(tensor[i:i + 1])) for i in range(len(tensor)))
+                continue
+
+            output = model.model(tensor, training=False).numpy()
+            if model_name == 'VGG-Face':
+                output = output / np.linalg.norm(output, axis=1, keepdims=True)
+            embeddings.extend(output)
+
+        return [embedding.tolist() for embedding in embeddings]
+
+    def stats(self):
+        return {
+            'pid': os.getpid(),
+            'loaded': self.loaded,
+            'detector_backend': self.detector_backend,
+            'embedding_models': self.embedding_models,
+            'load_seconds': {name: round(seconds, 3) for name, seconds in self.load_seconds.items()},
+            'warmup_seconds': round(self.warmup_seconds, 3) if self.warmup_seconds is not None else None,
+            'rss_mb': round(current_rss_mb(), 1),
+            'model_memory_mb': (
+                round(self.rss_after_mb - self.rss_before_mb, 1) if self.rss_after_mb is not None else None
+            ),
+        }
+
+
+model_registry = ModelRegistry()
+
+
+@worker_process_init.connect
+def warm_up_models(**kwargs):
+    """Load and warm up the face models in every new worker process."""
+    if not getattr(settings, 'FACE_MODEL_WARMUP', True):
+        return
+    try:
+        model_registry.load()
+    except Exception as e:
+        # Tasks will try again on first use
+        logger.error(f"Face model warm-up failed: {str(e)}", exc_info=True)
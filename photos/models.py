@@ -10,6 +10,10 @@ def event_photo_path(instance, filename):
     # Generate path: media/events/<event_id>_<event_slug>/photos/<filename>
     return f'events/{instance.event.id}_{event_slug}/photos/{filename}'
 
+def analysis_proxy_path(instance, filename):
+    # Generate path: media/events/<event_id>_<event_slug>/proxies/<filename>
+    return f'events/{instance.event.id}_{instance.event.slug}/proxies/{filename}'
+
 class EventPhoto(models.Model):
     event = models.ForeignKey('events.Event', on_delete=models.CASCADE, related_name='photos')
     image = models.ImageField(upload_to=event_photo_path)
@@ -24,6 +28,16 @@ class EventPhoto(models.Model):
     detected_faces = models.JSONField(null=True, blank=True)
     scene_tags = models.JSONField(null=True, blank=True)
     enhanced_image = models.ImageField(upload_to=event_photo_path, null=True, blank=True)
+
+    # Bounded-size copy of the image that analyzers read instead of the original
+    analysis_proxy = models.ImageField(upload_to=analysis_proxy_path, null=True, blank=True)
+    image_width = models.PositiveIntegerField(null=True, blank=True)
+    image_height = models.PositiveIntegerField(null=True, blank=True)
+
+    # Capture metadata read from EXIF at ingest (see photos/exif.py)
+    taken_at = models.DateTimeField(null=True, blank=True)
+    camera_serial = models.CharField(max_length=64, blank=True)
+    capture_sequence = models.PositiveBigIntegerField(null=True, blank=True)
     
     # Engagement metrics
     view_count = models.IntegerField(default=0)
@@ -35,6 +49,8 @@ class EventPhoto(models.Model):
             models.Index(fields=['event']),
             models.Index(fields=['uploaded_by']),
             models.Index(fields=['processed']),
+            # Same-camera time windows for burst and duplicate detection
+            models.Index(fields=['event', 'camera_serial', 'taken_at']),
         ]
 
     def __str__(self):
@@ -49,6 +65,10 @@ class EventPhoto(models.Model):
         if self.enhanced_image:
             if os.path.isfile(self.enhanced_image.path):
                 os.remove(self.enhanced_image.path)
+
+        if self.analysis_proxy:
+            if os.path.isfile(self.analysis_proxy.path):
+                os.remove(self.analysis_proxy.path)
                 
         super().delete(*args, **kwargs)
     
@@ -97,3 +117,94 @@ class PhotoComment(models.Model):
     def __str__(self):
         return f"Comment by {self.user.username} on photo {self.photo.id}"
 
+
+class UserPhotoMatch(models.Model):
+    """A registered user recognized in an event photo."""
+    photo = models.ForeignKey(EventPhoto, on_delete=models.CASCADE, related_name='user_matches')
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='photo_matches')
+    confidence_score = models.FloatField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('photo', 'user')
+        indexes = [
+            models.Index(fields=['photo']),
+            models.Index(fields=['user']),
+        ]
+
+    def __str__(self):
+        return f"{self.user.username} found in photo {self.photo.id}"
+
+
+class UserGallery(models.Model):
+    """Personal gallery of the photos a user was recognized in."""
+    user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='gallery')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    @property
+    def photo_count(self):
+        return EventPhoto.objects.filter(user_matches__user=self.user).count()
+
+    def __str__(self):
+        return f"Gallery of {self.user.username}"
+
+
+class UserFaceEmbedding(models.Model):
+    """Face embedding of a user's avatar, computed once per avatar and model."""
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='face_embeddings')
+    avatar_hash = models.CharField(max_length=64, help_text="SHA-256 of the avatar file the embedding was computed from")
+    avatar_name = models.CharField(
+        max_length=255, blank=True, help_text="Name of that avatar file, compared with the user's avatar on read"
+    )
+    model_name = models.CharField(max_length=50)
+    embedding = models.BinaryField(help_text="float32 vector; empty when no face was found in the avatar")
+    dimensions = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('user', 'avatar_hash', 'model_name')
+        indexes = [
+            models.Index(fields=['user']),
+        ]
+
+    def __str__(self):
+        return f"{self.model_name} embedding for user {self.user_id}"
+
+
+class PhotoFaceEmbedding(models.Model):
+    """Embedding of a face detected in an event photo, kept for retroactive matching."""
+    photo = models.ForeignKey(EventPhoto, on_delete=models.CASCADE, related_name='face_embeddings')
+    event = models.ForeignKey('events.Event', on_delete=models.CASCADE, related_name='face_embeddings')
+    face_index = models.PositiveSmallIntegerField(help_text="Index of the face in photo.detected_faces")
+    model_name = models.CharField(max_length=50)
+    embedding = models.BinaryField(help_text="float32 vector")
+    dimensions = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('photo', 'face_index', 'model_name')
+        indexes = [
+            models.Index(fields=['event', 'model_name']),
+        ]
+
+    def __str__(self):
+        return f"{self.model_name} embedding of face {self.face_index} in photo {self.photo_id}"
+
+
+class PhotoFeatures(models.Model):
+    """Intermediate image measurements of a photo, shared by the analyzers that score it."""
+    photo = models.OneToOneField(EventPhoto, on_delete=models.CASCADE, related_name='features')
+    version = models.PositiveSmallIntegerField(help_text="Version of the analyzer that measured the features")
+    width = models.PositiveIntegerField(help_text="Width of the analysis proxy the features were measured on")
+    height = models.PositiveIntegerField(help_text="Height of the analysis proxy the features were measured on")
+    sharpness = models.FloatField(help_text="Variance of the Laplacian of the grayscale proxy")
+    brightness = models.FloatField(help_text="Mean grayscale value (0-255)")
+    contrast = models.FloatField(help_text="Standard deviation of the grayscale values")
+    histogram = models.BinaryField(help_text="float32 grayscale histogram, 256 bins summing to 1")
+    tile_sharpness = models.BinaryField(help_text="float32 Laplacian variance per tile, row-major grid")
+    face_boxes = models.JSONField(default=list, help_text="[x, y, width, height] of each face, in original pixels")
+    face_sharpness = models.JSONField(default=list, help_text="Laplacian variance of each face box (null if empty)")
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Features v{self.version} of photo {self.photo_id}"
@@ -0,0 +1,889 @@
+# photos/pipeline.py
+"""
+Image analysis behind the photo tasks.
+
+Worker-only code: it imports OpenCV and borrows the face models from the
+registry, so photos.tasks imports it inside task bodies and the web
+process never loads it.
+"""
+import os
+import logging
+import concurrent.futures
+
+import cv2 # type: ignore
+import numpy as np # type: ignore
+from PIL import Image, ImageEnhance
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db.models import Q
+
+from .models import EventPhoto, UserPhotoMatch
+from .ann import get_event_indexes
+from .cascade import get_cascade_stages, record_cascade_stage
+from .matching import EventFaceMatcher
+from .ml import model_registry
+from .features import face_boxes_of, measure_photo, save_photo_features
+from .proxies import create_analysis_proxy, load_analysis_proxy, proxy_scale
+from .embeddings import (
+    avatar_content_hash, get_stored_user_embeddings, has_current_embeddings,
+    save_photo_face_embeddings, save_user_embeddings,
+)
+from .tasks import enhance_photo_task
+
+
+logger = logging.getLogger(__name__)
+User = get_user_model()
+
+# Minimum detector confidence for a face to be kept
+MIN_FACE_CONFIDENCE = 0.9
+
+
+def read_image(image_path):
+    """Decode an image file to a BGR array (None if it cannot be read)."""
+    return cv2.imread(image_path)
+
+
+def full_image_loader(photo, scale):
+    """
+    Loader of the original photo for face crops, or None when `scale` shows
+    the analyzed image already is the original, so it is not decoded twice.
+    """
+    if scale == 1.0:
+        return None
+    return lambda: read_image(photo.image.path)
+
+
+def save_photo_results(photo, quality_score, detected_faces, scene_tags, features=None):
+    """Write all analysis results to the photo in a single update, and its measured features."""
+    if features is not None:
+        save_photo_features(photo, features)
+
+    photo.processed = True
+    photo.quality_score = quality_score
+    photo.detected_faces = detected_faces
+    photo.scene_tags = scene_tags
+    photo.save(update_fields=['processed', 'quality_score', 'detected_faces', 'scene_tags'])
+    logger.info(f"Updated photo {photo.id} with processing results")
+
+    # Create enhanced version if quality is below threshold
+    if quality_score < 0.7:  # Threshold can be adjusted
+        enhance_photo_task.delay(photo.id)
+
+
+def analyze_image_quality(image, features=None):
+    """Analyze image quality metrics and return a score from 0-1 (from `features` when measured)."""
+    try:
+        if features is None:
+            features = measure_photo(image)
+        
+        # Sharpness from the Laplacian variance
+        sharpness_score = min(features['sharpness'] / 1000, 1.0)  # Normalize to 0-1
+        
+        # Brightness and contrast of the grayscale image
+        brightness = features['brightness'] / 255.0
+        contrast = features['contrast'] / 128.0
+        
+        # Combined quality score (with weights)
+        quality_score = (0.5 * sharpness_score + 0.25 * (1 - abs(0.5 - brightness) * 2) + 
+                         0.25 * min(contrast, 1.0))
+        
+        return round(quality_score, 2)
+    
+    except Exception as e:
+        logger.error(f"Error analyzing image quality: {str(e)}")
+        return 0.5  # Default middle score on error
+
+
+def preprocess_image(img_path, output_path=None):
+    """Preprocess images to improve face recognition accuracy."""
+    try:
+        img = cv2.imread(img_path)
+        if img is None:
+            logger.error(f"Failed to load image at {img_path}")
+            return img_path
+            
+        # Apply preprocessing steps
+        # Convert to grayscale
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        
+        # Apply histogram equalization to improve contrast
+        equalized = cv2.equalizeHist(gray)
+        
+        # Determine output path
+        if output_path is None:
+            output_path = img_path.replace('.jpg', '_preprocessed.jpg')
+            output_path = output_path.replace('.png', '_preprocessed.png')
+            
+        # Save preprocessed image
+        cv2.imwrite(output_path, equalized)
+        logger.info(f"Preprocessed image saved to {output_path}")
+        return output_path
+        
+    except Exception as e:
+        logger.error(f"Error preprocessing image {img_path}: {str(e)}")
+        return img_path  # Return original path if preprocessing fails
+
+
+def align_face(face_img):
+    """Align face using facial landmarks."""
+    try:
+        # Convert to RGB for face_recognition
+        rgb_face = cv2.cvtColor(face_img, cv2.COLOR_BGR2RGB)
+        
+        # Detect landmarks
+        face_landmarks_list = model_registry.face_recognition.face_landmarks(rgb_face)
+        
+        if not face_landmarks_list:
+            logger.warning("No landmarks detected for face alignment")
+            return face_img
+            
+        landmarks = face_landmarks_list[0]
+        
+        # Get eye coordinates
+        left_eye = np.mean(np.array(landmarks['left_eye']), axis=0).astype(int)
+        right_eye = np.mean(np.array(landmarks['right_eye']), axis=0).astype(int)
+        
+        # Calculate angle
+        dY = right_eye[1] - left_eye[1]
+        dX = right_eye[0] - left_eye[0]
+        angle = np.degrees(np.arctan2(dY, dX))
+        
+        # Get the center of the image
+        (h, w) = face_img.shape[:2]
+        center = (w // 2, h // 2)
+        
+        # Get rotation matrix
+        M = cv2.getRotationMatrix2D(center, angle, 1.0)
+        
+        # Apply rotation
+        aligned_face = cv2.warpAffine(face_img, M, (w, h), flags=cv2.INTER_CUBIC)
+        
+        return aligned_face
+        
+    except Exception as e:
+        logger.error(f"Error aligning face: {str(e)}")
+        return face_img  # Return original face if alignment fails
+
+
+def preprocess_event_users(event_id):
+    """Load face encodings of all event users from the persistent embedding store."""
+    try:
+        # Get all users with profile pictures for this event
+        event_users = list(User.objects.filter(
+            Q(organized_events__id=event_id) | 
+            Q(eventcrew__event__id=event_id) |
+            Q(eventparticipant__event__id=event_id)
+        ).exclude(avatar='').exclude(avatar__isnull=True).distinct())
+
+        user_data, processed_ids = get_stored_user_embeddings(user.id for user in event_users)
+
+        # Avatars that were never processed (e.g. uploaded before the store existed)
+        pending_users = [user for user in event_users if user.id not in processed_ids]
+        if pending_users:
+            logger.info(f"Computing avatar embeddings for {len(pending_users)} of {len(event_users)} event users")
+
+            with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+                future_to_user = {executor.submit(update_user_embeddings, user): user for user in pending_users}
+
+                for future in concurrent.futures.as_completed(future_to_user):
+                    user = future_to_user[future]
+                    try:
+                        result = future.result()
+                        if result:
+                            user_data[user.id] = result
+                    except Exception as e:
+                        logger.error(f"Error preprocessing user {user.username}: {str(e)}")
+
+        logger.info(f"Loaded face encodings for {len(user_data)} of {len(event_users)} event users")
+        return user_data
+
+    except Exception as e:
+        logger.error(f"Error preprocessing event users: {str(e)}")
+        return {}
+
+
+def update_user_embeddings(user, force=False):
+    """Compute and store the avatar embeddings of a user if the avatar changed."""
+    avatar_hash = avatar_content_hash(user)
+    if avatar_hash is None:
+        return None
+
+    if not force and has_current_embeddings(user, avatar_hash):
+        user_data, _ = get_stored_user_embeddings([user.id])
+        return user_data.get(user.id)
+
+    debug_dir = os.path.join(settings.MEDIA_ROOT, 'debug_faces')
+    os.makedirs(debug_dir, exist_ok=True)
+
+    result = preprocess_user(user, debug_dir=debug_dir)
+    save_user_embeddings(user, avatar_hash, result)
+    return result
+
+
+def preprocess_user(user, temp_dir=None, debug_dir=None):
+    """Compute face_recognition and DeepFace encodings for a user's avatar."""
+    if not user.avatar:
+        return None
+
+    avatar_path = os.path.join(settings.MEDIA_ROOT, str(user.avatar))
+    if not os.path.exists(avatar_path):
+        logger.warning(f"Avatar not found for user {user.username}: {avatar_path}")
+        return None
+
+    image = cv2.imread(avatar_path)
+    if image is None:
+        logger.error(f"Failed to load avatar at {avatar_path}")
+        return None
+
+    # face_recognition encoding of the first face in the avatar
+    fr_encoding = None
+    rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    face_locations = model_registry.face_recognition.face_locations(rgb_image)
+    if face_locations:
+        encodings = model_registry.face_recognition.face_encodings(rgb_image, face_locations)
+        if encodings:
+            fr_encoding = encodings[0]
+
+        # Keep a crop of the avatar face for debugging matches
+        if debug_dir:
+            top, right, bottom, left = face_locations[0]
+            cv2.imwrite(os.path.join(debug_dir, f"user_{user.id}.jpg"), image[top:bottom, left:right])
+
+    # DeepFace embeddings for every configured model
+    deepface_representations = {}
+    for model_name in model_registry.embedding_models:
+        try:
+            representations = model_registry.represent(
+                image, model_name, detector_backend=model_registry.detector_backend, align=True
+            )
+            if representations:
+                deepface_representations[model_name] = representations[0]['embedding']
+        except Exception as e:
+            logger.warning(f"Could not compute {model_name} embedding for user {user.username}: {str(e)}")
+
+    if fr_encoding is None and not deepface_representations:
+        logger.warning(f"No face found in avatar of user {user.username}")
+        return None
+
+    return {
+        'user_id': user.id,
+        'face_recognition_encoding': fr_encoding,
+        'deepface_representations': deepface_representations,
+    }
+
+
+def detect_faces_in_image(image, photo_id, scale=1.0, load_full_image=None):
+    """
+    Detect faces in an already decoded BGR image and match them with event users.
+
+    `scale` maps pixel coordinates of `image` to the original photo. When
+    `load_full_image` is given it is called once, only if a face was found,
+    to get the full-resolution image the embedding crops are taken from.
+    """
+    try:
+        photo = EventPhoto.objects.get(id=photo_id)
+
+        # Encodings of everyone registered for the event, from the embedding store
+        event_users_data = preprocess_event_users(photo.event_id)
+
+        matcher = build_event_matcher(photo.event_id, event_users_data)
+
+        face_objects, aligned_faces, fr_encodings = locate_faces(image, photo_id, scale, load_full_image)
+        representations = cascade_embed_faces(aligned_faces, [matcher] * len(aligned_faces))
+        face_reps = build_face_reps(fr_encodings, representations)
+
+        return match_detected_faces(photo, face_objects, face_reps, event_users_data, matcher=matcher)
+
+    except Exception as e:
+        logger.error(f"Error in optimized face detection: {str(e)}", exc_info=True)
+        return []
+
+
+def locate_faces(image, photo_id, scale=1.0, load_full_image=None):
+    """
+    Detect faces and prepare them for embedding.
+
+    Returns (face_objects, aligned_faces, fr_encodings): the detected_faces
+    entries in original image coordinates, the aligned BGR crop of each face
+    and its face_recognition encoding (or None).
+    """
+    try:
+        faces = model_registry.extract_faces(image, align=True)
+    except Exception as e:
+        logger.error(f"Face extraction failed for photo {photo_id}: {str(e)}")
+        return [], [], []
+
+    full_image = None
+    rgb_image = None
+    face_objects = []
+    aligned_faces = []
+    fr_encodings = []
+
+    for face in faces:
+        area = face.get('facial_area', {})
+        detection_confidence = float(face.get('confidence') or 0)
+
+        # Without enforce_detection DeepFace returns the whole frame when no face is found
+        if not area.get('w') or not area.get('h') or detection_confidence < MIN_FACE_CONFIDENCE:
+            continue
+
+        if full_image is None:
+            full_image = load_full_image() if load_full_image else None
+            crop_scale = scale
+            if full_image is None:
+                # Crop from the image we were given
+                full_image, crop_scale = image, 1.0
+            rgb_image = cv2.cvtColor(full_image, cv2.COLOR_BGR2RGB)
+
+        # Face box in original image coordinates
+        x = max(0, int(area.get('x', 0) * scale))
+        y = max(0, int(area.get('y', 0) * scale))
+        w, h = int(area['w'] * scale), int(area['h'] * scale)
+
+        # Face box in the image the crops are taken from
+        cx = max(0, int(area.get('x', 0) * crop_scale))
+        cy = max(0, int(area.get('y', 0) * crop_scale))
+        cw, ch = int(area['w'] * crop_scale), int(area['h'] * crop_scale)
+
+        face_img = full_image[cy:cy + ch, cx:cx + cw]
+        aligned_faces.append(align_face(face_img))
+
+        encodings = model_registry.face_recognition.face_encodings(rgb_image, [(cy, cx + cw, cy + ch, cx)])
+        fr_encodings.append(encodings[0] if encodings else None)
+
+        face_objects.append({
+            'face_id': len(face_objects),
+            'position': {'x': x, 'y': y, 'width': w, 'height': h},
+            'x': x,
+            'y': y,
+            'width': w,
+            'height': h,
+            'detection_confidence': round(detection_confidence, 3),
+            'user_id': None,
+        })
+
+    logger.info(f"Detected {len(face_objects)} faces in photo {photo_id}")
+    return face_objects, aligned_faces, fr_encodings
+
+
+def embed_faces(aligned_faces, batch_size=None, model_names=None):
+    """DeepFace embeddings of every face for each model (default: all configured), batched per model."""
+    representations = [{} for _ in aligned_faces]
+    if not aligned_faces:
+        return representations
+
+    for model_name in model_registry.embedding_models if model_names is None else model_names:
+        try:
+            embeddings = model_registry.represent_batch(aligned_faces, model_name, batch_size=batch_size)
+        except Exception as e:
+            logger.warning(f"Batched {model_name} embedding failed, embedding faces one by one: {str(e)}")
+            embeddings = []
+            for face in aligned_faces:
+                try:
+                    result = model_registry.represent(face, model_name, detector_backend='skip')
+                    embeddings.append(result[0]['embedding'] if result else None)
+                except Exception as e:
+                    logger.warning(f"{model_name} embedding failed for a face: {str(e)}")
+                    embeddings.append(None)
+
+        for face_representations, embedding in zip(representations, embeddings):
+            if embedding is not None:
+                face_representations[model_name] = embedding
+
+    return representations
+
+
+def cascade_embed_faces(aligned_faces, matchers, batch_size=None, stages=None, record_stats=True):
+    """
+    Embed faces model by model, in FACE_MODEL_CASCADE order.
+
+    `matchers` holds the EventFaceMatcher (or None) of each face. After each
+    stage the faces its model matched decisively are settled, and only the
+    others are embedded with the next, more expensive model. Faces without
+    users to match against go through every stage, so their stored
+    embeddings stay complete for later participants.
+    """
+    representations = [{} for _ in aligned_faces]
+    if stages is None:
+        stages = get_cascade_stages(model_registry.embedding_models)
+    face_reps = [{'deepface_representations': reps} for reps in representations]
+    pending = list(range(len(aligned_faces)))
+
+    for stage, (model_name, margin) in enumerate(stages):
+        if not pending:
+            break
+
+        embeddings = embed_faces([aligned_faces[i] for i in pending], batch_size, model_names=[model_name])
+        for i, embedding in zip(pending, embeddings):
+            representations[i].update(embedding)
+
+        settled = set()
+        if margin is not None and stage < len(stages) - 1:
+            by_matcher = {}
+            for i in pending:
+                if matchers[i] is not None:
+                    by_matcher.setdefault(id(matchers[i]), (matchers[i], []))[1].append(i)
+            for matcher, face_indexes in by_matcher.values():
+                try:
+                    settled |= matcher.decisive_faces(model_name, face_reps, face_indexes, margin)
+                except Exception as e:
+                    logger.error(f"Cascade decision with {model_name} failed, escalating faces: {str(e)}")
+
+        if record_stats:
+            record_cascade_stage(model_name, len(pending), len(settled))
+        logger.debug(f"Cascade stage {model_name}: {len(pending)} faces embedded, {len(settled)} settled")
+        pending = [i for i in pending if i not in settled]
+
+    return representations
+
+
+def build_face_reps(fr_encodings, deepface_representations):
+    """Face representations in the format the matcher and the embedding store use."""
+    return [
+        {
+            'index': index,
+            'face_recognition_encoding': fr_encoding,
+            'deepface_representations': representations,
+        }
+        for index, (fr_encoding, representations) in enumerate(zip(fr_encodings, deepface_representations))
+    ]
+
+
+def build_event_matcher(event_id, event_users_data):
+    """Matcher over the users of an event, or None when nobody has an embedding."""
+    if not event_users_data:
+        return None
+
+    # Large events search per-model ANN indexes instead of every user
+    ann_indexes = get_event_indexes(event_id, event_users_data, model_registry.embedding_models)
+    return EventFaceMatcher(
+        event_users_data,
+        ann_indexes=ann_indexes,
+        ann_probes=getattr(settings, 'FACE_ANN_PROBES', None),
+    )
+
+
+def match_detected_faces(photo, face_objects, face_reps, event_users_data, matcher=None):
+    """Store the face embeddings of a photo and match its faces with event users."""
+    # Keep the embeddings so that later participants can be matched without re-detection
+    try:
+        save_photo_face_embeddings(photo, face_reps)
+    except Exception as e:
+        logger.error(f"Error storing face embeddings of photo {photo.id}: {str(e)}")
+
+    if face_reps and event_users_data:
+        if matcher is None:
+            matcher = build_event_matcher(photo.event_id, event_users_data)
+        matches = matcher.match_faces(face_reps)
+
+        for face_index, match_result in enumerate(matches):
+            if not match_result:
+                continue
+            try:
+                face_objects[face_index].update({
+                    'user_id': match_result['user_id'],
+                    'confidence': float(match_result['confidence']),
+                    'matched_by': match_result['matched_by'],
+                })
+                UserPhotoMatch.objects.update_or_create(
+                    photo=photo,
+                    user=User.objects.get(id=match_result['user_id']),
+                    defaults={'confidence_score': float(match_result['confidence'])}
+                )
+            except Exception as e:
+                logger.error(f"Error processing match result for face {face_index}: {str(e)}")
+
+    # Log results
+    matches_found = sum(1 for face in face_objects if face.get('user_id') is not None)
+    logger.info(f"Found {matches_found} matches out of {len(face_objects)} faces")
+    return face_objects
+
+
+def process_photo_batch(photo_ids, batch_size=None):
+    """
+    Analyze a chunk of photos, running each embedding model once over all their faces.
+
+    Quality, tags and detection run per photo; the aligned face crops of the
+    whole chunk are then embedded in batches and the results scattered back
+    to each photo. Returns the number of photos processed.
+    """
+    photos = EventPhoto.objects.filter(id__in=photo_ids, processed=False).select_related('event')
+
+    prepared = []
+    for photo in photos:
+        try:
+            create_analysis_proxy(photo)
+            image = load_analysis_proxy(photo)
+            event_type = getattr(photo.event, 'event_type', None)
+
+            scale = proxy_scale(photo, image.shape[1])
+
+            face_objects, aligned_faces, fr_encodings = locate_faces(
+                image, photo.id,
+                scale=scale,
+                load_full_image=full_image_loader(photo, scale)
+            )
+            features = measure_photo(image, face_boxes_of(face_objects), scale)
+            prepared.append({
+                'photo': photo,
+                'features': features,
+                'quality_score': analyze_image_quality(image, features),
+                'scene_tags': generate_tags(image, event_type, features, scale),
+                'face_objects': face_objects,
+                'aligned_faces': aligned_faces,
+                'fr_encodings': fr_encodings,
+            })
+        except Exception as e:
+            logger.error(f"Error analyzing photo {photo.id} in batch: {str(e)}", exc_info=True)
+
+    # Users and matcher of every event in the chunk, needed by the cascade
+    event_users = {}
+    matchers = {}
+    for item in prepared:
+        event_id = item['photo'].event_id
+        if event_id in event_users:
+            continue
+        try:
+            event_users[event_id] = preprocess_event_users(event_id)
+            matchers[event_id] = build_event_matcher(event_id, event_users[event_id])
+        except Exception as e:
+            logger.error(f"Error loading users of event {event_id}: {str(e)}", exc_info=True)
+            event_users[event_id], matchers[event_id] = {}, None
+
+    # One pass per cascade stage over the faces of every photo in the chunk
+    all_faces = [face for item in prepared for face in item['aligned_faces']]
+    face_matchers = [matchers[item['photo'].event_id] for item in prepared for _ in item['aligned_faces']]
+    all_representations = cascade_embed_faces(all_faces, face_matchers, batch_size=batch_size)
+    logger.info(f"Embedded {len(all_faces)} faces from {len(prepared)} photos in one batch")
+
+    offset = 0
+    for item in prepared:
+        photo = item['photo']
+        count = len(item['aligned_faces'])
+        representations = all_representations[offset:offset + count]
+        offset += count
+
+        try:
+            face_reps = build_face_reps(item['fr_encodings'], representations)
+            detected_faces = match_detected_faces(
+                photo, item['face_objects'], face_reps, event_users[photo.event_id],
+                matcher=matchers[photo.event_id],
+            )
+            save_photo_results(
+                photo, item['quality_score'], detected_faces, item['scene_tags'], features=item['features']
+            )
+        except Exception as e:
+            logger.error(f"Error saving batch results for photo {photo.id}: {str(e)}", exc_info=True)
+
+    return len(prepared)
+
+
+def match_face_with_users(face_rep, event_users_data):
+    """Match a single face with all event users."""
+    try:
+        return EventFaceMatcher(event_users_data).match_face(face_rep)
+    except Exception as e:
+        logger.error(f"Error in match_face_with_users: {str(e)}")
+        return None
+
+
+def generate_tags(image, event_type, features=None, scale=1.0):
+    """
+    Generate tags based on image content and event type.
+    Uses multiple detection techniques to provide rich scene understanding.
+    Measurements already in `features` are not computed again. `scale` maps
+    pixels of `image` to original pixels, so the pixel thresholds tuned on
+    full-resolution photos give the same tags on the analysis proxy.
+    """
+    import numpy as np
+    import cv2
+    from sklearn.cluster import KMeans
+    import logging
+
+    logger = logging.getLogger(__name__)
+    tags = []
+    
+    # 1. Add event type as a tag
+    if event_type:
+        tags.append(event_type.lower())
+    
+    try:
+        # 2. Advanced scene analysis
+        hsv_image = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+        h_channel, s_channel, v_channel = cv2.split(hsv_image)
+        
+        # 2.1 Indoor/Outdoor detection
+        # Check for sky presence (blue color)
+        blue_mask = cv2.inRange(hsv_image, (100, 50, 50), (130, 255, 255))
+        blue_ratio = cv2.countNonZero(blue_mask) / (image.shape[0] * image.shape[1])
+        
+        # Check for green (vegetation)
+        green_mask = cv2.inRange(hsv_image, (35, 50, 50), (85, 255, 255))
+        green_ratio = cv2.countNonZero(green_mask) / (image.shape[0] * image.shape[1])
+        
+        # Combined outdoor indicators
+        if blue_ratio > 0.15 or green_ratio > 0.2:
+            tags.append("outdoor")
+            
+            # Add nature tags if significant greenery
+            if green_ratio > 0.3:
+                tags.append("nature")
+                
+            # Check for beach/water scene
+            if blue_ratio > 0.25:
+                # Water and sand detection
+                sand_mask = cv2.inRange(hsv_image, (20, 10, 180), (40, 60, 255))
+                sand_ratio = cv2.countNonZero(sand_mask) / (image.shape[0] * image.shape[1])
+                
+                if sand_ratio > 0.1:
+                    tags.append("beach")
+                elif blue_ratio > 0.35:
+                    tags.append("water")
+        else:
+            tags.append("indoor")
+            
+            # Check for indoor venue characteristics
+            # Detect stage/performance setting
+            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+            edges = cv2.Canny(gray, 50, 150)
+            
+            # Check for strong horizontal/vertical lines (typical in indoor venues)
+            lines = cv2.HoughLinesP(
+                edges, 1, np.pi/180,
+                threshold=max(1, round(100 / scale)), minLineLength=100 / scale, maxLineGap=10 / scale
+            )
+            if lines is not None and len(lines) > 10:
+                horizontal_lines = 0
+                vertical_lines = 0
+                
+                for line in lines:
+                    x1, y1, x2, y2 = line[0]
+                    if abs(y2 - y1) < 20 / scale:  # Horizontal line
+                        horizontal_lines += 1
+                    if abs(x2 - x1) < 20 / scale:  # Vertical line
+                        vertical_lines += 1
+                
+                if horizontal_lines > 5 and vertical_lines > 5:
+                    tags.append("venue")
+        
+        # 2.2 Time of day detection
+        avg_brightness = np.mean(v_channel)
+        if avg_brightness < 70:
+            tags.append("night")
+            tags.append("dark")
+        elif avg_brightness < 120:
+            # Check color temperature for sunset/sunrise
+            if np.mean(h_channel) > 10 and np.mean(h_channel) < 30:
+                tags.append("sunset")
+            else:
+                tags.append("dim")
+        elif avg_brightness > 200:
+            tags.append("bright")
+        
+        # 2.3 Color palette analysis
+        # Resize image for faster processing
+        small_image = cv2.resize(image, (100, 100))
+        pixels = small_image.reshape(-1, 3)
+        
+        # Extract dominant colors using K-means
+        kmeans = KMeans(n_clusters=3)
+        kmeans.fit(pixels)
+        dominant_colors = kmeans.cluster_centers_
+        
+        # Check for vibrant colors
+        saturation_values = []
+        for color in dominant_colors:
+            b, g, r = color
+            color_hsv = cv2.cvtColor(np.uint8([[[b, g, r]]]), cv2.COLOR_BGR2HSV)[0][0]
+            saturation_values.append(color_hsv[1])
+        
+        avg_saturation = np.mean(saturation_values)
+        if avg_saturation > 150:
+            tags.append("colorful")
+        elif avg_saturation < 70:
+            tags.append("muted")
+        
+        # 2.4 Detect crowd density
+        # Use face detection to approximate crowd
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+        faces = face_cascade.detectMultiScale(gray, 1.3, 5)
+        
+        if len(faces) > 10:
+            tags.append("crowd")
+        elif len(faces) > 5:
+            tags.append("group")
+        elif len(faces) > 0:
+            tags.append("people")
+        
+        # 2.5 Context-specific tags based on event_type
+        if event_type:
+            event_type_lower = event_type.lower()
+            
+            # Wedding specific
+            if "wedding" in event_type_lower:
+                # Detect white (bride's dress)
+                white_mask = cv2.inRange(image, (200, 200, 200), (255, 255, 255))
+                white_ratio = cv2.countNonZero(white_mask) / (image.shape[0] * image.shape[1])
+                
+                if white_ratio > 0.15:
+                    tags.append("ceremony")
+                
+                # Check for specific colors associated with weddings
+                if is_color_present(image, (0, 0, 128), 0.1):  # Dark blue
+                    tags.append("formal")
+            
+            # Concert/music specific
+            elif "concert" in event_type_lower or "music" in event_type_lower:
+                # Detect stage lighting (bright spots in dark environment)
+                if "dark" in tags or "night" in tags:
+                    # Find bright spots in dark setting
+                    bright_spots = cv2.threshold(v_channel, 200, 255, cv2.THRESH_BINARY)[1]
+                    bright_ratio = cv2.countNonZero(bright_spots) / (image.shape[0] * image.shape[1])
+                    
+                    if bright_ratio > 0.05 and bright_ratio < 0.3:
+                        tags.append("stage_lighting")
+                        tags.append("performance")
+            
+            # Sports specific
+            elif "sports" in event_type_lower or "game" in event_type_lower:
+                # Detect green field
+                if green_ratio > 0.4:
+                    tags.append("field")
+                
+                # Detect stadium features
+                if "crowd" in tags and "outdoor" in tags:
+                    tags.append("stadium")
+            
+            # Conference specific
+            elif "conference" in event_type_lower or "meeting" in event_type_lower:
+                # Detect presentation screens
+                # Look for bright rectangular regions
+                if "indoor" in tags:
+                    # Simple screen detection using contours
+                    _, thresh = cv2.threshold(gray, 200, 255, cv2.THRESH_BINARY)
+                    contours, _ = cv2.findContours(thresh, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+                    
+                    for contour in contours:
+                        x, y, w, h = cv2.boundingRect(contour)
+                        aspect_ratio = float(w) / h
+                        
+                        # Screen-like aspect ratio and minimum size
+                        if 1.2 < aspect_ratio < 2.0 and w > image.shape[1] / 5:
+                            tags.append("presentation")
+                            break
+        
+        # 3. Detection of specific compositions
+        # Check for food
+        if event_type and ("dinner" in event_type.lower() or "reception" in event_type.lower() or 
+                           "party" in event_type.lower() or "banquet" in event_type.lower()):
+            # Simple food detection based on color patterns and textures
+            # This is very basic - real production would use a trained model
+            saturation_mean = np.mean(s_channel)
+            saturation_std = np.std(s_channel)
+            
+            # Food often has varied colors and textures
+            if saturation_mean > 80 and saturation_std > 40 and "people" not in tags:
+                tags.append("food")
+                
+        # 4. Quality-based tags
+        # Calculate blur using Laplacian variance
+        if features is not None:
+            laplacian_var = features['sharpness']
+        else:
+            laplacian_var = cv2.Laplacian(gray, cv2.CV_64F).var()
+        if laplacian_var < 100:
+            tags.append("blurry")
+        elif laplacian_var > 500:
+            tags.append("sharp")
+        
+        # Check if it's a portrait-style photo
+        if len(faces) == 1:
+            face_area = faces[0][2] * faces[0][3]
+            image_area = image.shape[0] * image.shape[1]
+            
+            if face_area / image_area > 0.15:
+                tags.append("portrait")
+            
+        # 5. Common objects detection
+        # In production, you'd use a model like YOLO or SSD
+        # This is a simplified approximation
+        
+        # Add other contextual tags based on event type
+        if event_type:
+            event_lower = event_type.lower()
+            
+            event_tag_map = {
+                'birthday': ['celebration', 'party'],
+                'wedding': ['celebration', 'ceremony'],
+                'corporate': ['business', 'professional'],
+                'conference': ['business', 'presentation'],
+                'concert': ['entertainment', 'music'],
+                'festival': ['celebration', 'entertainment'],
+                'sports': ['athletic', 'competition'],
+                'party': ['celebration', 'social'],
+                'graduation': ['academic', 'ceremony'],
+                'reunion': ['social', 'gathering']
+            }
+            
+            # Add relevant tags based on event type
+            for key, value_tags in event_tag_map.items():
+                if key in event_lower:
+                    tags.extend(value_tags)
+        
+    except Exception as e:
+        logger.error(f"Error in tag generation: {str(e)}", exc_info=True)
+        # Add default tags if analysis fails
+        if not any(tag in tags for tag in ['indoor', 'outdoor']):
+            tags.append("indoor")
+    
+    # Return unique tags (remove duplicates)
+    return list(set(tags))
+
+
+def is_color_present(image, color_bgr, min_ratio=0.05):
+    """Check if a specific color is present in significant amount in the image"""
+    # Convert BGR color to a range
+    lower_bound = np.array([max(0, c - 30) for c in color_bgr])
+    upper_bound = np.array([min(255, c + 30) for c in color_bgr])
+    
+    # Create a mask for the color
+    mask = cv2.inRange(image, lower_bound, upper_bound)
+    ratio = cv2.countNonZero(mask) / (image.shape[0] * image.shape[1])
+    
+    return ratio > min_ratio
+
+
+def enhance_photo(photo):
+    """Create an enhanced version of a low-quality photo."""
+    try:
+        # Open the image with PIL
+        image_path = photo.image.path
+        img = Image.open(image_path)
+        
+        # Get the directory and filename
+        directory, filename = os.path.split(image_path)
+        base_name, extension = os.path.splitext(filename)
+        
+        # Create the directory if it doesn't exist
+        os.makedirs(directory, exist_ok=True)
+        
+        enhanced_filename = f"{base_name}_enhanced{extension}"
+        enhanced_path = os.path.join(directory, enhanced_filename)
+        
+        # Apply enhancements
+        img = ImageEnhance.Contrast(img).enhance(1.2)  # Increase contrast
+        img = ImageEnhance.Brightness(img).enhance(1.1)  # Slight brightness boost
+        img = ImageEnhance.Sharpness(img).enhance(1.5)  # Sharpen
+        
+        # Save the enhanced image
+        img.save(enhanced_path)
+        
+        # Update the photo model with enhanced image path
+        relative_path = os.path.relpath(enhanced_path, settings.MEDIA_ROOT)
+        photo.enhanced_image = relative_path
+        photo.save(update_fields=['enhanced_image'])
+        
+    except Exception as e:
+        logger.error(f"Error enhancing photo: {str(e)}")
@@ -0,0 +1,119 @@
+# photos/proxies.py
+"""
+Analysis proxies: one bounded-size JPEG per EventPhoto.
+
+Analyzers (quality, tags, face detection, highlights, duplicates, privacy)
+read the proxy instead of decoding the full-resolution original. The proxy
+is decoded with JPEG draft mode, so building it only costs a DCT-scaled
+decode of the original.
+"""
+import io
+import logging
+
+import numpy as np # type: ignore
+from PIL import Image, ImageOps
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db.models import Q
+
+from .exif import read_capture_info
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PROXY_MAX_SIZE = 1600
+DEFAULT_PROXY_QUALITY = 90
+
+
+def get_proxy_max_size():
+    return getattr(settings, 'ANALYSIS_PROXY_MAX_SIZE', DEFAULT_PROXY_MAX_SIZE)
+
+
+def render_analysis_proxy(image_path, max_size=None):
+    """Decode an image at reduced size and return (proxy, original_size, capture_info)."""
+    max_size = max_size or get_proxy_max_size()
+
+    img = Image.open(image_path)
+    capture_info = read_capture_info(img, image_path)
+
+    # Original dimensions as cv2.imread sees them (EXIF orientation applied)
+    width, height = img.size
+    if img.getexif().get(0x0112, 1) in (5, 6, 7, 8):
+        width, height = height, width
+
+    # Let the JPEG decoder scale in the DCT domain (1/2, 1/4, 1/8)
+    # instead of decoding every pixel of the original
+    img.draft('RGB', (max_size, max_size))
+
+    img.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
+    img = ImageOps.exif_transpose(img).convert('RGB')
+
+    return img, (width, height), capture_info
+
+
+def create_analysis_proxy(photo, force=False):
+    """
+    Write the analysis proxy for a photo and record the original dimensions and capture metadata.
+
+    process_photo and the post_save pipeline can render a proxy for the same
+    photo at once; the proxy is only recorded if the photo still has the one
+    it had when rendering started, and the loser removes its own file.
+    """
+    if photo.analysis_proxy and not force:
+        return photo.analysis_proxy
+
+    previous = photo.analysis_proxy.name if photo.analysis_proxy else None
+    proxy, (width, height), capture_info = render_analysis_proxy(photo.image.path)
+
+    buffer = io.BytesIO()
+    proxy.save(buffer, format='JPEG',
+               quality=getattr(settings, 'ANALYSIS_PROXY_QUALITY', DEFAULT_PROXY_QUALITY))
+
+    photo.analysis_proxy.save(f"{photo.id}_proxy.jpg", ContentFile(buffer.getvalue()), save=False)
+
+    # Queryset update so that derived data does not fire the post_save pipeline again
+    unchanged = Q(analysis_proxy=previous) if previous else Q(analysis_proxy__isnull=True) | Q(analysis_proxy='')
+    updated = type(photo).objects.filter(unchanged, id=photo.id).update(
+        analysis_proxy=photo.analysis_proxy.name,
+        image_width=width,
+        image_height=height,
+        **capture_info,
+    )
+    if not updated:
+        logger.info(f"Analysis proxy of photo {photo.id} was created concurrently, keeping that one")
+        photo.analysis_proxy.storage.delete(photo.analysis_proxy.name)
+        photo.refresh_from_db(fields=['analysis_proxy', 'image_width', 'image_height', *capture_info])
+        return photo.analysis_proxy
+
+    if previous:
+        photo.analysis_proxy.storage.delete(previous)
+    photo.image_width = width
+    photo.image_height = height
+    for field, value in capture_info.items():
+        setattr(photo, field, value)
+
+    logger.info(f"Created analysis proxy {proxy.size} for photo {photo.id} ({width}x{height})")
+    return photo.analysis_proxy
+
+
+def open_analysis_proxy(photo):
+    """Return the analysis proxy of a photo as an RGB PIL image."""
+    try:
+        create_analysis_proxy(photo)
+        return Image.open(photo.analysis_proxy.path).convert('RGB')
+    except (OSError, ValueError) as e:
+        logger.warning(f"Analysis proxy unavailable for photo {photo.id}, using original: {str(e)}")
+        proxy, (photo.image_width, photo.image_height), _ = render_analysis_proxy(photo.image.path)
+        return proxy
+
+
+def load_analysis_proxy(photo):
+    """Return the analysis proxy of a photo as a BGR array for OpenCV analyzers."""
+    rgb = np.asarray(open_analysis_proxy(photo))
+    return np.ascontiguousarray(rgb[:, :, ::-1])
+
+
+def proxy_scale(photo, proxy_width):
+    """Factor that maps proxy pixel coordinates to original pixel coordinates."""
+    if not photo.image_width or not proxy_width:
+        return 1.0
+    return photo.image_width / proxy_width
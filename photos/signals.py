@@ -0,0 +1,20 @@
+# photos/signals.py
+from django.db.models.signals import post_init, post_save
+from django.dispatch import receiver
+from events.models import EventParticipant
+from .tasks import add_participants_to_ann_index, match_user_to_event_faces
+
+@receiver(post_init, sender=EventParticipant)
+def remember_participant_user(sender, instance, **kwargs):
+    """Keep the loaded user to detect participants linked to an account later."""
+    instance._original_user_id = instance.__dict__.get('user_id')
+
+@receiver(post_save, sender=EventParticipant)
+def participant_post_save(sender, instance, created, **kwargs):
+    """Add registered participants to the event's face index and find them in existing photos."""
+    user_changed = instance.user_id != getattr(instance, '_original_user_id', None)
+    instance._original_user_id = instance.user_id
+
+    if instance.user_id and (created or user_changed):
+        add_participants_to_ann_index.delay(instance.event_id, [instance.user_id])
+        match_user_to_event_faces.delay(instance.user_id, instance.event_id)
@@ -1,3 +1,864 @@
-from django.test import TestCase
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+from unittest.mock import MagicMock, patch
 
-# Create your tests here.
+import numpy as np # type: ignore
+from PIL import Image
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from events.models import Event
+from .ann import IVFIndex, sync_event_index
+from .cascade import get_cascade_stages
+from .matching import EventFaceMatcher
+from .exif import parse_exif_datetime, sequence_from_filename
+from .models import EventPhoto, PhotoFaceEmbedding, UserPhotoMatch, analysis_proxy_path
+from .proxies import create_analysis_proxy, load_analysis_proxy, proxy_scale
+from .tasks import assign_matched_faces
+from .transactions import run_in_transaction
+
+
+class WebImportBudgetTests(SimpleTestCase):
+    """The web process must not load the ML stack that only Celery workers use."""
+
+    HEAVY_MODULES = ['tensorflow', 'deepface', 'face_recognition', 'cv2']
+
+    def test_setup_and_urls_do_not_import_ml_libraries(self):
+        # A fresh interpreter, since the test process may have imported anything
+        script = (
+            "import json, os, sys\n"
+            "os.environ['DJANGO_SETTINGS_MODULE'] = 'SnapFlow.settings'\n"
+            "import django\n"
+            "django.setup()\n"
+            "from django.urls import get_resolver\n"
+            "get_resolver().url_patterns\n"
+            f"print(json.dumps([m for m in {self.HEAVY_MODULES!r} if m in sys.modules]))\n"
+        )
+        result = subprocess.run(
+            [sys.executable, '-c', script],
+            cwd=settings.BASE_DIR,
+            capture_output=True,
+            text=True,
+            timeout=120,
+        )
+
+        self.assertEqual(result.returncode, 0, result.stderr)
+        imported = json.loads(result.stdout.strip().splitlines()[-1])
+        self.assertEqual(imported, [], f"Web process imported {imported}")
+
+
+class WorkerWarmupTests(SimpleTestCase):
+    """Every worker process warms up the face models when it starts."""
+
+    def test_warm_up_receiver_is_connected_when_the_celery_app_loads(self):
+        # A fresh interpreter, importing only what a worker imports at boot
+        script = (
+            "import os\n"
+            "os.environ['DJANGO_SETTINGS_MODULE'] = 'SnapFlow.settings'\n"
+            "from SnapFlow.celery import app\n"
+            "import django\n"
+            "django.setup()\n"
+            "app.loader.import_default_modules()\n"
+            "from celery.signals import worker_process_init\n"
+            "receivers = [ref() for _, ref in worker_process_init.receivers]\n"
+            "print(sorted(f'{r.__module__}.{r.__name__}' for r in receivers if r is not None))\n"
+        )
+        result = subprocess.run(
+            [sys.executable, '-c', script],
+            cwd=settings.BASE_DIR,
+            capture_output=True,
+            text=True,
+            timeout=120,
+        )
+
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertIn('photos.ml.warm_up_models', result.stdout.strip().splitlines()[-1])
+
+
+class CaptureInfoTests(SimpleTestCase):
+    """EXIF capture times and frame numbers are parsed for burst detection."""
+
+    def test_capture_time_with_subseconds_and_offset(self):
+        taken_at = parse_exif_datetime('2025:06:14 18:30:05', '42', '+02:00')
+        self.assertEqual(taken_at.isoformat(), '2025-06-14T18:30:05.420000+02:00')
+
+    def test_capture_time_without_offset_is_aware(self):
+        self.assertIsNotNone(parse_exif_datetime(b'2025:06:14 18:30:05\x00').tzinfo)
+        self.assertIsNone(parse_exif_datetime('0000:00:00 00:00:00'))
+        self.assertIsNone(parse_exif_datetime(None))
+
+    def test_sequence_from_filename(self):
+        self.assertEqual(sequence_from_filename('events/1_x/photos/IMG_0423.JPG'), 423)
+        self.assertEqual(sequence_from_filename('IMG_0423_aB3dE9z.JPG'), 423)
+        self.assertIsNone(sequence_from_filename('party.jpg'))
+
+
+def make_matched_photo(faces):
+    User = get_user_model()
+    organizer = User.objects.create_user('organizer', 'organizer@example.com', 'password')
+    event = Event.objects.create(
+        title='Matching', description='Event', location='Hall', organizer=organizer,
+        start_date=timezone.now(), end_date=timezone.now(),
+    )
+    # bulk_create sends no post_save, so no ingestion is queued
+    photo, = EventPhoto.objects.bulk_create([EventPhoto(event=event, image='events/test/a.jpg', detected_faces=faces)])
+    return photo
+
+
+def match(confidence):
+    return {'confidence': confidence, 'matched_by': 'Facenet'}
+
+
+class FaceAssignmentTests(TestCase):
+    """Late matches take faces over from other users and update their photo matches."""
+
+    def setUp(self):
+        User = get_user_model()
+        self.user = User.objects.create_user('late', 'late@example.com', 'password')
+        self.other = User.objects.create_user('other', 'other@example.com', 'password')
+
+    def assign(self, photo, matches):
+        return run_in_transaction(assign_matched_faces, self.user, {photo.id: matches})
+
+    def test_displaced_user_loses_the_photo(self):
+        photo = make_matched_photo([{'face_id': 0, 'user_id': self.other.id, 'confidence': 40}])
+        UserPhotoMatch.objects.bulk_create([UserPhotoMatch(photo=photo, user=self.other, confidence_score=40)])
+
+        self.assertEqual(self.assign(photo, {0: match(80)}), 1)
+
+        photo.refresh_from_db()
+        self.assertEqual(photo.detected_faces[0]['user_id'], self.user.id)
+        self.assertEqual(
+            list(UserPhotoMatch.objects.filter(photo=photo).values_list('user_id', 'confidence_score')),
+            [(self.user.id, 80)],
+        )
+
+    def test_displaced_user_keeps_the_photo_through_another_face(self):
+        photo = make_matched_photo([
+            {'face_id': 0, 'user_id': self.other.id, 'confidence': 90},
+            {'face_id': 1, 'user_id': self.other.id, 'confidence': 40},
+        ])
+        UserPhotoMatch.objects.bulk_create([UserPhotoMatch(photo=photo, user=self.other, confidence_score=90)])
+
+        # The better-scored face stays with the other user
+        self.assertEqual(self.assign(photo, {0: match(80), 1: match(80)}), 1)
+
+        self.assertEqual([face['user_id'] for face in EventPhoto.objects.get(id=photo.id).detected_faces],
+                         [self.other.id, self.user.id])
+        self.assertEqual(UserPhotoMatch.objects.get(photo=photo, user=self.other).confidence_score, 90)
+
+
+class ConcurrentFaceAssignmentTests(TransactionTestCase):
+    """Two users matched on the same photo at once both keep their faces."""
+
+    def test_concurrent_assignments_are_merged(self):
+        User = get_user_model()
+        users = [User.objects.create_user(f'user{index}', f'user{index}@example.com', 'password') for index in range(2)]
+        photo = make_matched_photo([{'face_id': 0}, {'face_id': 1}])
+
+        # Both tasks read the photo before either writes
+        barrier = threading.Barrier(2)
+        bulk_update = EventPhoto.objects.bulk_update
+        waited = threading.local()
+
+        def bulk_update_after_both_read(*args, **kwargs):
+            if not getattr(waited, 'done', False):
+                waited.done = True
+                try:
+                    barrier.wait(timeout=5)
+                except threading.BrokenBarrierError:
+                    pass
+            return bulk_update(*args, **kwargs)
+
+        errors = []
+
+        def assign(user, face_id):
+            try:
+                run_in_transaction(assign_matched_faces, user, {photo.id: {face_id: match(80)}})
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        with patch.object(EventPhoto.objects, 'bulk_update', bulk_update_after_both_read):
+            threads = [threading.Thread(target=assign, args=(user, index)) for index, user in enumerate(users)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(errors, [])
+        photo.refresh_from_db()
+        self.assertEqual([face['user_id'] for face in photo.detected_faces], [user.id for user in users])
+        self.assertEqual(UserPhotoMatch.objects.filter(photo=photo).count(), 2)
+
+
+def clustered_embeddings(count, dimensions=64, clusters=40, seed=0):
+    """Normalized embeddings spread around random cluster centres, as face models produce."""
+    rng = np.random.default_rng(seed)
+    centres = rng.normal(size=(clusters, dimensions))
+    vectors = centres[rng.integers(clusters, size=count)] + rng.normal(scale=0.6, size=(count, dimensions))
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+
+class IVFIndexTests(SimpleTestCase):
+    """The IVF index finds the same best users as exact search and survives a save/load round trip."""
+
+    def setUp(self):
+        rng = np.random.default_rng(1)
+        self.vectors = clustered_embeddings(2000)
+        self.ids = np.arange(10000, 12000)
+        self.index = IVFIndex.build(self.ids, self.vectors)
+        # Faces of known users: their embedding with some noise
+        picked = rng.choice(len(self.vectors), 200, replace=False)
+        self.queries = self.vectors[picked] + rng.normal(scale=0.05, size=(200, self.vectors.shape[1]))
+        self.queries /= np.linalg.norm(self.queries, axis=1, keepdims=True)
+
+    def brute_force(self, queries):
+        scores = queries @ self.vectors.T
+        order = np.argsort(-scores, axis=1)
+        rows = np.arange(len(queries))
+        return self.ids[order[:, 0]], scores[rows, order[:, 0]], scores[rows, order[:, 1]]
+
+    def test_recall_against_brute_force(self):
+        expected_ids, _, _ = self.brute_force(self.queries)
+        found_ids, _ = self.index.search(self.queries, n_probe=8)
+
+        self.assertGreaterEqual(np.mean(found_ids == expected_ids), 0.95)
+
+    def test_probing_every_list_is_exact(self):
+        expected_ids, expected_best, expected_second = self.brute_force(self.queries)
+        found_ids, best, second = self.index.search(self.queries, n_probe=len(self.index.centroids), runner_up=True)
+
+        self.assertEqual(found_ids.tolist(), expected_ids.tolist())
+        np.testing.assert_allclose(best, expected_best, atol=1e-5)
+        np.testing.assert_allclose(second, expected_second, atol=1e-5)
+
+    def test_add_and_remove(self):
+        self.index.remove(self.ids[:1000])
+        found_ids, _ = self.index.search(self.vectors[:10], n_probe=len(self.index.centroids))
+        self.assertTrue(np.isin(found_ids, self.ids[1000:]).all())
+
+        # Re-adding replaces the vector stored for an id
+        self.index.add([20000, 10000], self.vectors[:2])
+        found_ids, scores = self.index.search(self.vectors[:2], n_probe=len(self.index.centroids))
+        self.assertEqual(found_ids.tolist(), [20000, 10000])
+        np.testing.assert_allclose(scores, 1.0, atol=1e-5)
+        self.assertEqual(len(self.index), 1002)
+
+    def test_needs_retrain_after_growth(self):
+        index = IVFIndex.build(self.ids[:100], self.vectors[:100])
+        self.assertFalse(index.needs_retrain)
+        index.add(self.ids[100:], self.vectors[100:])
+        self.assertTrue(index.needs_retrain)
+
+    def test_save_load_round_trip(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'event_1', 'Facenet512.npz')
+            self.index.save(path)
+            loaded = IVFIndex.load(path)
+
+        for name in ('centroids', 'vectors', 'ids', 'assignments', 'offsets'):
+            np.testing.assert_array_equal(getattr(loaded, name), getattr(self.index, name))
+        self.assertEqual(loaded.trained_size, self.index.trained_size)
+        for found, expected in zip(loaded.search(self.queries, runner_up=True),
+                                   self.index.search(self.queries, runner_up=True)):
+            np.testing.assert_array_equal(found, expected)
+
+    def test_sync_updates_the_saved_index(self):
+        users = {
+            int(user_id): {'deepface_representations': {'Facenet512': vector.tolist()}}
+            for user_id, vector in zip(self.ids[:300], self.vectors[:300])
+        }
+        with tempfile.TemporaryDirectory() as directory, override_settings(MEDIA_ROOT=directory):
+            sync_event_index(1, 'Facenet512', users)
+            del users[int(self.ids[0])]
+            users[30000] = {'deepface_representations': {'Facenet512': self.vectors[500].tolist()}}
+            index = sync_event_index(1, 'Facenet512', users)
+
+        self.assertEqual(set(index.ids.tolist()), set(users))
+        self.assertEqual(index.search(self.vectors[500])[0].tolist(), [30000])
+
+    def test_concurrent_additions_are_all_kept(self):
+        from . import ann
+
+        users = {
+            int(user_id): {'deepface_representations': {'Facenet512': vector.tolist()}}
+            for user_id, vector in zip(self.ids[:300], self.vectors[:300])
+        }
+        # Each worker reads the file, as separate processes would, and
+        # both read before either saves unless the lock orders them
+        barrier = threading.Barrier(2)
+
+        def load_after_both_read(path):
+            try:
+                barrier.wait(timeout=1)
+            except threading.BrokenBarrierError:
+                pass
+            return IVFIndex.load(path)
+
+        errors = []
+
+        def add(user_id, vector):
+            try:
+                ann.add_users_to_event_index(1, {user_id: {'deepface_representations': {'Facenet512': vector}}})
+            except Exception as e:
+                errors.append(e)
+
+        with tempfile.TemporaryDirectory() as directory, override_settings(MEDIA_ROOT=directory):
+            sync_event_index(1, 'Facenet512', users)
+            with patch.object(ann, '_load_index', side_effect=load_after_both_read):
+                threads = [
+                    threading.Thread(target=add, args=(30000 + offset, self.vectors[500 + offset].tolist()))
+                    for offset in range(2)
+                ]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            saved = IVFIndex.load(ann.ann_index_path(1, 'Facenet512'))
+
+        self.assertEqual(errors, [])
+        self.assertEqual(set(saved.ids.tolist()), set(users) | {30000, 30001})
+
+
+def unit(vector):
+    return vector / np.linalg.norm(vector)
+
+
+class SyntheticFacesTestCase(SimpleTestCase):
+    """Five users with random Facenet, ArcFace and face_recognition embeddings."""
+
+    def setUp(self):
+        rng = np.random.default_rng(2)
+        self.facenet = {user_id: unit(rng.normal(size=128)) for user_id in range(1, 6)}
+        self.arcface = {user_id: unit(rng.normal(size=512)) for user_id in range(1, 6)}
+        self.encodings = {user_id: rng.normal(scale=0.1, size=128) for user_id in range(1, 6)}
+        self.users = {
+            user_id: {
+                'deepface_representations': {'Facenet': self.facenet[user_id], 'ArcFace': self.arcface[user_id]},
+                'face_recognition_encoding': self.encodings[user_id],
+            }
+            for user_id in self.facenet
+        }
+        self.rng = rng
+
+    def face(self, facenet=None, arcface=None, encoding=None):
+        representations = {}
+        if facenet is not None:
+            representations['Facenet'] = facenet
+        if arcface is not None:
+            representations['ArcFace'] = arcface
+        return {'face_recognition_encoding': encoding, 'deepface_representations': representations}
+
+    def noisy(self, vector, scale=0.02):
+        return vector + self.rng.normal(scale=scale, size=len(vector))
+
+
+class FaceMatcherTests(SyntheticFacesTestCase):
+    """Faces are matched with synthetic user embeddings, and only clear-cut matches are decisive."""
+
+    def test_match_faces(self):
+        matcher = EventFaceMatcher(self.users)
+        matches = matcher.match_faces([
+            self.face(facenet=self.noisy(self.facenet[3])),
+            self.face(facenet=self.rng.normal(size=128)),
+            self.face(encoding=self.noisy(self.encodings[2], 0.001)),
+        ])
+
+        self.assertEqual(matches[0]['user_id'], 3)
+        self.assertEqual(matches[0]['matched_by'], 'deepface_Facenet')
+        self.assertGreater(matches[0]['confidence'], 95)
+        self.assertIsNone(matches[1])
+        # No DeepFace embedding: face_recognition is the fallback
+        self.assertEqual((matches[2]['user_id'], matches[2]['matched_by']), (2, 'face_recognition'))
+
+    def test_decisive_faces_need_a_margin(self):
+        matcher = EventFaceMatcher(self.users)
+        faces = [
+            self.face(facenet=self.noisy(self.facenet[1])),
+            # As close to user 1 as to user 2
+            self.face(facenet=self.facenet[1] + self.facenet[2]),
+        ]
+
+        self.assertEqual(matcher.decisive_faces('Facenet', faces, [0, 1], margin=10), {0})
+        self.assertEqual(matcher.decisive_faces('VGG-Face', faces, [0, 1], margin=10), set())
+
+    def test_ann_index_gives_the_exact_matches(self):
+        user_ids = list(self.facenet)
+        index = IVFIndex.build(user_ids, np.vstack([self.facenet[user_id] for user_id in user_ids]), n_lists=2)
+        faces = [self.face(facenet=self.noisy(self.facenet[user_id])) for user_id in user_ids]
+
+        exact = EventFaceMatcher(self.users).match_faces(faces)
+        approximate = EventFaceMatcher(self.users, ann_indexes={'Facenet': index}, ann_probes=2).match_faces(faces)
+        self.assertEqual(approximate, exact)
+        self.assertEqual([match['user_id'] for match in exact], user_ids)
+
+
+@override_settings(
+    FACE_MODEL_CASCADE=[('Facenet', 10), ('ArcFace', 8)],
+)
+class FaceCascadeTests(SyntheticFacesTestCase):
+    """Decisive faces stop at the cheap model; ambiguous ones are embedded with the next one."""
+
+    def test_stages_follow_the_cascade(self):
+        self.assertEqual(
+            get_cascade_stages(['ArcFace', 'VGG-Face', 'Facenet']),
+            [('Facenet', 10), ('ArcFace', 8), ('VGG-Face', None)],
+        )
+
+    def test_ambiguous_faces_fall_through(self):
+        from .cascade import cascade_stats
+        from .ml import model_registry
+        from .pipeline import cascade_embed_faces
+
+        # Aligned faces stand in as keys of their synthetic embeddings
+        embeddings = {
+            'Facenet': {'clear': self.noisy(self.facenet[4]), 'ambiguous': self.facenet[1] + self.facenet[2]},
+            'ArcFace': {'clear': self.noisy(self.arcface[4]), 'ambiguous': self.noisy(self.arcface[2])},
+        }
+        embedded = []
+
+        def represent_batch(faces, model_name, batch_size=None):
+            embedded.append((model_name, list(faces)))
+            return [embeddings[model_name][face] for face in faces]
+
+        matcher = EventFaceMatcher(self.users)
+        stages = get_cascade_stages(['Facenet', 'ArcFace'])
+        with patch.object(model_registry, 'represent_batch', side_effect=represent_batch):
+            representations = cascade_embed_faces(['clear', 'ambiguous'], [matcher, matcher], stages=stages)
+
+        self.assertEqual(embedded, [('Facenet', ['clear', 'ambiguous']), ('ArcFace', ['ambiguous'])])
+        self.assertEqual(set(representations[0]), {'Facenet'})
+        self.assertEqual(set(representations[1]), {'Facenet', 'ArcFace'})
+
+        matches = matcher.match_faces([self.face(**{
+            model_name.lower(): vector for model_name, vector in reps.items()
+        }) for reps in representations])
+        self.assertEqual([match['user_id'] for match in matches], [4, 2])
+        self.assertEqual(matches[1]['matched_by'], 'deepface_ArcFace')
+
+        stats = {stage['model']: stage for stage in cascade_stats(['Facenet', 'ArcFace'])}
+        self.assertEqual((stats['Facenet']['embedded'], stats['Facenet']['settled']), (2, 1))
+        self.assertEqual((stats['ArcFace']['embedded'], stats['ArcFace']['share_of_faces']), (1, 0.5))
+
+
+class EmbeddingLRUTests(SimpleTestCase):
+    """The in-process embedding cache stays within its limit."""
+
+    def test_least_recently_used_entry_is_evicted(self):
+        from .embeddings import EmbeddingLRU
+
+        lru = EmbeddingLRU(2)
+        lru.set((1, 'a', 'Facenet'), 'one')
+        lru.set((2, 'b', 'Facenet'), 'two')
+        lru.get((1, 'a', 'Facenet'))
+        lru.set((3, 'c', 'Facenet'), 'three')
+
+        self.assertEqual(len(lru), 2)
+        self.assertIsNone(lru.get((2, 'b', 'Facenet')))
+        self.assertEqual(lru.get((1, 'a', 'Facenet')), 'one')
+
+    def test_discard_user(self):
+        from .embeddings import EmbeddingLRU
+
+        lru = EmbeddingLRU(10)
+        lru.set((1, 'a', 'Facenet'), 'one')
+        lru.set((1, 'a', 'ArcFace'), 'one')
+        lru.set((2, 'b', 'Facenet'), 'two')
+        lru.discard_user(1)
+
+        self.assertEqual(len(lru), 1)
+        self.assertEqual(lru.get((2, 'b', 'Facenet')), 'two')
+
+
+class StoredUserEmbeddingTests(TestCase):
+    """Avatar embeddings are stored once per avatar and reused until it changes."""
+
+    def setUp(self):
+        from .embeddings import embedding_cache
+
+        User = get_user_model()
+        self.user = User.objects.create_user('avatar', 'avatar@example.com', 'password')
+        # A queryset update sends no post_save, so no refresh is queued
+        User.objects.filter(id=self.user.id).update(avatar='avatars/first.jpg')
+        self.user.refresh_from_db()
+        embedding_cache.clear()
+        self.addCleanup(embedding_cache.clear)
+
+    def store(self, avatar_hash='first'):
+        from .embeddings import save_user_embeddings
+
+        save_user_embeddings(self.user, avatar_hash, {
+            'face_recognition_encoding': [1.0, 0.0],
+            'deepface_representations': {'Facenet': [0.0, 1.0, 0.0]},
+        })
+
+    def test_embeddings_are_reused_from_the_cache(self):
+        from .embeddings import embedding_cache, get_stored_user_embeddings
+
+        self.store()
+        user_data, processed = get_stored_user_embeddings([self.user.id])
+
+        self.assertEqual(processed, {self.user.id})
+        self.assertEqual(list(user_data[self.user.id]['face_recognition_encoding']), [1.0, 0.0])
+        self.assertEqual(list(user_data[self.user.id]['deepface_representations']['Facenet']), [0.0, 1.0, 0.0])
+        self.assertEqual(embedding_cache.get((self.user.id, 'first', 'Facenet')).tolist(), [0.0, 1.0, 0.0])
+
+        # Only the index query runs; vectors come from the cache
+        with self.assertNumQueries(1):
+            cached, _ = get_stored_user_embeddings([self.user.id])
+        self.assertIs(cached[self.user.id]['deepface_representations']['Facenet'],
+                      user_data[self.user.id]['deepface_representations']['Facenet'])
+
+    def test_avatar_without_a_face_counts_as_processed(self):
+        from .embeddings import get_stored_user_embeddings, save_user_embeddings
+
+        save_user_embeddings(self.user, 'first', None)
+        user_data, processed = get_stored_user_embeddings([self.user.id])
+
+        self.assertEqual(processed, {self.user.id})
+        self.assertEqual(user_data, {})
+
+    def test_saving_a_new_avatar_queues_a_refresh(self):
+        user = get_user_model().objects.get(id=self.user.id)
+        with patch('photos.tasks.refresh_user_face_embeddings.delay') as refresh:
+            user.first_name = 'Unchanged avatar'
+            user.save()
+            refresh.assert_not_called()
+
+            user.avatar = 'avatars/second.jpg'
+            user.save()
+        refresh.assert_called_once_with(user.id)
+
+    def test_embeddings_of_an_older_avatar_are_not_served(self):
+        from .embeddings import get_stored_user_embeddings, has_current_embeddings
+
+        self.store()
+        get_stored_user_embeddings([self.user.id])
+        # Changed without post_save, so no refresh ran
+        get_user_model().objects.filter(id=self.user.id).update(avatar='avatars/second.jpg')
+
+        self.assertEqual(get_stored_user_embeddings([self.user.id]), ({}, set()))
+
+        # The same picture uploaded again keeps its embeddings
+        self.user.refresh_from_db()
+        self.assertTrue(has_current_embeddings(self.user, 'first'))
+        _, processed = get_stored_user_embeddings([self.user.id])
+        self.assertEqual(processed, {self.user.id})
+
+    def test_changed_avatar_is_embedded_again(self):
+        from .pipeline import update_user_embeddings
+
+        self.store()
+        get_user_model().objects.filter(id=self.user.id).update(avatar='avatars/second.jpg')
+        self.user.refresh_from_db()
+        new_data = {'face_recognition_encoding': [0.0, 1.0], 'deepface_representations': {}}
+
+        with patch('photos.pipeline.avatar_content_hash', return_value='second'), \
+                patch('photos.pipeline.preprocess_user', return_value=new_data) as preprocess:
+            result = update_user_embeddings(self.user)
+
+        preprocess.assert_called_once()
+        self.assertIs(result, new_data)
+        self.assertEqual(
+            list(self.user.face_embeddings.values_list('avatar_hash', 'avatar_name', 'model_name')),
+            [('second', 'avatars/second.jpg', 'face_recognition')],
+        )
+
+
+def detected_face(x, y, size=40):
+    return {'facial_area': {'x': x, 'y': y, 'w': size, 'h': size}, 'confidence': 0.99}
+
+
+class FusedProcessingTests(TestCase):
+    """The fused pipeline decodes a photo once and writes every result in one save."""
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        settings_override = override_settings(
+            MEDIA_ROOT=self.media_root, ANALYSIS_PROXY_MAX_SIZE=400, PHOTO_PROCESSING_MODE='fused',
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        organizer = get_user_model().objects.create_user('organizer', 'organizer@example.com', 'password')
+        self.event = Event.objects.create(
+            title='Fused', description='Event', location='Hall', organizer=organizer,
+            start_date=timezone.now(), end_date=timezone.now(),
+        )
+        os.makedirs(os.path.join(self.media_root, 'events', 'test'))
+
+    def make_photo(self, name, size):
+        path = os.path.join(self.media_root, 'events', 'test', name)
+        Image.new('RGB', size, (120, 160, 200)).save(path)
+        photo, = EventPhoto.objects.bulk_create([EventPhoto(event=self.event, image=f'events/test/{name}')])
+        return photo
+
+    def process(self, photo):
+        from . import pipeline
+        from .ml import model_registry
+        from .tasks import process_photo
+
+        deepface = MagicMock()
+        deepface.extract_faces.return_value = [detected_face(10, 10), detected_face(100, 60)]
+        face_recognition = MagicMock()
+        face_recognition.face_encodings.return_value = []
+        face_recognition.face_landmarks.return_value = [{'left_eye': [(10, 15)], 'right_eye': [(30, 15)]}]
+        saves = []
+        original_save = EventPhoto.save
+
+        def save(instance, *args, **kwargs):
+            saves.append(kwargs.get('update_fields'))
+            return original_save(instance, *args, **kwargs)
+
+        with patch.object(model_registry, '_deepface', deepface), \
+                patch.object(model_registry, '_face_recognition', face_recognition), \
+                patch.object(pipeline, 'cascade_embed_faces', side_effect=lambda faces, *a, **k: [{}] * len(faces)), \
+                patch.object(pipeline, 'enhance_photo_task'), \
+                patch('highlights.signals.process_new_photo'), \
+                patch.object(pipeline, 'generate_tags', return_value=['indoor']), \
+                patch.object(pipeline, 'read_image', wraps=pipeline.read_image) as read_image, \
+                patch.object(EventPhoto, 'save', autospec=True, side_effect=save):
+            process_photo(photo.id)
+
+        return read_image.call_count, saves
+
+    def assert_processed(self, photo, saves):
+        self.assertEqual(saves, [['processed', 'quality_score', 'detected_faces', 'scene_tags']])
+        photo.refresh_from_db()
+        self.assertTrue(photo.processed)
+        self.assertIsNotNone(photo.quality_score)
+        self.assertEqual(len(photo.detected_faces), 2)
+        self.assertEqual(photo.scene_tags, ['indoor'])
+
+    def test_photo_within_proxy_size_is_not_decoded_again(self):
+        photo = self.make_photo('small.jpg', (300, 200))
+
+        decodes, saves = self.process(photo)
+
+        self.assertEqual(decodes, 0)
+        self.assert_processed(photo, saves)
+        self.assertEqual(photo.detected_faces[1]['position'], {'x': 100, 'y': 60, 'width': 40, 'height': 40})
+
+    def test_large_photo_is_decoded_once_for_face_crops(self):
+        photo = self.make_photo('large.jpg', (1200, 800))
+
+        decodes, saves = self.process(photo)
+
+        self.assertEqual(decodes, 1)
+        self.assert_processed(photo, saves)
+        # Positions are reported in original pixels
+        self.assertEqual(photo.detected_faces[1]['position'], {'x': 300, 'y': 180, 'width': 120, 'height': 120})
+
+
+class AnalysisProxyTests(TestCase):
+    """Each photo gets one bounded-size proxy, with the original as fallback."""
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root, ANALYSIS_PROXY_MAX_SIZE=400)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        organizer = get_user_model().objects.create_user('organizer', 'organizer@example.com', 'password')
+        event = Event.objects.create(
+            title='Proxies', description='Event', location='Hall', organizer=organizer,
+            start_date=timezone.now(), end_date=timezone.now(),
+        )
+        os.makedirs(os.path.join(self.media_root, 'events', 'test'))
+        Image.new('RGB', (1200, 800), (120, 160, 200)).save(os.path.join(self.media_root, 'events', 'test', 'a.jpg'))
+        self.photo, = EventPhoto.objects.bulk_create([EventPhoto(event=event, image='events/test/a.jpg')])
+        self.proxy_dir = os.path.join(self.media_root, os.path.dirname(analysis_proxy_path(self.photo, 'x')))
+
+    def test_proxy_is_created_once(self):
+        proxy = create_analysis_proxy(self.photo)
+
+        self.assertEqual(Image.open(proxy.path).size, (400, 267))
+        stored = EventPhoto.objects.get(id=self.photo.id)
+        self.assertEqual((stored.analysis_proxy.name, stored.image_width, stored.image_height),
+                         (proxy.name, 1200, 800))
+        self.assertEqual(proxy_scale(stored, 400), 3.0)
+
+        with patch('photos.proxies.render_analysis_proxy') as render:
+            create_analysis_proxy(stored)
+        render.assert_not_called()
+
+    def test_concurrent_creation_keeps_one_proxy(self):
+        # Loaded by process_photo and by the post_save pipeline before either wrote a proxy
+        first = EventPhoto.objects.get(id=self.photo.id)
+        second = EventPhoto.objects.get(id=self.photo.id)
+
+        create_analysis_proxy(first)
+        create_analysis_proxy(second)
+
+        self.assertEqual(second.analysis_proxy.name, first.analysis_proxy.name)
+        self.assertEqual(os.listdir(self.proxy_dir), [os.path.basename(first.analysis_proxy.name)])
+        self.assertEqual(EventPhoto.objects.get(id=self.photo.id).analysis_proxy.name, first.analysis_proxy.name)
+
+    def test_recreated_proxy_replaces_the_old_file(self):
+        create_analysis_proxy(self.photo)
+        create_analysis_proxy(self.photo, force=True)
+
+        self.assertEqual(os.listdir(self.proxy_dir), [os.path.basename(self.photo.analysis_proxy.name)])
+        self.assertEqual(EventPhoto.objects.get(id=self.photo.id).analysis_proxy.name, self.photo.analysis_proxy.name)
+
+    def test_missing_proxy_falls_back_to_the_original(self):
+        os.remove(create_analysis_proxy(self.photo).path)
+
+        image = load_analysis_proxy(self.photo)
+
+        self.assertEqual(image.shape, (267, 400, 3))
+        self.assertEqual((self.photo.image_width, self.photo.image_height), (1200, 800))
+
+
+def stub_embedding_models():
+    """A Keras model that represent_batch runs on whole batches, and one with its own forward()."""
+    from deepface.models.FacialRecognition import FacialRecognition  # type: ignore
+    from tensorflow.keras import layers, models  # type: ignore
+
+    class KerasStub(FacialRecognition):
+        def __init__(self):
+            self.model_name = 'KerasStub'
+            self.input_shape = (8, 8)
+            self.output_shape = 4
+            self.model = models.Sequential([layers.Input((8, 8, 3)), layers.Flatten(), layers.Dense(4)])
+
+    class ForwardStub(FacialRecognition):
+        def __init__(self):
+            self.model_name = 'ForwardStub'
+            self.input_shape = (6, 6)
+            self.output_shape = 3
+            self.calls = 0
+
+        def forward(self, img):
+            self.calls += 1
+            return img.mean(axis=(0, 1, 2)).tolist()
+
+    return {'KerasStub': KerasStub(), 'ForwardStub': ForwardStub()}
+
+
+@override_settings(FACE_EMBEDDING_MODELS=['KerasStub', 'ForwardStub'], FACE_MODEL_CASCADE=None)
+class BatchedEmbeddingTests(TestCase):
+    """Batched embeddings equal per-face ones and go back to the photo and face they came from."""
+
+    # Background grey of each photo, and the colored face squares in it (x, y, size, color)
+    PHOTOS = {
+        50: [(20, 20, 40, (200, 30, 30))],
+        100: [],
+        150: [(10, 60, 50, (30, 200, 30)), (120, 30, 40, (30, 30, 200))],
+    }
+
+    def setUp(self):
+        from deepface import DeepFace  # type: ignore
+        from .ml import model_registry
+
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.models = stub_embedding_models()
+        face_recognition = MagicMock()
+        face_recognition.face_encodings.return_value = []
+        face_recognition.face_landmarks.return_value = []
+        for patcher in (
+            patch.dict(model_registry.models, self.models),
+            patch.object(model_registry, '_deepface', DeepFace),
+            patch.object(model_registry, '_face_recognition', face_recognition),
+            # DeepFace.represent builds its model through here
+            patch('deepface.modules.modeling.build_model', side_effect=lambda task, model_name: self.models[model_name]),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def faces(self):
+        rng = np.random.default_rng(0)
+        return [rng.integers(0, 256, shape, dtype=np.uint8) for shape in ((20, 16, 3), (30, 30, 3), (12, 25, 3))] * 2
+
+    def represent(self, face, model_name):
+        from .ml import model_registry
+
+        return model_registry.represent(face, model_name, detector_backend='skip')[0]['embedding']
+
+    def test_batches_match_per_face_embeddings(self):
+        from .ml import model_registry
+
+        faces = self.faces()
+        for model_name in self.models:
+            batched = model_registry.represent_batch(faces, model_name, batch_size=4)
+            self.assertEqual(len(batched), len(faces))
+            for face, embedding in zip(faces, batched):
+                np.testing.assert_allclose(embedding, self.represent(face, model_name), rtol=1e-5, atol=1e-6)
+
+    def test_model_without_batch_support_runs_per_face(self):
+        from .ml import model_registry
+
+        model_registry.represent_batch(self.faces(), 'ForwardStub', batch_size=4)
+        self.assertEqual(self.models['ForwardStub'].calls, 6)
+
+    def test_batch_embeddings_are_mapped_to_their_photos(self):
+        from . import pipeline
+
+        organizer = get_user_model().objects.create_user('organizer', 'organizer@example.com', 'password')
+        event = Event.objects.create(
+            title='Batch', description='Event', location='Hall', organizer=organizer,
+            start_date=timezone.now(), end_date=timezone.now(),
+        )
+        os.makedirs(os.path.join(self.media_root, 'events', 'test'))
+        photos = {}
+        for grey, squares in self.PHOTOS.items():
+            pixels = np.full((150, 200, 3), grey, dtype=np.uint8)
+            for x, y, size, color in squares:
+                pixels[y:y + size, x:x + size] = color
+            name = f'events/test/{grey}.jpg'
+            Image.fromarray(pixels).save(os.path.join(self.media_root, name), quality=95)
+            photos[grey], = EventPhoto.objects.bulk_create([EventPhoto(event=event, image=name)])
+
+        def extract_faces(img_path, **kwargs):
+            grey = int(round(img_path[0, 0].mean() / 50) * 50)
+            return [
+                {'facial_area': {'x': x, 'y': y, 'w': size, 'h': size}, 'confidence': 0.99}
+                for x, y, size, _ in self.PHOTOS[grey]
+            ]
+
+        with patch.object(pipeline.model_registry._deepface, 'extract_faces', side_effect=extract_faces), \
+                patch.object(pipeline.model_registry, 'represent', side_effect=AssertionError('not batched')), \
+                patch.object(pipeline, 'generate_tags', return_value=[]), \
+                patch.object(pipeline, 'enhance_photo_task'), \
+                patch('highlights.signals.process_new_photo'):
+            # Two faces per forward pass, so a batch spans two photos
+            processed = pipeline.process_photo_batch([photo.id for photo in photos.values()], batch_size=2)
+
+        self.assertEqual(processed, 3)
+        for grey, photo in photos.items():
+            photo.refresh_from_db()
+            squares = self.PHOTOS[grey]
+            self.assertTrue(photo.processed)
+            self.assertEqual([(face['x'], face['y']) for face in photo.detected_faces],
+                             [(x, y) for x, y, _, _ in squares])
+
+            proxy = load_analysis_proxy(photo)
+            stored = {
+                (face_index, model_name): np.frombuffer(bytes(embedding), dtype=np.float32)
+                for face_index, model_name, embedding in PhotoFaceEmbedding.objects.filter(photo=photo).values_list(
+                    'face_index', 'model_name', 'embedding'
+                )
+            }
+            self.assertEqual(set(stored), {(index, model_name) for index in range(len(squares)) for model_name in self.models})
+            for index, (x, y, size, _) in enumerate(squares):
+                face = proxy[y:y + size, x:x + size]
+                for model_name in self.models:
+                    np.testing.assert_allclose(stored[index, model_name], self.represent(face, model_name),
+                                               rtol=1e-5, atol=1e-5)
@@ -0,0 +1,39 @@
+# photos/transactions.py
+"""
+Retrying short write transactions.
+
+select_for_update() serializes concurrent writers on PostgreSQL, but it is
+a no-op on SQLite, where the second writer fails with "database is locked"
+instead of waiting. run_in_transaction() runs a read-merge-write function
+in its own atomic block and runs it again on such lock errors, so a writer
+that lost the race re-reads the rows and merges into them instead of its
+update being lost or overwriting the other one.
+"""
+import logging
+import random
+import time
+
+from django.db import OperationalError, transaction
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ATTEMPTS = 6
+DEFAULT_DELAY = 0.05  # seconds, doubled after every failed attempt
+
+
+def run_in_transaction(func, *args, attempts=DEFAULT_ATTEMPTS, delay=DEFAULT_DELAY, **kwargs):
+    """Call func in an atomic block, retrying it on lock and serialization errors."""
+    if transaction.get_connection().in_atomic_block:
+        # The outer transaction would be broken by a failed attempt; its owner retries
+        return func(*args, **kwargs)
+
+    for attempt in range(1, attempts + 1):
+        try:
+            with transaction.atomic():
+                return func(*args, **kwargs)
+        except OperationalError as e:
+            if attempt == attempts:
+                raise
+            wait = delay * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+            logger.info(f"Retrying {func.__name__} in {wait:.2f}s after a lock error: {str(e)}")
+            time.sleep(wait)
@@ -20,8 +20,9 @@ from django.views.decorators.http import require_POST
 from django.db.models import F, Q
 
 from events.models import Event, EventParticipant
+from privacy.resolver import attach_privacy_status, exclude_hidden
 from .models import EventPhoto, PhotoLike, PhotoComment, UserPhotoMatch, UserGallery
-from .tasks import *
+from .tasks import enqueue_photo_processing, process_photo
 
 
 
@@ -68,7 +69,8 @@ class EventGalleryView(DetailView):
        
         # Get tag filter
         tag_filter = self.request.GET.get('tag')
-        photos_queryset = event.photos.all()
+        # Photos hidden by privacy requests are left out in SQL
+        photos_queryset = exclude_hidden(event.photos.all())
        
         # Apply tag filter if specified
         if tag_filter:
@@ -98,6 +100,8 @@ class EventGalleryView(DetailView):
         paginator = Paginator(photos_queryset, 12)  # Show 12 photos per page
         page = self.request.GET.get('page')
         photos = paginator.get_page(page)
+        # Blurred versions of the whole page come from one cached map read
+        photos.object_list = attach_privacy_status(photos.object_list)
        
         # Check user permissions
         can_upload = False
@@ -163,8 +167,7 @@ class UploadPhotosView(LoginRequiredMixin, View):
             )
             uploaded_photos.append(photo)
 
-        for photo in uploaded_photos:
-            process_photo.delay(photo.id)
+        enqueue_photo_processing(photo.id for photo in uploaded_photos)
         
         messages.success(request, f"{len(uploaded_photos)} photos uploaded successfully and queued for AI processing.")
         return redirect('photos:event_gallery', slug=slug)
@@ -327,10 +330,10 @@ class UserGalleryView(LoginRequiredMixin, ListView):
     paginate_by = 12
     
     def get_queryset(self):
-        # Get photos where the current user appears
-        return EventPhoto.objects.filter(
+        # Get photos where the current user appears, except hidden ones
+        return exclude_hidden(EventPhoto.objects.filter(
             user_matches__user=self.request.user
-        ).order_by('-upload_date')
+        )).order_by('-upload_date')
     
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
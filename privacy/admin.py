@@ -1,6 +1,6 @@
 # privacy/admin.py
 from django.contrib import admin
-from .models import PrivacyRequest, ProcessedPhoto
+from .models import PrivacyMask, PrivacyRequest, ProcessedPhoto
 
 @admin.register(PrivacyRequest)
 class PrivacyRequestAdmin(admin.ModelAdmin):
@@ -27,3 +27,10 @@ class ProcessedPhotoAdmin(admin.ModelAdmin):
     readonly_fields = ('processing_date',)
 
 
+
+
+
+@admin.register(PrivacyMask)
+class PrivacyMaskAdmin(admin.ModelAdmin):
+    list_display = ('photo', 'version', 'updated_at')
+    readonly_fields = ('updated_at',)
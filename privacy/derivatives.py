@@ -0,0 +1,225 @@
+# privacy/derivatives.py
+"""
+Privacy-safe derivatives, generated when they are viewed.
+
+A derivative is a photo's original with every region of its PrivacyMask
+blurred, scaled to one of PRIVACY_DERIVATIVE_SIZES. It is rendered on the
+first request and kept on disk under PRIVACY_DERIVATIVE_DIR, keyed by
+(photo, mask version, size), so changing a mask simply makes new keys.
+At most PRIVACY_DERIVATIVE_MAX_RENDERS renders run at once across all web
+processes: each render leases one of that many slot keys in the
+PRIVACY_DERIVATIVE_CACHE cache alias, with a timeout so that a crashed
+process cannot hold a slot forever. Every PRIVACY_DERIVATIVE_EVICT_EVERY
+renders, the least recently served files are evicted once the cache grows
+past PRIVACY_DERIVATIVE_CACHE_MAX_BYTES.
+"""
+import io
+import logging
+import os
+import random
+import time
+import uuid
+
+from PIL import Image, ImageFilter, ImageOps
+from django.conf import settings
+from django.core.cache import caches
+
+logger = logging.getLogger(__name__)
+
+# Longest edge in pixels; None keeps the original resolution
+DEFAULT_SIZES = {'thumb': 400, 'medium': 800, 'full': None}
+DEFAULT_MAX_RENDERS = 4
+DEFAULT_RENDER_WAIT = 10  # seconds
+DEFAULT_CACHE_MAX_BYTES = 512 * 2 ** 20
+DEFAULT_QUALITY = 85
+DEFAULT_SLOT_TIMEOUT = 60  # seconds a render may hold its slot
+DEFAULT_EVICT_EVERY = 50  # renders between two eviction scans
+SLOT_POLL_INTERVAL = 0.05  # seconds between attempts to take a slot
+
+
+class DerivativeBusy(Exception):
+    """Every render slot stayed taken for the whole wait."""
+
+
+def get_sizes():
+    return getattr(settings, 'PRIVACY_DERIVATIVE_SIZES', DEFAULT_SIZES)
+
+
+def get_cache_dir():
+    return str(getattr(settings, 'PRIVACY_DERIVATIVE_DIR', os.path.join(settings.BASE_DIR, 'privacy_cache')))
+
+
+def get_render_cache():
+    return caches[getattr(settings, 'PRIVACY_DERIVATIVE_CACHE', 'default')]
+
+
+def _slot_key(slot):
+    return f"privacy_derivative:slot:{slot}"
+
+
+def acquire_render_slot(wait=None):
+    """
+    Lease one of the render slots shared by every process.
+
+    Returns (key, token), to pass to release_render_slot, or None when no
+    slot came free within `wait` seconds.
+    """
+    cache = get_render_cache()
+    slots = getattr(settings, 'PRIVACY_DERIVATIVE_MAX_RENDERS', DEFAULT_MAX_RENDERS)
+    timeout = getattr(settings, 'PRIVACY_DERIVATIVE_SLOT_TIMEOUT', DEFAULT_SLOT_TIMEOUT)
+    if wait is None:
+        wait = getattr(settings, 'PRIVACY_DERIVATIVE_RENDER_WAIT', DEFAULT_RENDER_WAIT)
+
+    token = uuid.uuid4().hex
+    deadline = time.monotonic() + wait
+    while True:
+        # From a random slot, so waiting requests do not all race for the first key
+        first = random.randrange(slots)
+        for offset in range(slots):
+            key = _slot_key((first + offset) % slots)
+            if cache.add(key, token, timeout=timeout):
+                return key, token
+        if time.monotonic() >= deadline:
+            return None
+        time.sleep(SLOT_POLL_INTERVAL)
+
+
+def release_render_slot(slot):
+    key, token = slot
+    cache = get_render_cache()
+    # The lease may have expired and been taken by another render meanwhile
+    if cache.get(key) == token:
+        cache.delete(key)
+
+
+def count_render():
+    """Count a render in every process; True for each PRIVACY_DERIVATIVE_EVICT_EVERY-th one."""
+    cache = get_render_cache()
+    key = 'privacy_derivative:renders'
+    cache.add(key, 0, timeout=None)
+    try:
+        count = cache.incr(key)
+    except ValueError:
+        # Evicted between add() and incr()
+        return False
+    return count % getattr(settings, 'PRIVACY_DERIVATIVE_EVICT_EVERY', DEFAULT_EVICT_EVERY) == 0
+
+
+def derivative_path(photo_id, version, size):
+    return os.path.join(get_cache_dir(), f"{photo_id}_v{version}_{size}.jpg")
+
+
+def _kernel_sigma(blur_factor):
+    """Standard deviation OpenCV derives from a Gaussian kernel size, as used by blur_regions."""
+    blur_factor += 1 - blur_factor % 2
+    return 0.3 * ((blur_factor - 1) * 0.5 - 1) + 0.8
+
+
+def render_derivative(image_path, regions, max_edge=None):
+    """
+    JPEG bytes of an image with regions blurred, scaled to max_edge, or None.
+
+    Rendered with PIL, like the analysis proxies, so the web process does not
+    load OpenCV. Regions are in original pixels with EXIF orientation applied.
+    """
+    try:
+        img = Image.open(image_path)
+        width = img.size[1] if img.getexif().get(0x0112, 1) in (5, 6, 7, 8) else img.size[0]
+
+        # Decode at a fraction of the resolution when the output is much smaller
+        if max_edge:
+            img.draft('RGB', (max_edge, max_edge))
+        img = ImageOps.exif_transpose(img).convert('RGB')
+    except (OSError, ValueError) as e:
+        logger.error(f"Failed to load image {image_path}: {str(e)}")
+        return None
+
+    scale = img.width / width
+    for region in regions or []:
+        top, bottom = max(0, round(region['top'] * scale)), min(img.height, round(region['bottom'] * scale))
+        left, right = max(0, round(region['left'] * scale)), min(img.width, round(region['right'] * scale))
+        if bottom <= top or right <= left:
+            continue
+        sigma = _kernel_sigma(max(3, int(region.get('blur_factor', 101) * scale)))
+        box = (left, top, right, bottom)
+        img.paste(img.crop(box).filter(ImageFilter.GaussianBlur(sigma)), box)
+
+    if max_edge and max(img.size) > max_edge:
+        img.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+
+    buffer = io.BytesIO()
+    img.save(buffer, format='JPEG', quality=getattr(settings, 'PRIVACY_DERIVATIVE_QUALITY', DEFAULT_QUALITY))
+    return buffer.getvalue()
+
+
+def get_derivative(photo, size):
+    """Path of the privacy-safe derivative of a photo at a named size, rendering it on a miss."""
+    mask = getattr(photo, 'privacy_mask', None)
+    version, regions = (mask.version, mask.regions) if mask else (0, [])
+    path = derivative_path(photo.id, version, size)
+
+    try:
+        # Served files are the most recently used
+        os.utime(path)
+        return path
+    except FileNotFoundError:
+        pass
+
+    slot = acquire_render_slot()
+    if slot is None:
+        raise DerivativeBusy(f"No render slot for photo {photo.id}")
+    try:
+        # Rendered by another request while this one waited
+        if os.path.exists(path):
+            return path
+
+        data = render_derivative(photo.image.path, regions, get_sizes()[size])
+        if data is None:
+            return None
+
+        # Written aside and moved in, so readers never see a partial file
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    finally:
+        release_render_slot(slot)
+
+    # A scan stats every file, so it only runs every few renders
+    if count_render():
+        evict_derivatives()
+    return path
+
+
+def evict_derivatives(max_bytes=None):
+    """Delete the least recently served derivatives until the cache fits; returns how many went."""
+    if max_bytes is None:
+        max_bytes = getattr(settings, 'PRIVACY_DERIVATIVE_CACHE_MAX_BYTES', DEFAULT_CACHE_MAX_BYTES)
+
+    entries = []
+    try:
+        for entry in os.scandir(get_cache_dir()):
+            if not (entry.name.endswith('.jpg') and entry.is_file()):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                # Evicted by another process during the scan
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    except FileNotFoundError:
+        return 0
+
+    total = sum(size for _, size, _ in entries)
+    evicted = 0
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        evicted += 1
+    return evicted
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from privacy.masks import refresh_privacy_masks
+from privacy.models import ProcessedPhoto
+
+class Command(BaseCommand):
+    help = 'Build the privacy masks of photos from the regions of completed blur requests'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--event', type=int, help='Only rebuild masks of this event ID')
+        parser.add_argument('--batch-size', type=int, default=200, help='Photos updated per transaction')
+
+    def handle(self, *args, **options):
+        processed = ProcessedPhoto.objects.filter(
+            privacy_request__request_type='blur',
+            privacy_request__status='completed',
+        )
+        if options.get('event'):
+            processed = processed.filter(original_photo__event_id=options['event'])
+
+        photo_ids = sorted(set(processed.values_list('original_photo_id', flat=True)))
+        self.stdout.write(f"Rebuilding privacy masks of {len(photo_ids)} photos")
+
+        batch_size = options['batch_size']
+        updated = 0
+        for start in range(0, len(photo_ids), batch_size):
+            updated += refresh_privacy_masks(photo_ids[start:start + batch_size])
+
+        self.stdout.write(self.style.SUCCESS(f"Updated {updated} privacy masks"))
@@ -0,0 +1,85 @@
+# privacy/masks.py
+"""
+Layered privacy masks.
+
+A blur request only records where the requester's face is in each photo
+(ProcessedPhoto.face_coordinates). A photo's PrivacyMask aggregates the
+regions of every completed blur request, plus the request being
+processed, and its version is bumped whenever that set changes. Nothing
+is rendered here: blurred derivatives are generated from the original
+and the mask when they are viewed (see privacy/derivatives.py), keyed by
+the mask version. Deleting a request re-aggregates the remaining regions
+without locating anyone's face again.
+"""
+import logging
+
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import PrivacyMask, ProcessedPhoto
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BLUR_FACTOR = 101
+SIDES = ('top', 'right', 'bottom', 'left')
+
+
+def aggregate_regions(photo_ids, include_request_id=None):
+    """{photo id: mask regions} from the completed blur requests, in one query."""
+    requests = Q(privacy_request__status='completed')
+    if include_request_id is not None:
+        # The request being processed is masked before it completes
+        requests |= Q(privacy_request_id=include_request_id)
+
+    rows = ProcessedPhoto.objects.filter(
+        requests,
+        original_photo_id__in=photo_ids,
+        privacy_request__request_type='blur',
+    ).order_by('privacy_request_id').values_list('original_photo_id', 'privacy_request_id', 'face_coordinates')
+
+    regions = {photo_id: [] for photo_id in photo_ids}
+    for photo_id, request_id, coordinates in rows:
+        for region in coordinates or []:
+            regions[photo_id].append({
+                'request_id': request_id,
+                **{side: int(region[side]) for side in SIDES},
+                'blur_factor': DEFAULT_BLUR_FACTOR,
+            })
+    return regions
+
+
+def update_privacy_masks(photo_ids, include_request_id=None):
+    """Store the aggregated regions of photos; returns the masks whose version was bumped."""
+    photo_ids = list(photo_ids)
+    if not photo_ids:
+        return []
+
+    with transaction.atomic():
+        regions = aggregate_regions(photo_ids, include_request_id)
+        PrivacyMask.objects.bulk_create(
+            [PrivacyMask(photo_id=photo_id) for photo_id in photo_ids if regions[photo_id]],
+            ignore_conflicts=True,
+        )
+        masks = PrivacyMask.objects.select_for_update().select_related('photo').filter(photo_id__in=photo_ids)
+
+        changed = []
+        for mask in masks:
+            if mask.regions != regions[mask.photo_id]:
+                mask.regions = regions[mask.photo_id]
+                mask.version += 1
+                mask.updated_at = timezone.now()
+                changed.append(mask)
+        PrivacyMask.objects.bulk_update(changed, ['regions', 'version', 'updated_at'])
+
+    return changed
+
+
+def refresh_privacy_masks(photo_ids, include_request_id=None):
+    """Update the masks of photos; returns how many changed."""
+    from .resolver import invalidate_privacy_map
+
+    changed = update_privacy_masks(photo_ids, include_request_id)
+    for event_id in {mask.photo.event_id for mask in changed}:
+        invalidate_privacy_map(event_id)
+    return len(changed)
@@ -95,4 +95,21 @@ class ProcessedPhoto(models.Model):
         unique_together = ('privacy_request', 'original_photo')
     
     def __str__(self):
-        return f"Processed photo {self.original_photo.id} for {self.privacy_request}"
\ No newline at end of file
+        return f"Processed photo {self.original_photo.id} for {self.privacy_request}"
+
+class PrivacyMask(models.Model):
+    """Blur regions of a photo from every completed blur request."""
+    
+    photo = models.OneToOneField(
+        EventPhoto,
+        on_delete=models.CASCADE,
+        related_name='privacy_mask'
+    )
+    # [{'request_id', 'top', 'right', 'bottom', 'left', 'blur_factor'}, ...]
+    regions = models.JSONField(default=list, blank=True)
+    # Bumped whenever the regions change; keys the derivatives served for the photo
+    version = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    def __str__(self):
+        return f"Privacy mask of photo {self.photo_id} (v{self.version})"
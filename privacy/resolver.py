@@ -0,0 +1,146 @@
+# privacy/resolver.py
+"""
+Bulk privacy resolution for photo pages.
+
+Which photos of an event are hidden, and which have a blurred version,
+is read with one query over the hide requests' processed photos and the
+photos' privacy masks, and kept per event in the PRIVACY_MAP_CACHE cache
+alias under the event's current generation. The generation is bumped when
+a request of the event completes or is deleted, or a mask changes, so a
+map built from rows read before the change lands under a key nobody reads
+instead of hiding a new blur. A page of photos is resolved with two cache
+reads instead of two queries per photo. Galleries exclude hidden photos in
+SQL with exclude_hidden().
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Q
+
+from photos.models import EventPhoto
+from .models import ProcessedPhoto
+
+DEFAULT_TIMEOUT = 60 * 60
+
+
+def get_privacy_cache():
+    return caches[getattr(settings, 'PRIVACY_MAP_CACHE', 'default')]
+
+
+def get_privacy_timeout():
+    return getattr(settings, 'PRIVACY_MAP_TIMEOUT', DEFAULT_TIMEOUT)
+
+
+def generation_key(event_id):
+    return f"privacy_map:{event_id}:generation"
+
+
+def privacy_map_key(event_id, generation):
+    return f"privacy_map:{event_id}:{generation}"
+
+
+def get_generations(event_ids):
+    """{event id: current generation of its privacy map}, starting the missing ones."""
+    cache = get_privacy_cache()
+    keys = {event_id: generation_key(event_id) for event_id in event_ids}
+    cached = cache.get_many(keys.values())
+    generations = {}
+    for event_id, key in keys.items():
+        generation = cached.get(key)
+        if generation is None:
+            # A clock start, so a counter that was evicted never reuses an old generation's keys
+            cache.add(key, time.time_ns(), timeout=None)
+            generation = cache.get(key)
+        generations[event_id] = generation
+    return generations
+
+
+def hidden_photos():
+    """Processed photos that hide the outer photo, for Exists() annotations."""
+    return ProcessedPhoto.objects.filter(
+        original_photo=OuterRef('pk'),
+        privacy_request__request_type='hide',
+        privacy_request__status='completed',
+    )
+
+
+def exclude_hidden(queryset):
+    """EventPhoto queryset without the photos hidden by a completed request."""
+    return queryset.alias(privacy_hidden=Exists(hidden_photos())).filter(privacy_hidden=False)
+
+
+def build_privacy_map(event_id):
+    """{'hidden': photo ids, 'blurred': {photo id: mask version}} of an event, from the database."""
+    rows = EventPhoto.objects.filter(event_id=event_id).annotate(
+        privacy_hidden=Exists(hidden_photos()),
+    ).filter(
+        Q(privacy_hidden=True) | Q(privacy_mask__regions__0__isnull=False)
+    ).values_list('id', 'privacy_hidden', 'privacy_mask__version', 'privacy_mask__regions__0')
+
+    hidden, blurred = set(), {}
+    for photo_id, is_hidden, mask_version, first_region in rows:
+        if is_hidden:
+            hidden.add(photo_id)
+        if first_region is not None:
+            blurred[photo_id] = mask_version
+    return {'hidden': hidden, 'blurred': blurred}
+
+
+def get_privacy_maps(event_ids):
+    """Privacy maps of several events: one cache read, missing ones built and cached."""
+    cache = get_privacy_cache()
+    # Read before the database: a change committed after this read bumps the
+    # generation, so a map built from older rows lands under a dead key
+    generations = get_generations(set(event_ids))
+    keys = {event_id: privacy_map_key(event_id, generation) for event_id, generation in generations.items()}
+    cached = cache.get_many(keys.values())
+
+    maps = {}
+    for event_id, key in keys.items():
+        privacy_map = cached.get(key)
+        if privacy_map is None:
+            privacy_map = build_privacy_map(event_id)
+            cache.add(key, privacy_map, timeout=get_privacy_timeout())
+        maps[event_id] = privacy_map
+    return maps
+
+
+def get_privacy_map(event_id):
+    return get_privacy_maps([event_id])[event_id]
+
+
+def privacy_status(photo_id, privacy_map):
+    """Privacy status of a photo, in the format check_photo_privacy returns."""
+    mask_version = privacy_map['blurred'].get(photo_id)
+    return {
+        'is_hidden': photo_id in privacy_map['hidden'],
+        'has_blurred_version': mask_version is not None,
+        # Blurred versions are served by privacy:photo_derivative, versioned by the mask
+        'mask_version': mask_version,
+    }
+
+
+def attach_privacy_status(photos):
+    """Set privacy_status on each photo of a page, reading every event's map at once."""
+    photos = list(photos)
+    maps = get_privacy_maps({photo.event_id for photo in photos})
+    for photo in photos:
+        photo.privacy_status = privacy_status(photo.id, maps[photo.event_id])
+    return photos
+
+
+def drop_privacy_map(event_id):
+    """Move an event to a new generation, leaving its cached privacy map behind."""
+    cache = get_privacy_cache()
+    try:
+        cache.incr(generation_key(event_id))
+    except ValueError:
+        # Never read, or evicted: the next read starts a new generation
+        cache.add(generation_key(event_id), time.time_ns(), timeout=None)
+
+
+def invalidate_privacy_map(event_id):
+    """Bump the privacy map generation of an event once the current transaction commits."""
+    transaction.on_commit(lambda: drop_privacy_map(event_id))
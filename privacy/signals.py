@@ -1,12 +1,38 @@
 
 # privacy/signals.py
-from django.db.models.signals import post_save
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_delete
 from django.dispatch import receiver
 from .models import PrivacyRequest
-from .tasks import process_privacy_request
+from .resolver import invalidate_privacy_map
+from .tasks import process_privacy_request, refresh_photo_privacy_masks
 
 @receiver(post_save, sender=PrivacyRequest)
 def handle_privacy_request(sender, instance, created, **kwargs):
     """Trigger processing when a request is approved."""
     if instance.status == 'approved':
-        process_privacy_request.delay(instance.id)
\ No newline at end of file
+        process_privacy_request.delay(instance.id)
+    elif instance.status == 'completed':
+        # Its hidden or blurred photos changed the event's privacy map
+        invalidate_privacy_map(instance.event_id)
+
+
+@receiver(pre_delete, sender=PrivacyRequest)
+def collect_masked_photos(sender, instance, **kwargs):
+    """Remember the photos a blur request masks, before its processed photos are deleted."""
+    if instance.request_type == 'blur':
+        instance._masked_photo_ids = list(
+            instance.processed_photos.values_list('original_photo_id', flat=True)
+        )
+
+
+@receiver(post_delete, sender=PrivacyRequest)
+def drop_deleted_request_privacy(sender, instance, **kwargs):
+    """Deleting a completed request restores its photos."""
+    if instance.status == 'completed':
+        invalidate_privacy_map(instance.event_id)
+    
+    # Only the masks lose this request's regions; other requests are not reprocessed
+    photo_ids = getattr(instance, '_masked_photo_ids', None)
+    if photo_ids:
+        transaction.on_commit(lambda: refresh_photo_privacy_masks.delay(photo_ids))
@@ -1,21 +1,21 @@
 # privacy/tasks.py
 import os
-import cv2
 import numpy as np
 import logging
-import tempfile
-from datetime import datetime
 from django.utils import timezone
 from django.conf import settings
 from django.db import transaction
-from celery import shared_task
+from django.db.models import F
+from celery import chord, shared_task
 
 from photos.models import EventPhoto
-from users.models import CustomUser
 from .models import PrivacyRequest, ProcessedPhoto
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_BLUR_CHUNK_SIZE = 25
+
+
 @shared_task
 def process_privacy_request(request_id):
     """Process a privacy request after it's been approved."""
@@ -32,20 +32,21 @@ def process_privacy_request(request_id):
                 logger.warning(f"Privacy request {request_id} is not in 'approved' state: {privacy_request.status}")
                 return False
             
-            # Update status to processing
+            # Update status to processing; the count grows as chunks finish
             privacy_request.status = 'processing'
+            privacy_request.processed_photos_count = privacy_request.processed_photos.count()
             privacy_request.save()
         
-        # Get all photos from the event
-        event_photos = EventPhoto.objects.filter(event=privacy_request.event)
-        logger.info(f"Processing {len(event_photos)} photos for privacy request {request_id}")
+        # Only photos the user was recognized in are affected
+        photo_ids = list(affected_photos(privacy_request).values_list('id', flat=True))
+        logger.info(f"Processing {len(photo_ids)} photos for privacy request {request_id}")
         
         # Get user face encoding if needed
         user = privacy_request.user
         if privacy_request.request_type in ['blur', 'hide']:
-            user_encoding = get_user_face_encoding(user)
-            # Check if encoding exists
-            if user_encoding is None:
+            user_data = get_user_face_data(user)
+            # Check if embeddings exist
+            if user_data is None:
                 logger.error(f"Failed to get face encoding for user {user.id}. User may not have a valid avatar.")
                 with transaction.atomic():
                     privacy_request = PrivacyRequest.objects.select_for_update().get(id=request_id)
@@ -56,19 +57,13 @@ def process_privacy_request(request_id):
         
         # Process different request types
         if privacy_request.request_type == 'blur':
-            process_blur_request(privacy_request, event_photos)
+            # Chunks are blurred in parallel and the last one completes the request
+            process_blur_request(privacy_request, photo_ids)
+            return True
         elif privacy_request.request_type == 'hide':
-            process_hide_request(privacy_request, event_photos)
-        
-        # Update request status after completion
-        with transaction.atomic():
-            privacy_request = PrivacyRequest.objects.select_for_update().get(id=request_id)
-            privacy_request.status = 'completed'
-            privacy_request.processed_at = timezone.now()
-            privacy_request.processed_photos_count = privacy_request.processed_photos.count()
-            privacy_request.save()
+            process_hide_request(privacy_request, photo_ids)
         
-        logger.info(f"Completed processing privacy request {request_id}")
+        complete_privacy_request(request_id)
         return True
     
     except Exception as e:
@@ -91,126 +86,187 @@ def process_privacy_request(request_id):
         return False
 
 
-def process_blur_request(privacy_request, event_photos):
-    """Process a request to blur a user's face in photos."""
-    import shutil
+def affected_photos(privacy_request):
+    """Photos of the request's event the user was recognized in, selected with one join."""
+    return EventPhoto.objects.filter(
+        event_id=privacy_request.event_id,
+        user_matches__user_id=privacy_request.user_id,
+    ).order_by('id')
+
+
+def complete_privacy_request(request_id):
+    """Mark a processing request completed with its final count of processed photos."""
+    with transaction.atomic():
+        privacy_request = PrivacyRequest.objects.select_for_update().get(id=request_id)
+        if privacy_request.status != 'processing':
+            logger.warning(f"Privacy request {request_id} is not in 'processing' state: {privacy_request.status}")
+            return False
+        privacy_request.status = 'completed'
+        privacy_request.processed_at = timezone.now()
+        privacy_request.processed_photos_count = privacy_request.processed_photos.count()
+        privacy_request.save()
     
-    user = privacy_request.user
-    processed_count = 0
+    logger.info(f"Completed processing privacy request {request_id}")
+    return True
+
+
+def process_blur_request(privacy_request, photo_ids, chunk_size=None):
+    """Fan a blur request out as chunk tasks, completing it after the last chunk."""
+    chunk_size = chunk_size or getattr(settings, 'PRIVACY_BLUR_CHUNK_SIZE', DEFAULT_BLUR_CHUNK_SIZE)
+    chunks = [photo_ids[start:start + chunk_size] for start in range(0, len(photo_ids), chunk_size)]
     
-    # Get user face encodings (assuming a profile picture exists)
-    user_encoding = get_user_face_encoding(user)
-    if user_encoding is None:
-        logger.error(f"No face encoding available for user {user.id}")
-        return
+    finish = finish_blur_request.si(privacy_request.id)
+    if chunks:
+        chord(blur_photo_chunk.si(privacy_request.id, chunk) for chunk in chunks)(finish)
+    else:
+        finish.delay()
     
-    # Process each photo
-    for photo in event_photos:
-        try:
-            # Check if user is in this photo
-            if not user_is_in_photo(photo, user):
-                continue
-            
-            # Check if there's already a blurred version of this photo
-            existing_processed = ProcessedPhoto.objects.filter(
-                original_photo=photo,
-                privacy_request__request_type='blur',
-                privacy_request__status='completed',
-                processed_image__isnull=False
-            ).first()
-            
-            if existing_processed:
-                # Use the existing blurred image as starting point
-                logger.info(f"Using existing blurred version for photo {photo.id}")
-                image_path = os.path.join(settings.MEDIA_ROOT, str(existing_processed.processed_image))
-                if not os.path.exists(image_path):
-                    logger.warning(f"Existing blurred image doesn't exist: {image_path}")
-                    image_path = photo.image.path
-            else:
-                # Use original image
-                image_path = photo.image.path
-            
-            if not os.path.exists(image_path):
-                logger.warning(f"Image doesn't exist: {image_path}")
-                continue
-            
-            # Process the image
-            processed_image, face_locations = blur_user_face(image_path, user_encoding, blur_factor=101)  # Increased blur factor
-            if processed_image is None:
-                continue
-            
-            # Save the processed image
-            with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as temp_file:
-                temp_path = temp_file.name
-                cv2.imwrite(temp_path, processed_image)
-            
-            # Create processed photo record
-            processed_photo = ProcessedPhoto(
-                privacy_request=privacy_request,
-                original_photo=photo,
-                face_coordinates=face_locations
+    logger.info(f"Queued {len(photo_ids)} photos in {len(chunks)} chunks for blur request {privacy_request.id}")
+    return len(chunks)
+
+
+@shared_task
+def blur_photo_chunk(request_id, photo_ids):
+    """Locate the user's face in a chunk of photos and add it to their privacy masks."""
+    from .masks import refresh_privacy_masks
+    
+    try:
+        privacy_request = PrivacyRequest.objects.select_related('user').get(id=request_id)
+        if privacy_request.status != 'processing':
+            logger.warning(f"Privacy request {request_id} is no longer processing: {privacy_request.status}")
+            return 0
+        
+        user = privacy_request.user
+        user_data = get_user_face_data(user)
+        if user_data is None:
+            logger.error(f"No face embeddings available for user {user.id}")
+            return 0
+        user_encoding = user_data.get('face_recognition_encoding')
+        
+        # Photos a retried chunk already processed are skipped
+        photos = list(
+            EventPhoto.objects.filter(id__in=photo_ids)
+            .exclude(privacy_versions__privacy_request_id=request_id)
+        )
+        
+        # Faces are located from the stored detections and embeddings where possible
+        stored_regions, compared = stored_face_regions(photos, user, user_data)
+        
+        processed = []
+        for photo in photos:
+            try:
+                if photo.id in stored_regions:
+                    regions = stored_regions[photo.id]
+                elif photo.id in compared:
+                    # Every stored face was compared with the user: detecting them again would not help
+                    logger.info(f"User {user.id} matched no stored face of photo {photo.id}")
+                    continue
+                else:
+                    # No stored faces or embeddings to go by
+                    regions = locate_photo_regions(photo, user_encoding)
+                if not regions:
+                    logger.warning(f"Could not locate user {user.id} in photo {photo.id}")
+                    continue
+                
+                # Only the regions are recorded; blurred versions are rendered when viewed
+                processed.append(ProcessedPhoto(
+                    privacy_request=privacy_request,
+                    original_photo=photo,
+                    face_coordinates=regions
+                ))
+                
+            except Exception as e:
+                logger.error(f"Error processing photo {photo.id}: {str(e)}")
+        
+        with transaction.atomic():
+            ProcessedPhoto.objects.bulk_create(processed, ignore_conflicts=True)
+            PrivacyRequest.objects.filter(id=request_id).update(
+                processed_photos_count=F('processed_photos_count') + len(processed)
             )
-            
-            # Save the processed image to media
-            filename = f"privacy_{photo.id}_{user.id}_{timezone.now().strftime('%Y%m%d%H%M%S')}.jpg"
-            relative_path = os.path.join('privacy_processed', filename)
-            final_path = os.path.join(settings.MEDIA_ROOT, relative_path)
-            
-            # Create directory if it doesn't exist
-            os.makedirs(os.path.dirname(final_path), exist_ok=True)
-            
-            # Use shutil.copy2 instead of os.rename to handle cross-drive operations
-            shutil.copy2(temp_path, final_path)
-            # Delete the temp file after copying
-            os.unlink(temp_path)
-            
-            processed_photo.processed_image = relative_path
-            processed_photo.save()
-            
-            processed_count += 1
-            
-        except Exception as e:
-            logger.error(f"Error processing photo {photo.id}: {str(e)}")
+        
+        # A mask version bump per photo; nothing is decoded or encoded here
+        updated = refresh_privacy_masks(photo_ids, include_request_id=request_id)
+        
+        logger.info(
+            f"Masked {len(processed)} of {len(photo_ids)} photos for blur request {request_id}, "
+            f"updated {updated} masks"
+        )
+        return len(processed)
     
-    logger.info(f"Processed {processed_count} photos for blur request {privacy_request.id}")
-    return processed_count
+    except Exception as e:
+        # Never fail the chord: the request still completes after the last chunk
+        logger.error(f"Error processing blur chunk of request {request_id}: {str(e)}")
+        return 0
 
 
+@shared_task
+def finish_blur_request(request_id):
+    """Chord callback completing a blur request once every chunk has run."""
+    from .masks import refresh_privacy_masks
+    
+    try:
+        completed = complete_privacy_request(request_id)
+        if completed:
+            # Picks up regions a concurrent refresh dropped while the request was processing
+            photo_ids = ProcessedPhoto.objects.filter(privacy_request_id=request_id).values_list('original_photo_id', flat=True)
+            refresh_privacy_masks(list(photo_ids))
+        return completed
+    except Exception as e:
+        logger.error(f"Error completing blur request {request_id}: {str(e)}")
+        return False
+
 
-def process_hide_request(privacy_request, event_photos):
-    """Process a request to hide photos containing a user."""
-    user = privacy_request.user
-    processed_count = 0
+@shared_task
+def refresh_photo_privacy_masks(photo_ids):
+    """Update the privacy masks of photos whose blur requests changed."""
+    from .masks import refresh_privacy_masks
+    
+    try:
+        return refresh_privacy_masks(photo_ids)
+    except Exception as e:
+        logger.error(f"Error refreshing privacy masks: {str(e)}")
+        return 0
+
+
+def locate_photo_regions(photo, user_encoding):
+    """Regions of the user's face in a photo's original, detecting faces again, or None."""
+    import cv2
     
-    # Get user face encoding
-    user_encoding = get_user_face_encoding(user)
     if user_encoding is None:
-        logger.error(f"No face encoding available for user {user.id}")
-        return
+        return None
     
-    # Process each photo
-    for photo in event_photos:
-        try:
-            # Check if user is in this photo
-            if user_is_in_photo(photo, user):
-                # Create a processed photo record (with no image) to mark it as hidden
-                # Make sure it doesn't already exist
-                existing_record = ProcessedPhoto.objects.filter(
-                    privacy_request=privacy_request,
-                    original_photo=photo
-                ).first()
-                
-                if not existing_record:
-                    ProcessedPhoto.objects.create(
-                        privacy_request=privacy_request,
-                        original_photo=photo
-                    )
-                    processed_count += 1
-        except Exception as e:
-            logger.error(f"Error processing hide request for photo {photo.id}: {str(e)}")
+    image_path = photo.image.path
+    if not os.path.exists(image_path):
+        logger.warning(f"Image doesn't exist: {image_path}")
+        return None
     
-    logger.info(f"Hidden {processed_count} photos for hide request {privacy_request.id}")
-    return processed_count
+    image = cv2.imread(image_path)
+    if image is None:
+        logger.error(f"Failed to load image: {image_path}")
+        return None
+    
+    height, width = image.shape[:2]
+    return [
+        {
+            'top': max(0, region['top']), 'right': min(width, region['right']),
+            'bottom': min(height, region['bottom']), 'left': max(0, region['left']),
+        }
+        for region in locate_user_faces(image, user_encoding, photo)
+    ]
+
+
+def process_hide_request(privacy_request, photo_ids):
+    """Hide the photos containing a user, recording them with one bulk insert."""
+    # Records without an image mark the photos as hidden
+    existing = set(privacy_request.processed_photos.values_list('original_photo_id', flat=True))
+    hidden = [
+        ProcessedPhoto(privacy_request=privacy_request, original_photo_id=photo_id)
+        for photo_id in photo_ids if photo_id not in existing
+    ]
+    ProcessedPhoto.objects.bulk_create(hidden, batch_size=500, ignore_conflicts=True)
+    
+    logger.info(f"Hidden {len(hidden)} photos for hide request {privacy_request.id}")
+    return len(hidden)
 
 
 def user_is_in_photo(photo, user):
@@ -223,40 +279,125 @@ def user_is_in_photo(photo, user):
 
 
 def get_user_face_encoding(user):
-    """Get face encoding for a user from their profile picture."""
-    import face_recognition
+    """Get face encoding for a user from the stored avatar embeddings."""
+    user_data = get_user_face_data(user)
+    return user_data['face_recognition_encoding'] if user_data else None
+
+
+def get_user_face_data(user):
+    """Stored avatar embeddings of a user, in the format the face matcher uses, or None."""
+    from photos.embeddings import get_stored_user_embeddings
+    from photos.tasks import refresh_user_face_embeddings
     
     # Check if user has a profile picture
     if not user.avatar:
         return None
     
-    # Load the user's avatar image
-    avatar_path = os.path.join(settings.MEDIA_ROOT, str(user.avatar))
-    if not os.path.exists(avatar_path):
-        return None
-    
     try:
-        # Load image with face_recognition
-        image = face_recognition.load_image_file(avatar_path)
-        
-        # Find faces in the image
-        face_locations = face_recognition.face_locations(image)
-        if not face_locations:
-            return None
+        user_data, processed_ids = get_stored_user_embeddings([user.id])
         
-        # Generate encodings for the face
-        face_encodings = face_recognition.face_encodings(image, face_locations)
-        if not face_encodings:
-            return None
+        # Avatar never processed: compute and store its embeddings now
+        if user.id not in processed_ids:
+            refresh_user_face_embeddings(user.id)
+            user_data, _ = get_stored_user_embeddings([user.id])
         
-        # Return the first encoding
-        return face_encodings[0]
+        return user_data.get(user.id)
     
     except Exception as e:
-        logger.error(f"Error getting face encoding for user {user.id}: {str(e)}")
+        logger.error(f"Error getting face embeddings for user {user.id}: {str(e)}")
         return None
 
-def blur_user_face(image_path, user_encoding, blur_factor=101):  # Increased from 51 to 101
+
+def face_region(face):
+    """Blur region of a photo.detected_faces entry, in original pixels."""
+    x, y = int(face['x']), int(face['y'])
+    return {
+        "top": y,
+        "right": x + int(face['width']),
+        "bottom": y + int(face['height']),
+        "left": x,
+    }
+
+
+def stored_face_regions(photos, user, user_data=None):
+    """
+    Regions of a user's face in photos, from the stored detection data.
+
+    Faces the pipeline already matched to the user are read from
+    photo.detected_faces. For the other photos, the stored embeddings of
+    their faces are scored against the user's avatar embeddings, in one
+    query. Returns ({photo id: regions}, ids of the photos whose stored
+    faces were all compared with the user); only photos in neither have no
+    stored data to decide whether the user is in them.
+    """
+    from photos.embeddings import get_photo_face_reps
+    from photos.matching import EventFaceMatcher
+    
+    regions = {}
+    unresolved = {}
+    for photo in photos:
+        # face_id -> entry, for the faces with a stored box
+        faces = {
+            face.get('face_id', index): face
+            for index, face in enumerate(photo.detected_faces or [])
+            if isinstance(face, dict) and all(key in face for key in ('x', 'y', 'width', 'height'))
+        }
+        matched = [face_region(face) for face in faces.values() if face.get('user_id') == user.id]
+        if matched:
+            regions[photo.id] = matched
+        elif faces:
+            unresolved[photo.id] = faces
+    
+    compared = set()
+    if unresolved and user_data:
+        matcher = EventFaceMatcher({user.id: user_data})
+        for photo_id, face_reps in get_photo_face_reps(unresolved).items():
+            faces = unresolved[photo_id]
+            face_reps = [face_rep for face_rep in face_reps if face_rep['index'] in faces]
+            if not any(comparable(matcher, face_rep) for face_rep in face_reps):
+                continue
+            compared.add(photo_id)
+            matched = [
+                face_region(faces[face_rep['index']])
+                for face_rep, match in zip(face_reps, matcher.match_faces(face_reps))
+                if match
+            ]
+            if matched:
+                regions[photo_id] = matched
+    
+    return regions, compared
+
+
+def comparable(matcher, face_rep):
+    """Whether a stored face has an embedding the user also has."""
+    if face_rep['face_recognition_encoding'] is not None and matcher.fr_matrix is not None:
+        return True
+    return any(matcher.has_model(model_name) for model_name in face_rep['deepface_representations'])
+
+
+def blur_regions(image, regions, blur_factor=101):
+    """Blur regions of a BGR image in place; returns the regions, clipped to the image."""
+    import cv2
+    
+    # Ensure blur factor is odd
+    if blur_factor % 2 == 0:
+        blur_factor += 1
+    
+    height, width = image.shape[:2]
+    blurred = []
+    for region in regions:
+        top, bottom = max(0, region['top']), min(height, region['bottom'])
+        left, right = max(0, region['left']), min(width, region['right'])
+        if bottom <= top or right <= left:
+            continue
+        
+        # Apply intensive Gaussian blur to the face region
+        image[top:bottom, left:right] = cv2.GaussianBlur(image[top:bottom, left:right], (blur_factor, blur_factor), 0)
+        blurred.append({"top": top, "right": right, "bottom": bottom, "left": left})
+    
+    return blurred
+
+def blur_user_face(image_path, user_encoding, blur_factor=101, photo=None):  # Increased from 51 to 101
     """
     Blur the face of a specific user in an image.
     
@@ -264,78 +405,83 @@ def blur_user_face(image_path, user_encoding, blur_factor=101):  # Increased fro
         image_path: Path to the image file
         user_encoding: Face encoding of the user to blur
         blur_factor: Blur intensity (must be odd number)
+        photo: EventPhoto the image belongs to; faces are then located on
+            its analysis proxy and only the blur touches the full image
         
     Returns:
         processed_image: The image with blurred face
         face_locations: List of coordinates of blurred faces
     """
-    import face_recognition
+    import cv2
     
     try:
-        # Ensure blur factor is odd
-        if blur_factor % 2 == 0:
-            blur_factor += 1
-        
         # Load the image
         image = cv2.imread(image_path)
         if image is None:
             logger.error(f"Failed to load image: {image_path}")
             return None, None
         
-        # Convert BGR to RGB (face_recognition uses RGB)
-        rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        
-        # Find all faces in the image
-        face_locations = face_recognition.face_locations(rgb_image)
-        if not face_locations:
-            return image, []
-        
-        # Get encodings for all faces
-        face_encodings = face_recognition.face_encodings(rgb_image, face_locations)
-        
-        # Track which faces match the user
-        blurred_faces = []
-        
-        # Check each face for a match with the user
-        for i, face_encoding in enumerate(face_encodings):
-            # Compare with user encoding
-            matches = face_recognition.compare_faces([user_encoding], face_encoding, tolerance=0.6)
-          
-            # Use .any() for NumPy array boolean evaluation
-            if matches[0].any():
-                # This face matches the user - blur it
-                top, right, bottom, left = face_locations[i]
-                
-                # Extract the face region
-                face_region = image[top:bottom, left:right]
-                
-                # Apply intensive Gaussian blur
-                blurred_face = cv2.GaussianBlur(face_region, (blur_factor, blur_factor), 0)
-                
-                # Replace the face region with the blurred version
-                image[top:bottom, left:right] = blurred_face
-                
-                # Add to list of blurred faces
-                blurred_faces.append({
-                    "top": top,
-                    "right": right,
-                    "bottom": bottom,
-                    "left": left
-                })
-        
         # Return the processed image and face locations
-        return image, blurred_faces
+        return image, blur_regions(image, locate_user_faces(image, user_encoding, photo), blur_factor)
     
     except Exception as e:
         logger.error(f"Error blurring face in image {image_path}: {str(e)}")
         return None, None
 
 
+def locate_user_faces(image, user_encoding, photo=None):
+    """Regions of a BGR image whose faces match the user's encoding, detecting faces again."""
+    import cv2
+    from photos.ml import model_registry
+    face_recognition = model_registry.face_recognition
+    
+    # Locate faces on the analysis proxy when we know the photo
+    scale = 1.0
+    if photo is not None:
+        from photos.proxies import open_analysis_proxy
+        proxy = open_analysis_proxy(photo)
+        rgb_image = np.asarray(proxy)
+        scale = image.shape[1] / proxy.size[0]
+    else:
+        # Convert BGR to RGB (face_recognition uses RGB)
+        rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    
+    # Find all faces in the image
+    face_locations = face_recognition.face_locations(rgb_image)
+    if not face_locations:
+        return []
+    
+    # Get encodings for all faces
+    face_encodings = face_recognition.face_encodings(rgb_image, face_locations)
+    
+    # Map face locations back to full-resolution pixels
+    face_locations = [
+        tuple(int(round(coordinate * scale)) for coordinate in location)
+        for location in face_locations
+    ]
+    
+    # Track which faces match the user
+    user_regions = []
+    
+    # Check each face for a match with the user
+    for i, face_encoding in enumerate(face_encodings):
+        # Compare with user encoding
+        matches = face_recognition.compare_faces([user_encoding], face_encoding, tolerance=0.6)
+      
+        # Use .any() for NumPy array boolean evaluation
+        if matches[0].any():
+            top, right, bottom, left = face_locations[i]
+            user_regions.append({"top": top, "right": right, "bottom": bottom, "left": left})
+    
+    return user_regions
+
+
 def check_photo_privacy(photo, user=None):
     """
     Check if a photo should be hidden or has privacy-processed versions.
     
     This function can be called from templates to determine how to display photos.
+    Pages of photos should use privacy.resolver.attach_privacy_status instead.
     
     Args:
         photo: An EventPhoto instance
@@ -344,33 +490,7 @@ def check_photo_privacy(photo, user=None):
     Returns:
         dict: Privacy status information for the photo
     """
-    result = {
-        'is_hidden': False,
-        'has_blurred_version': False,
-        'blurred_image': None
-    }
+    from .resolver import get_privacy_map, privacy_status
     
-    # Check if the photo is hidden due to any hide requests
-    hide_requests = ProcessedPhoto.objects.filter(
-        original_photo=photo,
-        privacy_request__request_type='hide',
-        privacy_request__status='completed',
-        processed_image__isnull=True  # For hide requests, no processed image is stored
-    ).exists()
-    
-    if hide_requests:
-        result['is_hidden'] = True
-    
-    # Check if there's a blurred version of this photo
-    blurred_version = ProcessedPhoto.objects.filter(
-        original_photo=photo,
-        privacy_request__request_type='blur',
-        privacy_request__status='completed',
-        processed_image__isnull=False
-    ).first()
-    
-    if blurred_version:
-        result['has_blurred_version'] = True
-        result['blurred_image'] = blurred_version.processed_image
-    
-    return result
\ No newline at end of file
+    # Read from the event's cached map rather than queried per photo
+    return privacy_status(photo.id, get_privacy_map(photo.event_id))
@@ -1,3 +1,451 @@
-from django.test import TestCase
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from unittest.mock import patch
 
-# Create your tests here.
+import numpy as np # type: ignore
+from PIL import Image
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from events.models import Event
+from photos.models import EventPhoto, PhotoFaceEmbedding, UserFaceEmbedding, UserPhotoMatch
+from .derivatives import (
+    DerivativeBusy, acquire_render_slot, evict_derivatives, get_derivative, get_render_cache, release_render_slot,
+)
+from .models import PrivacyMask, PrivacyRequest, ProcessedPhoto
+from . import resolver
+from .resolver import attach_privacy_status, exclude_hidden, get_privacy_cache
+from .tasks import (
+    blur_photo_chunk, blur_regions, check_photo_privacy, finish_blur_request, process_privacy_request,
+    refresh_photo_privacy_masks, stored_face_regions,
+)
+
+
+def face(face_id, x, user_id=None):
+    return {'face_id': face_id, 'x': x, 'y': 10, 'width': 40, 'height': 50, 'user_id': user_id}
+
+
+class StoredFaceRegionTests(TestCase):
+    """Blur regions come from stored detections and embeddings, without decoding photos."""
+
+    @classmethod
+    def setUpTestData(cls):
+        User = get_user_model()
+        cls.user = User.objects.create_user('guest', 'guest@example.com', 'password')
+        other = User.objects.create_user('other', 'other@example.com', 'password')
+        event = Event.objects.create(
+            title='Privacy', description='Event', location='Hall', organizer=other,
+            start_date=timezone.now(), end_date=timezone.now(),
+        )
+
+        rng = np.random.default_rng(0)
+        cls.embedding = rng.normal(size=128).astype(np.float32)
+
+        # bulk_create sends no post_save, so no ingestion is queued
+        cls.matched, cls.embedded, cls.unknown = EventPhoto.objects.bulk_create([
+            EventPhoto(event=event, image='events/test/matched.jpg',
+                       detected_faces=[face(0, 100, other.id), face(1, 200, cls.user.id)]),
+            EventPhoto(event=event, image='events/test/embedded.jpg',
+                       detected_faces=[face(0, 100), face(1, 300)]),
+            EventPhoto(event=event, image='events/test/unknown.jpg', detected_faces=[]),
+        ])
+        PhotoFaceEmbedding.objects.bulk_create([
+            PhotoFaceEmbedding(photo=cls.embedded, event=event, face_index=index, model_name='Facenet',
+                               embedding=vector.tobytes(), dimensions=len(vector))
+            for index, vector in enumerate([rng.normal(size=128).astype(np.float32), cls.embedding])
+        ])
+
+    def test_regions_from_stored_matches_and_embeddings(self):
+        user_data = {'face_recognition_encoding': None, 'deepface_representations': {'Facenet': self.embedding}}
+        photos = [self.matched, self.embedded, self.unknown]
+
+        # Only the stored embeddings of the photo without a recorded match are read
+        with self.assertNumQueries(1):
+            regions, compared = stored_face_regions(photos, self.user, user_data)
+
+        self.assertEqual(regions, {
+            self.matched.id: [{'top': 10, 'right': 240, 'bottom': 60, 'left': 200}],
+            self.embedded.id: [{'top': 10, 'right': 340, 'bottom': 60, 'left': 300}],
+        })
+        self.assertEqual(compared, {self.embedded.id})
+
+    def test_only_photos_without_stored_faces_are_detected_again(self):
+        # Matches none of the stored faces
+        stranger = np.random.default_rng(1).normal(size=128).astype(np.float32)
+        user_data = {'face_recognition_encoding': None, 'deepface_representations': {'Facenet': stranger}}
+        request = PrivacyRequest.objects.create(
+            user=self.user, event=self.embedded.event, request_type='blur', reason='Privacy'
+        )
+        PrivacyRequest.objects.filter(id=request.id).update(status='processing')
+
+        with patch('privacy.tasks.get_user_face_data', return_value=user_data), \
+                patch('privacy.tasks.locate_photo_regions', return_value=[]) as locate:
+            self.assertEqual(blur_photo_chunk(request.id, [self.embedded.id, self.unknown.id]), 0)
+
+        self.assertEqual([call.args[0].id for call in locate.call_args_list], [self.unknown.id])
+
+
+class BlurRegionTests(SimpleTestCase):
+
+    def test_regions_are_clipped_to_the_image(self):
+        image = np.tile(np.arange(100, dtype=np.uint8), (80, 1))[:, :, None].repeat(3, axis=2)
+        original = image.copy()
+
+        blurred = blur_regions(image, [{'top': -5, 'right': 130, 'bottom': 40, 'left': 60}], blur_factor=10)
+
+        self.assertEqual(blurred, [{'top': 0, 'right': 100, 'bottom': 40, 'left': 60}])
+        self.assertFalse(np.array_equal(image[:40, 60:], original[:40, 60:]))
+        self.assertTrue(np.array_equal(image[40:], original[40:]))
+        self.assertTrue(np.array_equal(image[:, :60], original[:, :60]))
+
+
+class BlurRequestProcessingTests(TestCase):
+    """Blur requests locate faces in chunks and layer them into one mask per photo."""
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        User = get_user_model()
+        self.user = User.objects.create_user('guest', 'guest@example.com', 'password')
+        self.other = User.objects.create_user('other', 'other@example.com', 'password')
+        User.objects.update(avatar='avatars/user.jpg')
+        embedding = np.ones(128, dtype=np.float32)
+        for user in (self.user, self.other):
+            user.refresh_from_db()
+            UserFaceEmbedding.objects.create(
+                user=user, avatar_hash=f'blur-{user.id}', avatar_name=user.avatar.name, model_name='Facenet',
+                embedding=embedding.tobytes(), dimensions=len(embedding),
+            )
+        event = Event.objects.create(
+            title='Blur', description='Event', location='Hall', organizer=self.other,
+            start_date=timezone.now(), end_date=timezone.now(),
+        )
+
+        os.makedirs(os.path.join(self.media_root, 'events', 'test'))
+        photos = []
+        for index in range(5):
+            name = f'events/test/photo{index}.jpg'
+            Image.new('RGB', (120, 90), (index * 40, 200, 100)).save(os.path.join(self.media_root, name))
+            photos.append(EventPhoto(event=event, image=name, detected_faces=[
+                face(0, 20, self.user.id), face(1, 70, self.other.id),
+            ]))
+        self.photos = EventPhoto.objects.bulk_create(photos)
+
+        # The guest was recognized in all but the last photo, the other user in the first two
+        UserPhotoMatch.objects.bulk_create(
+            [UserPhotoMatch(photo=photo, user=self.user, confidence_score=90) for photo in self.photos[:4]]
+            + [UserPhotoMatch(photo=photo, user=self.other, confidence_score=90) for photo in self.photos[:2]]
+        )
+        # Created pending so the approval signal queues nothing
+        self.request, self.other_request = [
+            PrivacyRequest.objects.create(user=user, event=event, request_type='blur', reason='Privacy')
+            for user in (self.user, self.other)
+        ]
+        PrivacyRequest.objects.update(status='approved')
+
+    def process(self, privacy_request):
+        with patch('privacy.tasks.chord') as chord:
+            self.assertTrue(process_privacy_request(privacy_request.id))
+        for signature in chord.call_args.args[0]:
+            blur_photo_chunk(*signature.args)
+        self.assertTrue(finish_blur_request(privacy_request.id))
+
+    def masks(self):
+        return {mask.photo_id: mask for mask in PrivacyMask.objects.all()}
+
+    @override_settings(PRIVACY_BLUR_CHUNK_SIZE=3)
+    def test_matched_photos_are_blurred_in_chunks(self):
+        with patch('privacy.tasks.chord') as chord:
+            self.assertTrue(process_privacy_request(self.request.id))
+
+        chunks = [signature.args for signature in chord.call_args.args[0]]
+        self.assertEqual(chunks, [
+            (self.request.id, [photo.id for photo in self.photos[:3]]),
+            (self.request.id, [self.photos[3].id]),
+        ])
+
+        # Progress is recorded as each chunk finishes
+        self.assertEqual(blur_photo_chunk(*chunks[0]), 3)
+        self.request.refresh_from_db()
+        self.assertEqual((self.request.status, self.request.processed_photos_count), ('processing', 3))
+
+        # A retried chunk skips the photos it already processed
+        self.assertEqual(blur_photo_chunk(*chunks[0]), 0)
+        self.assertEqual(blur_photo_chunk(*chunks[1]), 1)
+        self.assertTrue(finish_blur_request(self.request.id))
+
+        self.request.refresh_from_db()
+        self.assertEqual((self.request.status, self.request.processed_photos_count), ('completed', 4))
+        for processed in self.request.processed_photos.all():
+            self.assertEqual(processed.face_coordinates, [{'top': 10, 'right': 60, 'bottom': 60, 'left': 20}])
+
+        masks = self.masks()
+        self.assertEqual(sorted(masks), [photo.id for photo in self.photos[:4]])
+        for mask in masks.values():
+            self.assertEqual(mask.version, 1)
+            self.assertEqual(mask.regions, [{
+                'request_id': self.request.id, 'top': 10, 'right': 60, 'bottom': 60, 'left': 20, 'blur_factor': 101,
+            }])
+
+    def test_requests_are_layered_and_revoked_without_reprocessing(self):
+        guest_region = {'top': 10, 'right': 60, 'bottom': 60, 'left': 20, 'blur_factor': 101}
+        other_region = {'top': 10, 'right': 110, 'bottom': 60, 'left': 70, 'blur_factor': 101}
+        self.process(self.request)
+        self.process(self.other_request)
+
+        # Photos with both users carry both regions; the others keep their version
+        masks = self.masks()
+        for photo in self.photos[:2]:
+            self.assertEqual(masks[photo.id].regions, [
+                {'request_id': self.request.id, **guest_region},
+                {'request_id': self.other_request.id, **other_region},
+            ])
+            self.assertEqual(masks[photo.id].version, 2)
+        for photo in self.photos[2:4]:
+            self.assertEqual(masks[photo.id].version, 1)
+
+        # Revoking the guest's request only re-aggregates the stored regions
+        with patch('privacy.signals.refresh_photo_privacy_masks.delay') as delay, \
+                patch('privacy.tasks.locate_photo_regions') as locate, \
+                self.captureOnCommitCallbacks(execute=True):
+            self.request.delete()
+        refresh_photo_privacy_masks(*delay.call_args.args)
+        locate.assert_not_called()
+
+        masks = self.masks()
+        for photo in self.photos[:2]:
+            self.assertEqual(masks[photo.id].regions, [{'request_id': self.other_request.id, **other_region}])
+            self.assertEqual(masks[photo.id].version, 3)
+        for photo in self.photos[2:4]:
+            self.assertEqual((masks[photo.id].regions, masks[photo.id].version), ([], 2))
+
+
+class PrivacyResolverTests(TestCase):
+    """Pages of photos are resolved from a cached per-event map; hidden photos are excluded in SQL."""
+
+    def setUp(self):
+        get_privacy_cache().clear()
+        User = get_user_model()
+        self.guest = User.objects.create_user('guest', 'guest@example.com', 'password')
+        self.other = User.objects.create_user('other', 'other@example.com', 'password')
+        self.event = Event.objects.create(
+            title='Resolver', description='Event', location='Hall', organizer=self.other,
+            start_date=timezone.now(), end_date=timezone.now(),
+        )
+        self.hidden, self.blurred, self.plain = EventPhoto.objects.bulk_create(
+            EventPhoto(event=self.event, image=f'events/test/{name}.jpg') for name in ('hidden', 'blurred', 'plain')
+        )
+        # Created pending so the approval signal queues nothing
+        self.hide = PrivacyRequest.objects.create(user=self.guest, event=self.event, request_type='hide')
+        self.blur = PrivacyRequest.objects.create(user=self.other, event=self.event, request_type='blur')
+        ProcessedPhoto.objects.bulk_create([
+            ProcessedPhoto(privacy_request=self.hide, original_photo=self.hidden),
+            ProcessedPhoto(privacy_request=self.blur, original_photo=self.blurred,
+                           face_coordinates=[{'top': 10, 'right': 60, 'bottom': 60, 'left': 20}]),
+        ])
+        PrivacyMask.objects.bulk_create([
+            PrivacyMask(photo=self.blurred, version=2, regions=[{'top': 10, 'right': 60, 'bottom': 60, 'left': 20}]),
+            # Revoked: no regions left
+            PrivacyMask(photo=self.plain, version=1, regions=[]),
+        ])
+
+    def complete(self, privacy_request):
+        privacy_request.status = 'completed'
+        with self.captureOnCommitCallbacks(execute=True):
+            privacy_request.save()
+
+    def test_hidden_photos_are_excluded_in_sql(self):
+        photos = EventPhoto.objects.filter(event=self.event).order_by('id')
+        self.assertEqual(list(exclude_hidden(photos)), [self.hidden, self.blurred, self.plain])
+
+        self.complete(self.hide)
+        self.assertEqual(list(exclude_hidden(photos)), [self.blurred, self.plain])
+
+    def test_page_is_resolved_from_the_cached_map(self):
+        self.complete(self.hide)
+        self.complete(self.blur)
+        photos = list(EventPhoto.objects.filter(event=self.event).order_by('id'))
+
+        with self.assertNumQueries(1):
+            attach_privacy_status(photos)
+        # Warm: no queries for the page or per photo
+        with self.assertNumQueries(0):
+            attach_privacy_status(photos)
+            self.assertTrue(check_photo_privacy(self.hidden)['is_hidden'])
+
+        self.assertEqual([photo.privacy_status for photo in photos], [
+            {'is_hidden': True, 'has_blurred_version': False, 'mask_version': None},
+            {'is_hidden': False, 'has_blurred_version': True, 'mask_version': 2},
+            {'is_hidden': False, 'has_blurred_version': False, 'mask_version': None},
+        ])
+
+    def test_map_is_dropped_when_a_request_completes_or_is_deleted(self):
+        self.assertFalse(check_photo_privacy(self.hidden)['is_hidden'])
+
+        self.complete(self.hide)
+        self.assertTrue(check_photo_privacy(self.hidden)['is_hidden'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.hide.delete()
+        self.assertFalse(check_photo_privacy(self.hidden)['is_hidden'])
+
+    def test_map_built_before_a_change_is_not_served(self):
+        build = resolver.build_privacy_map
+
+        def build_during_change(event_id):
+            privacy_map = build(event_id)
+            # The request completes while this reader is still building from older rows
+            self.complete(self.hide)
+            return privacy_map
+
+        with patch.object(resolver, 'build_privacy_map', side_effect=build_during_change):
+            self.assertFalse(check_photo_privacy(self.hidden)['is_hidden'])
+
+        self.assertTrue(check_photo_privacy(self.hidden)['is_hidden'])
+
+
+class PrivacyDerivativeTests(TestCase):
+    """Blurred derivatives are rendered on first view and cached per mask version and size."""
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        settings_override = override_settings(
+            MEDIA_ROOT=self.media_root, PRIVACY_DERIVATIVE_DIR=os.path.join(self.media_root, 'cache'),
+            PRIVACY_DERIVATIVE_MAX_RENDERS=1,
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        get_render_cache().clear()
+
+        User = get_user_model()
+        self.organizer = User.objects.create_user('organizer', 'organizer@example.com', 'password')
+        event = Event.objects.create(
+            title='Derivatives', description='Event', location='Hall', organizer=self.organizer,
+            start_date=timezone.now(), end_date=timezone.now(),
+        )
+        os.makedirs(os.path.join(self.media_root, 'events', 'test'))
+        name = 'events/test/noise.jpg'
+        self.pixels = np.random.default_rng(0).integers(0, 256, (900, 1200, 3), dtype=np.uint8)
+        Image.fromarray(self.pixels).save(os.path.join(self.media_root, name), quality=95)
+        # bulk_create sends no post_save, so no ingestion is queued
+        self.photo, = EventPhoto.objects.bulk_create([
+            EventPhoto(event=event, image=name, image_width=1200, image_height=900),
+        ])
+        self.mask = PrivacyMask.objects.create(
+            photo=self.photo, version=1, regions=[{'top': 0, 'right': 600, 'bottom': 450, 'left': 0, 'blur_factor': 101}],
+        )
+        self.photo.refresh_from_db()
+
+    def test_derivative_is_blurred_scaled_and_cached(self):
+        path = get_derivative(self.photo, 'thumb')
+        with Image.open(path) as img:
+            thumb = np.asarray(img.convert('RGB')).astype(float)
+        self.assertEqual(thumb.shape, (300, 400, 3))
+        # The masked quarter is smooth, the rest keeps its noise
+        self.assertLess(thumb[:140, :190].std(), thumb[160:, 210:].std() / 3)
+
+        with patch('privacy.derivatives.render_derivative') as render:
+            self.assertEqual(get_derivative(self.photo, 'thumb'), path)
+        render.assert_not_called()
+
+        # A new mask version is a new key
+        self.mask.version = 2
+        self.mask.save()
+        self.photo.refresh_from_db()
+        self.assertNotEqual(get_derivative(self.photo, 'thumb'), path)
+
+    def test_rendering_does_not_load_opencv(self):
+        # A fresh interpreter, as a web process that has not imported anything else
+        script = (
+            "import os, sys\n"
+            "os.environ['DJANGO_SETTINGS_MODULE'] = 'SnapFlow.settings'\n"
+            "import django\n"
+            "django.setup()\n"
+            "from privacy.derivatives import render_derivative\n"
+            f"assert render_derivative({self.photo.image.path!r}, {self.mask.regions!r}).startswith(b'\\xff\\xd8')\n"
+            "print('cv2' in sys.modules)\n"
+        )
+        result = subprocess.run(
+            [sys.executable, '-c', script], cwd=settings.BASE_DIR, capture_output=True, text=True, timeout=120,
+        )
+
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout.strip().splitlines()[-1], 'False')
+
+    def test_least_recently_served_derivatives_are_evicted(self):
+        thumb = get_derivative(self.photo, 'thumb')
+        medium = get_derivative(self.photo, 'medium')
+        os.utime(thumb, (1, 1))
+
+        self.assertEqual(evict_derivatives(max_bytes=os.path.getsize(medium)), 1)
+        self.assertFalse(os.path.exists(thumb))
+        self.assertTrue(os.path.exists(medium))
+
+    @override_settings(PRIVACY_DERIVATIVE_RENDER_WAIT=0)
+    def test_renders_are_capped_across_processes(self):
+        # The only slot is leased through the shared cache, as another process would
+        slot = acquire_render_slot()
+        self.assertIsNotNone(slot)
+        with self.assertRaises(DerivativeBusy):
+            get_derivative(self.photo, 'thumb')
+
+        release_render_slot(slot)
+        self.assertIsNotNone(get_derivative(self.photo, 'thumb'))
+        # Released after the render
+        self.assertIsNotNone(acquire_render_slot())
+
+    @override_settings(PRIVACY_DERIVATIVE_EVICT_EVERY=2)
+    def test_eviction_runs_every_few_renders(self):
+        with patch('privacy.derivatives.evict_derivatives') as evict:
+            for size in ('thumb', 'medium', 'full'):
+                get_derivative(self.photo, size)
+            # Served from disk: not a render
+            get_derivative(self.photo, 'thumb')
+        evict.assert_called_once_with()
+
+    def test_view_renders_a_derivative_evicted_before_it_is_opened(self):
+        get_user_model().objects.update(avatar='avatars/user.jpg', phone_number='5550100', role='PARTICIPANT')
+        self.client.force_login(self.organizer)
+        paths = []
+
+        def get_then_evict(photo, size):
+            path = get_derivative(photo, size)
+            if not paths:
+                os.remove(path)
+            paths.append(path)
+            return path
+
+        with patch('privacy.views.get_derivative', side_effect=get_then_evict):
+            response = self.client.get(reverse('privacy:photo_derivative', args=[self.photo.id, 'thumb']))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(paths), 2)
+        self.assertTrue(b''.join(response.streaming_content).startswith(b'\xff\xd8'))
+
+    def test_view_serves_gallery_viewers_only(self):
+        url = reverse('privacy:photo_derivative', args=[self.photo.id, 'thumb'])
+        stranger = get_user_model().objects.create_user('stranger', 'stranger@example.com', 'password')
+        # Complete profiles, so the profile middleware lets both through
+        get_user_model().objects.update(
+            avatar='avatars/user.jpg', phone_number='5550100', role='PARTICIPANT', is_staff=False,
+        )
+        self.client.force_login(self.organizer)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertEqual(self.client.get(reverse('privacy:photo_derivative', args=[self.photo.id, 'huge'])).status_code, 404)
+
+        self.client.force_login(stranger)
+        self.assertEqual(self.client.get(url).status_code, 404)
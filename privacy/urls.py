@@ -14,4 +14,7 @@ urlpatterns = [
     path('manage/', views.OrganizerPrivacyRequestListView.as_view(), name='organizer_requests'),
     path('event/<slug:slug>/requests/', views.EventPrivacyRequestListView.as_view(), name='event_requests'),
     path('requests/<int:pk>/respond/', views.PrivacyRequestResponseView.as_view(), name='respond_to_request'),
+    
+    # Privacy-safe photo derivatives
+    path('photo/<int:pk>/<str:size>/', views.photo_derivative, name='photo_derivative'),
 ]
\ No newline at end of file
@@ -5,11 +5,14 @@ from django.views.generic import ListView, DetailView, CreateView, UpdateView
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
 from django.urls import reverse_lazy, reverse
 from django.contrib import messages
-from django.http import HttpResponseRedirect
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseRedirect
 from django.utils import timezone
 
 from events.models import Event
+from photos.models import EventPhoto
+from .derivatives import DerivativeBusy, get_derivative, get_sizes
 from .models import PrivacyRequest, ProcessedPhoto
+from .resolver import exclude_hidden
 from .forms import PrivacyRequestForm, PrivacyRequestResponseForm
 
 
@@ -148,4 +151,51 @@ class PrivacyRequestResponseView(LoginRequiredMixin, UserPassesTestMixin, Update
                     return self.form_invalid(form)
                 messages.info(self.request, f"Privacy request has been rejected.")
             
-        return super().form_valid(form)
\ No newline at end of file
+        return super().form_valid(form)
+
+
+def can_view_gallery(user, event):
+    """Organizers, crew members and participants with approved gallery access."""
+    return (
+        event.organizer_id == user.id
+        or event.crew_members.filter(member=user).exists()
+        or event.participants.filter(user=user, gallery_access='APPROVED').exists()
+    )
+
+
+@login_required
+def photo_derivative(request, pk, size):
+    """Serve a photo with every privacy mask region blurred, rendered and cached on first view."""
+    if size not in get_sizes():
+        raise Http404("Unknown size")
+    
+    # Hidden photos are never served
+    photo = get_object_or_404(
+        exclude_hidden(EventPhoto.objects.select_related('event', 'privacy_mask')), pk=pk
+    )
+    if not can_view_gallery(request.user, photo.event):
+        raise Http404("Photo not found")
+    
+    image = None
+    try:
+        # Twice: a file evicted between the lookup and the open is rendered again
+        for _ in range(2):
+            path = get_derivative(photo, size)
+            if path is None:
+                raise Http404("Photo could not be rendered")
+            try:
+                image = open(path, 'rb')
+                break
+            except FileNotFoundError:
+                continue
+    except DerivativeBusy:
+        pass
+    if image is None:
+        response = HttpResponse("Too many photos are being prepared, please retry.", status=503)
+        response['Retry-After'] = '2'
+        return response
+    
+    response = FileResponse(image, content_type='image/jpeg')
+    # Links carry the mask version, so a changed mask is a new URL
+    response['Cache-Control'] = 'private, max-age=86400'
+    return response
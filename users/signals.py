@@ -1,5 +1,5 @@
 # signals.py
-from django.db.models.signals import post_save
+from django.db.models.signals import post_init, post_save
 from django.dispatch import receiver
 from django.core.mail import send_mail
 from django.conf import settings
@@ -60,3 +60,21 @@ def user_profile_updated(sender, instance, created, **kwargs):
                     )
             except Exception as e:
                 print(f"Failed to send admin notification: {str(e)}")
+
+
+@receiver(post_init, sender=CustomUser)
+def remember_avatar(sender, instance, **kwargs):
+    """Keep the loaded avatar name to detect avatar changes on save"""
+    instance._original_avatar = instance.__dict__.get('avatar')
+
+
+@receiver(post_save, sender=CustomUser)
+def user_avatar_changed(sender, instance, created, **kwargs):
+    """Recompute stored face embeddings when the avatar changes"""
+    avatar = str(instance.avatar) if instance.avatar else ''
+    original = str(getattr(instance, '_original_avatar', '') or '')
+    instance._original_avatar = instance.avatar.name if instance.avatar else None
+
+    if avatar and (created or avatar != original):
+        from photos.tasks import refresh_user_face_embeddings
+        refresh_user_face_embeddings.delay(instance.id)